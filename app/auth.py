@@ -4,17 +4,28 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, APIKeyHeader
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 from app.database import get_db
 from app import models
+from collections import OrderedDict
+import os
 import secrets
 import hashlib
+import threading
+import time
 
 # Secret key for JWT. In production, this should be in environment variables.
 SECRET_KEY = "your-secret-key-please-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# API key cache. The revocation stamp file lets another process (the CLI)
+# invalidate the cache of the running server.
+API_KEY_CACHE_TTL = int(os.getenv("API_KEY_CACHE_TTL", 300))
+API_KEY_CACHE_SIZE = int(os.getenv("API_KEY_CACHE_SIZE", 256))
+API_KEY_REVOCATION_FILE = os.getenv("API_KEY_REVOCATION_FILE", "apikey_revocations.stamp")
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 api_key_header = APIKeyHeader(name="X-Webhook-Secret", auto_error=False)
@@ -60,6 +71,105 @@ def generate_api_key():
 def hash_api_key(api_key: str):
     return hashlib.sha256(api_key.encode()).hexdigest()
 
+class APIKeyCache:
+    """LRU cache with TTL mapping a hashed API key to a detached snapshot of its User."""
+
+    def __init__(self, ttl: int = API_KEY_CACHE_TTL, max_size: int = API_KEY_CACHE_SIZE,
+                 stamp_file: str = API_KEY_REVOCATION_FILE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stamp_file = stamp_file
+        self._entries = OrderedDict()  # hashed_key -> (expires_at, user)
+        self._lock = threading.Lock()
+        self._stamp = self._read_stamp()
+
+    def _read_stamp(self):
+        try:
+            return os.stat(self.stamp_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self, hashed_key: str):
+        stamp = self._read_stamp()
+        with self._lock:
+            if stamp != self._stamp:
+                # A key was revoked somewhere, start over
+                self._entries.clear()
+                self._stamp = stamp
+
+            entry = self._entries.get(hashed_key)
+            if not entry:
+                return None
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                del self._entries[hashed_key]
+                return None
+            self._entries.move_to_end(hashed_key)
+            return user
+
+    def put(self, hashed_key: str, user: models.User):
+        with self._lock:
+            self._entries[hashed_key] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(hashed_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_key(self, hashed_key: str):
+        with self._lock:
+            self._entries.pop(hashed_key, None)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for hashed_key in [k for k, (_, user) in self._entries.items() if user.user_id == user_id]:
+                del self._entries[hashed_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+api_key_cache = APIKeyCache()
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+@event.listens_for(models.APIKey, "after_update")
+@event.listens_for(models.APIKey, "after_delete")
+def _invalidate_cached_user(mapper, connection, target):
+    # Snapshots carry profile fields (weight, timezone) used when logging, so drop them on change
+    api_key_cache.invalidate_user(target.user_id)
+
+def notify_api_key_revoked(hashed_key: Optional[str] = None):
+    """
+    Drops a revoked key from this process's cache and bumps the revocation
+    stamp so other processes drop their cached keys as well.
+    """
+    if hashed_key:
+        api_key_cache.invalidate_key(hashed_key)
+    with open(API_KEY_REVOCATION_FILE, "w") as f:
+        f.write(str(time.time_ns()))
+
+def authenticate_api_key(db: Session, api_key: str) -> Optional[models.User]:
+    """
+    Resolves a raw API key to its User, attached to `db`.
+    Cached keys are served without querying the database.
+    """
+    hashed = hash_api_key(api_key)
+    user = api_key_cache.get(hashed)
+    if user is None:
+        user = db.query(models.User).join(
+            models.APIKey, models.APIKey.user_id == models.User.user_id
+        ).filter(
+            models.APIKey.hashed_key == hashed,
+            models.APIKey.is_active == True
+        ).first()
+        if not user:
+            return None
+        # Keep the loaded instance as the cached snapshot
+        db.expunge(user)
+        api_key_cache.put(hashed, user)
+
+    # Attach a copy to this session without a SELECT so callers can still modify it
+    return db.merge(user, load=False)
+
 def verify_webhook_api_key(api_key: str = Depends(api_key_header), db: Session = Depends(get_db)):
     if not api_key:
          raise HTTPException(
@@ -67,7 +177,6 @@ def verify_webhook_api_key(api_key: str = Depends(api_key_header), db: Session =
             detail="Missing API Key",
         )
 
-    hashed = hash_api_key(api_key)
     # Check if key exists and is active.
     # Since we need to know WHICH user this is associated with to log data against them,
     # the webhook architecture needs to handle user identification.
@@ -75,10 +184,10 @@ def verify_webhook_api_key(api_key: str = Depends(api_key_header), db: Session =
     # It doesn't explicitly say the key maps to a user, but "All tables include user_id".
     # So the key MUST map to a user.
 
-    key_record = db.query(models.APIKey).filter(models.APIKey.hashed_key == hashed, models.APIKey.is_active == True).first()
-    if not key_record:
+    user = authenticate_api_key(db, api_key)
+    if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid API Key",
         )
-    return key_record.user
+    return user
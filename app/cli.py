@@ -1,8 +1,10 @@
 import sys
+import time
 import argparse
 from sqlalchemy.orm import Session
+from datetime import datetime
 from app.database import SessionLocal
-from app import models, auth
+from app import models, auth, services
 
 def get_db():
     db = SessionLocal()
@@ -94,6 +96,8 @@ def revoke_api_key(key_id):
 
         key.is_active = False
         db.commit()
+        # Tell the running server to drop its cached copy of this key
+        auth.notify_api_key_revoked(key.hashed_key)
         print(f"API Key ID {key_id} revoked.")
     finally:
         db.close()
@@ -113,6 +117,63 @@ def make_admin(user_id, revoke=False):
     finally:
         db.close()
 
+def rebuild_daily_logs(user_id=None, start=None, end=None, incremental=False, dry_run=False):
+    db = SessionLocal()
+    try:
+        start_date = datetime.strptime(start, "%Y-%m-%d").date() if start else None
+        end_date = datetime.strptime(end, "%Y-%m-%d").date() if end else None
+
+        report = services.DailyLogRebuildService().rebuild(
+            db, user_id=user_id, start_date=start_date, end_date=end_date,
+            incremental=incremental, dry_run=dry_run
+        )
+        for item in report["discrepancies"]:
+            fields = ", ".join(f"{k}: {v['stored']:.2f} -> {v['actual']:.2f}" for k, v in item["fields"].items())
+            print(f"User {item['user_id']} {item['date']}: {fields}")
+        if report["discrepancy_count"] > len(report["discrepancies"]):
+            print(f"... and {report['discrepancy_count'] - len(report['discrepancies'])} more")
+
+        print(f"Checked {report['days_checked']} days for {report['users']} user(s), "
+              f"found {report['discrepancy_count']} discrepancies.")
+        if dry_run:
+            print("Dry run: no changes were made.")
+        else:
+            print(f"Updated {report['days_updated']} days.")
+    finally:
+        db.close()
+
+def rebuild_adherence(user_id=None):
+    db = SessionLocal()
+    try:
+        query = db.query(models.User)
+        if user_id:
+            query = query.filter(models.User.user_id == user_id)
+        ledger = services.AdherenceLedgerService()
+        for user in query.all():
+            days = ledger.rebuild(db, user)
+            print(f"User {user.user_id}: {days} medication days.")
+    finally:
+        db.close()
+
+def import_off(path, batch_size=5000, restart=False, delimiter="\t"):
+    db = SessionLocal()
+    try:
+        started = time.monotonic()
+
+        def progress(stats):
+            rate = (stats["records"] - stats["resumed_from"]) / max(time.monotonic() - started, 0.001)
+            print(f"  {stats['records']:,} records read, {stats['imported']:,} imported, "
+                  f"{stats['skipped']:,} skipped ({rate:,.0f}/s)", flush=True)
+
+        stats = services.OpenFoodFactsImportService().import_file(
+            db, path, batch_size=batch_size, resume=not restart, delimiter=delimiter, progress=progress
+        )
+        if stats["resumed_from"]:
+            print(f"Resumed after record {stats['resumed_from']:,}.")
+        print(f"Import complete: {stats['imported']:,} products imported, {stats['skipped']:,} records skipped.")
+    finally:
+        db.close()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Health App Admin CLI")
     subparsers = parser.add_subparsers(dest="command")
@@ -144,6 +205,25 @@ if __name__ == "__main__":
     parser_admin.add_argument("--user-id", type=int, required=True)
     parser_admin.add_argument("--revoke", action="store_true", help="Revoke admin access instead of granting")
 
+    # Rebuild Daily Logs
+    parser_rebuild = subparsers.add_parser("rebuild-daily-logs", help="Recompute daily totals from the raw logs")
+    parser_rebuild.add_argument("--user-id", type=int, help="Only rebuild this user (default: everyone)")
+    parser_rebuild.add_argument("--start", type=str, help="First local date to rebuild (YYYY-MM-DD)")
+    parser_rebuild.add_argument("--end", type=str, help="Last local date to rebuild (YYYY-MM-DD)")
+    parser_rebuild.add_argument("--incremental", action="store_true", help="Only rebuild days with logs added since the last run")
+    parser_rebuild.add_argument("--dry-run", action="store_true", help="Report discrepancies without fixing them")
+
+    # Rebuild Dose Adherence Ledger
+    parser_adherence = subparsers.add_parser("rebuild-adherence", help="Recompute the dose adherence ledger from the dose logs")
+    parser_adherence.add_argument("--user-id", type=int, help="Only rebuild this user (default: everyone)")
+
+    # Import Open Food Facts dump
+    parser_off = subparsers.add_parser("import-off", help="Load an Open Food Facts export into the nutrition cache")
+    parser_off.add_argument("path", type=str, help="JSONL or CSV export, optionally gzipped (.jsonl.gz, .csv.gz)")
+    parser_off.add_argument("--batch-size", type=int, default=5000, help="Products written per transaction")
+    parser_off.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an interrupted import")
+    parser_off.add_argument("--delimiter", type=str, default="\t", help="CSV field delimiter (OFF exports use tabs)")
+
     args = parser.parse_args()
 
     if args.command == "create-user":
@@ -156,5 +236,11 @@ if __name__ == "__main__":
         revoke_api_key(args.key_id)
     elif args.command == "make-admin":
         make_admin(args.user_id, args.revoke)
+    elif args.command == "rebuild-daily-logs":
+        rebuild_daily_logs(args.user_id, args.start, args.end, args.incremental, args.dry_run)
+    elif args.command == "rebuild-adherence":
+        rebuild_adherence(args.user_id)
+    elif args.command == "import-off":
+        import_off(args.path, args.batch_size, args.restart, args.delimiter)
     else:
         parser.print_help()
@@ -1,13 +1,57 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import itertools
+import logging
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, Session
 from app.models import Base
 
+logger = logging.getLogger(__name__)
+
 SQLALCHEMY_DATABASE_URL = "sqlite:///./health_app.db"
 
+# SQLite tuning, applied to every new connection
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 16 * 1024))
+SQLITE_FOREIGN_KEYS = os.getenv("SQLITE_FOREIGN_KEYS", "1").lower() in ("1", "true", "yes", "on")
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", 256))
+
+def configure_sqlite_engine(engine):
+    """Registers the connect hook that applies the SQLITE_* pragmas to each pooled connection."""
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            # A negative cache_size is interpreted as KiB rather than pages
+            cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+            cursor.execute(f"PRAGMA foreign_keys={'ON' if SQLITE_FOREIGN_KEYS else 'OFF'}")
+        finally:
+            cursor.close()
+
+    @event.listens_for(engine, "savepoint")
+    def _begin_before_savepoint(conn, name):
+        # pysqlite only opens a transaction before DML, so a SAVEPOINT issued first would
+        # start a transaction of its own and its RELEASE would commit it
+        dbapi_connection = conn.connection.dbapi_connection
+        if not dbapi_connection.in_transaction:
+            dbapi_connection.execute("BEGIN")
+    return engine
+
 # Create engine with shared cache disabled for potential file swaps (though less critical for sqlite compared to pooling)
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+engine = configure_sqlite_engine(create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={
+        "check_same_thread": False,
+        "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+        "cached_statements": SQLITE_STATEMENT_CACHE,
+    }
+))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def init_db():
@@ -20,6 +64,60 @@ def get_db():
     finally:
         db.close()
 
+def checkpoint():
+    """Folds the WAL back into the main database file so it can be copied on its own."""
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
 def dispose_engine():
     """Closes all connections in the pool."""
+    try:
+        checkpoint()
+    except Exception as e:
+        logger.error(f"WAL checkpoint before dispose failed: {e}")
     engine.dispose()
+
+# --- Change Notification ---
+# Any session that commits rows carrying a user_id reports those users to the
+# registered listeners (e.g. the MQTT state publisher), whichever code path wrote them.
+
+CHANGED_USERS_KEY = "changed_user_ids"
+_commit_listeners = []
+
+def add_commit_listener(listener):
+    """Registers `listener(user_ids: set)` to be called after every commit that changed user data."""
+    _commit_listeners.append(listener)
+
+def remove_commit_listener(listener):
+    if listener in _commit_listeners:
+        _commit_listeners.remove(listener)
+
+def mark_user_changed(db: Session, user_id: int):
+    """Flags a user as changed for writes that bypass the ORM unit of work (bulk/Core statements)."""
+    db.info.setdefault(CHANGED_USERS_KEY, set()).add(user_id)
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session, flush_context):
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        user_id = getattr(obj, "user_id", None)
+        if user_id is not None:
+            mark_user_changed(session, user_id)
+
+@event.listens_for(Session, "after_commit")
+def _notify_commit_listeners(session):
+    if session.in_nested_transaction():
+        # A savepoint was released; nothing is visible to others until the outer commit
+        return
+    changed = session.info.pop(CHANGED_USERS_KEY, None)
+    if not changed:
+        return
+    for listener in list(_commit_listeners):
+        try:
+            listener(set(changed))
+        except Exception as e:
+            logger.error(f"Error in commit listener: {e}")
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changed_users(session):
+    if not session.in_nested_transaction():
+        session.info.pop(CHANGED_USERS_KEY, None)
@@ -7,10 +7,10 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from fastapi.openapi.docs import get_swagger_ui_html
-from app import database, models
+from app import database, models, services
 from app.routers import auth, users, medication, health, webhook, prescribers, admin, nutrition, medical
 from app.version import BUILD_VERSION, BUILD_DATE
-from app import mqtt
+from app import mqtt, outbox
 from contextlib import asynccontextmanager
 
 # Create DB tables
@@ -18,9 +18,21 @@ models.Base.metadata.create_all(bind=database.engine)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Load recent/frequent foods for autocomplete
+    db = database.SessionLocal()
+    try:
+        services.recent_foods.rebuild(db)
+        # Backfill the dose adherence ledger the first time it exists
+        services.AdherenceLedgerService().ensure_built(db)
+    finally:
+        db.close()
+
     # Start MQTT Client
     mqtt.mqtt_client.start()
+    # Start applying queued async webhook events
+    outbox.outbox_worker.start()
     yield
+    outbox.outbox_worker.stop()
     # Stop MQTT Client
     mqtt.mqtt_client.stop()
 
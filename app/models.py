@@ -1,8 +1,13 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, DateTime, Boolean, Enum, Time
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, DateTime, Boolean, Enum, Time, Index
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import relationship, declarative_base
 import datetime
 from datetime import timezone
 import enum
+import logging
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -74,8 +79,19 @@ class DailyLog(Base):
     total_calories_consumed = Column(Float, default=0.0)
     total_calories_burned = Column(Float, default=0.0)
 
+    # Macro totals, maintained alongside calories by every food log write
+    total_protein = Column(Float, default=0.0)
+    total_fat = Column(Float, default=0.0)
+    total_carbs = Column(Float, default=0.0)
+    total_fiber = Column(Float, default=0.0)
+    food_item_count = Column(Integer, default=0)
+
     user = relationship("User", back_populates="daily_logs")
 
+    __table_args__ = (
+        Index("ix_daily_logs_user_id_date", "user_id", "date", unique=True),
+    )
+
 class Prescriber(Base):
     __tablename__ = "prescribers"
 
@@ -119,6 +135,10 @@ class Medication(Base):
     prescriber = relationship("Prescriber", back_populates="medications")
     dose_logs = relationship("MedDoseLog", back_populates="medication")
 
+    __table_args__ = (
+        Index("ix_medications_user_id_name", "user_id", "name"),
+    )
+
 class MedDoseLog(Base):
     __tablename__ = "med_dose_logs"
 
@@ -131,6 +151,23 @@ class MedDoseLog(Base):
 
     medication = relationship("Medication", back_populates="dose_logs")
 
+    __table_args__ = (
+        Index("ix_med_dose_logs_user_id_timestamp_taken", "user_id", "timestamp_taken"),
+    )
+
+class DoseAdherence(Base):
+    __tablename__ = "dose_adherence"
+
+    # Ledger derived from med_dose_logs, see services.AdherenceLedgerService
+    med_id = Column(Integer, ForeignKey("medications.med_id"), primary_key=True)
+    local_date = Column(Date, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"))
+    windows_taken = Column(Integer, default=0) # Bit per window: 1 morning, 2 afternoon, 4 evening, 8 bedtime
+
+    __table_args__ = (
+        Index("ix_dose_adherence_user_id_local_date", "user_id", "local_date"),
+    )
+
 class BloodPressure(Base):
     __tablename__ = "blood_pressure"
 
@@ -146,6 +183,10 @@ class BloodPressure(Base):
 
     user = relationship("User", back_populates="blood_pressures")
 
+    __table_args__ = (
+        Index("ix_blood_pressure_user_id_timestamp", "user_id", "timestamp"),
+    )
+
 class NutritionSource(str, enum.Enum):
     OFF = "OFF"
     MANUAL = "MANUAL"
@@ -162,9 +203,42 @@ class NutritionCache(Base):
     carbs = Column(Float, default=0.0)
     fiber = Column(Float, default=0.0)
     source = Column(String) # OFF/MANUAL
+    fetched_at = Column(DateTime, nullable=True) # Last time OFF data was fetched
 
     food_item_logs = relationship("FoodItemLog", back_populates="nutrition_info")
 
+# Full-text index over food names, kept in sync by triggers. It is an external
+# content table, so it stores only the index and reads rows from nutrition_cache.
+NUTRITION_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS nutrition_cache_fts USING fts5(
+        food_name, content='nutrition_cache', content_rowid='food_id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS nutrition_cache_fts_ai AFTER INSERT ON nutrition_cache BEGIN
+        INSERT INTO nutrition_cache_fts(rowid, food_name) VALUES (new.food_id, new.food_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS nutrition_cache_fts_ad AFTER DELETE ON nutrition_cache BEGIN
+        INSERT INTO nutrition_cache_fts(nutrition_cache_fts, rowid, food_name) VALUES ('delete', old.food_id, old.food_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS nutrition_cache_fts_au AFTER UPDATE OF food_name ON nutrition_cache BEGIN
+        INSERT INTO nutrition_cache_fts(nutrition_cache_fts, rowid, food_name) VALUES ('delete', old.food_id, old.food_name);
+        INSERT INTO nutrition_cache_fts(rowid, food_name) VALUES (new.food_id, new.food_name);
+    END""",
+]
+
+@event.listens_for(NutritionCache.__table__, "after_create")
+def _create_nutrition_fts(target, connection, **kw):
+    try:
+        for ddl in NUTRITION_FTS_DDL:
+            connection.exec_driver_sql(ddl)
+    except OperationalError as e:
+        # SQLite built without FTS5; food search falls back to LIKE
+        logger.warning(f"Full-text search unavailable: {e}")
+
+@event.listens_for(NutritionCache.__table__, "before_drop")
+def _drop_nutrition_fts(target, connection, **kw):
+    connection.exec_driver_sql("DROP TABLE IF EXISTS nutrition_cache_fts")
+
 class FoodItemLog(Base):
     __tablename__ = "food_item_logs"
 
@@ -175,10 +249,20 @@ class FoodItemLog(Base):
     serving_size = Column(Float)
     quantity = Column(Float)
     timestamp = Column(DateTime, default=lambda: datetime.datetime.now(timezone.utc))
+    # Nutrition per serving as it was when logged, so later changes to the cached food leave history alone
+    calories = Column(Float, nullable=True)
+    protein = Column(Float, nullable=True)
+    fat = Column(Float, nullable=True)
+    carbs = Column(Float, nullable=True)
+    fiber = Column(Float, nullable=True)
 
     user = relationship("User", back_populates="food_item_logs")
     nutrition_info = relationship("NutritionCache", back_populates="food_item_logs")
 
+    __table_args__ = (
+        Index("ix_food_item_logs_user_id_timestamp", "user_id", "timestamp"),
+    )
+
 class ExerciseLog(Base):
     __tablename__ = "exercise_logs"
 
@@ -191,18 +275,46 @@ class ExerciseLog(Base):
 
     user = relationship("User", back_populates="exercise_logs")
 
+    __table_args__ = (
+        Index("ix_exercise_logs_user_id_timestamp", "user_id", "timestamp"),
+    )
+
 class APIKey(Base):
     __tablename__ = "api_keys"
 
     key_id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.user_id"))
     name = Column(String)
-    hashed_key = Column(String, index=True)
+    hashed_key = Column(String, unique=True, index=True)
     created_at = Column(DateTime, default=lambda: datetime.datetime.now(timezone.utc))
     is_active = Column(Boolean, default=True)
 
     user = relationship("User", back_populates="api_keys")
 
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    # Keys are scoped to the user that sent them
+    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
+    key = Column(String, primary_key=True)
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(timezone.utc), index=True)
+
+class WebhookOutbox(Base):
+    __tablename__ = "webhook_outbox"
+
+    outbox_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), index=True)
+    event = Column(String) # JSON webhook event
+    idempotency_key = Column(String, nullable=True)
+    status = Column(String, default="PENDING") # PENDING/FAILED, rows are deleted once applied
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+    received_at = Column(DateTime, default=lambda: datetime.datetime.now(timezone.utc))
+
+    __table_args__ = (
+        Index("ix_webhook_outbox_status_outbox_id", "status", "outbox_id"),
+    )
+
 class METLookup(Base):
     __tablename__ = "met_lookup"
 
@@ -1,12 +1,14 @@
 import os
 import json
 import logging
+import queue
 import threading
 import time
-from typing import Any, Dict
+from typing import Any, Dict, Iterable, Optional
 import paho.mqtt.client as mqtt
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy import desc, func, select
+from sqlalchemy.exc import IntegrityError
 from app import database, models, schemas, auth, services
 
 # Configure logging
@@ -19,6 +21,190 @@ MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", None)
 MQTT_TOPIC_PREFIX = os.getenv("MQTT_TOPIC_PREFIX", "hahealth/log")
 HASS_DISCOVERY_PREFIX = os.getenv("HASS_DISCOVERY_PREFIX", "homeassistant")
 
+# Ingestion worker pool
+MQTT_WORKERS = int(os.getenv("MQTT_WORKERS", 2))
+MQTT_QUEUE_MAXSIZE = int(os.getenv("MQTT_QUEUE_MAXSIZE", 1000))
+MQTT_QUEUE_OVERFLOW = os.getenv("MQTT_QUEUE_OVERFLOW", "block").lower()
+MQTT_SPILL_FILE = os.getenv("MQTT_SPILL_FILE", "mqtt_spill.jsonl")
+
+# Seconds to coalesce writes before publishing the affected users' state topics
+MQTT_PUBLISH_DEBOUNCE = float(os.getenv("MQTT_PUBLISH_DEBOUNCE", 0.5))
+
+class IngestQueue:
+    """
+    Bounded queue drained by a fixed pool of worker threads.
+
+    When the queue is full the overflow policy decides what happens:
+    - "block": the caller waits for room (backpressure onto the MQTT loop).
+    - "drop_oldest": the oldest queued message is discarded.
+    - "spill": the message is appended to a JSON-lines file on disk and
+      re-queued by idle workers once the burst has passed.
+    """
+    OVERFLOW_POLICIES = ("block", "drop_oldest", "spill")
+
+    def __init__(self, handler, workers: int = MQTT_WORKERS, maxsize: int = MQTT_QUEUE_MAXSIZE,
+                 overflow: str = MQTT_QUEUE_OVERFLOW, spill_file: str = MQTT_SPILL_FILE):
+        if overflow not in self.OVERFLOW_POLICIES:
+            logger.warning(f"Unknown MQTT_QUEUE_OVERFLOW '{overflow}', falling back to 'block'")
+            overflow = "block"
+
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.maxsize = max(1, maxsize)
+        self.overflow = overflow
+        self.spill_file = spill_file
+
+        self._queue = queue.Queue(maxsize=self.maxsize)
+        self._stop_event = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._threads = []
+
+        self._busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop_event.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"mqtt-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 5):
+        self._stop_event.set()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+
+    def put(self, item: Dict[str, Any]):
+        if self.overflow == "drop_oldest":
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self._queue.task_done()
+                        with self._stats_lock:
+                            self.dropped += 1
+                        logger.warning("MQTT ingest queue full, dropped oldest message")
+                    except queue.Empty:
+                        pass
+
+        elif self.overflow == "spill":
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._spill(item)
+
+        else:
+            # Block until there is room, but give up if we are shutting down
+            while not self._stop_event.is_set():
+                try:
+                    self._queue.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+            with self._stats_lock:
+                self.dropped += 1
+
+    def join(self):
+        """Blocks until every queued message has been handled."""
+        self._queue.join()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            busy = self._busy
+            stats = {
+                "depth": self._queue.qsize(),
+                "max_depth": self.maxsize,
+                "overflow_policy": self.overflow,
+                "workers": self.workers,
+                "busy_workers": busy,
+                "utilisation": round(busy / self.workers, 2),
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "spilled": self.spilled,
+            }
+        stats["spill_pending"] = os.path.exists(self.spill_file) if self.overflow == "spill" else False
+        return stats
+
+    def _worker(self):
+        while not self._stop_event.is_set():
+            try:
+                item = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.overflow == "spill":
+                    self._drain_spill()
+                continue
+
+            with self._stats_lock:
+                self._busy += 1
+            try:
+                self.handler(item)
+                with self._stats_lock:
+                    self.processed += 1
+            except Exception as e:
+                logger.error(f"Error in MQTT worker: {e}")
+                with self._stats_lock:
+                    self.failed += 1
+            finally:
+                with self._stats_lock:
+                    self._busy -= 1
+                self._queue.task_done()
+
+    def _spill(self, item: Dict[str, Any]):
+        with self._spill_lock:
+            with open(self.spill_file, "a") as f:
+                f.write(json.dumps(item) + "\n")
+        with self._stats_lock:
+            self.spilled += 1
+
+    def _drain_spill(self):
+        # Only pull spilled messages back in when the in-memory queue is idle
+        if not self._queue.empty() or not os.path.exists(self.spill_file):
+            return
+        with self._spill_lock:
+            try:
+                with open(self.spill_file, "r") as f:
+                    lines = f.readlines()
+            except OSError as e:
+                logger.error(f"Failed to read MQTT spill file: {e}")
+                return
+
+            remaining = []
+            for line in lines:
+                if remaining:
+                    remaining.append(line)
+                    continue
+                try:
+                    self._queue.put_nowait(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.error("Discarding corrupt line in MQTT spill file")
+                except queue.Full:
+                    remaining.append(line)
+
+            # The spill file stays intact until its leftovers are safely in place
+            try:
+                if remaining:
+                    tmp_file = self.spill_file + ".tmp"
+                    with open(tmp_file, "w") as f:
+                        f.writelines(remaining)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_file, self.spill_file)
+                else:
+                    os.remove(self.spill_file)
+            except OSError as e:
+                logger.error(f"Failed to rewrite MQTT spill file: {e}")
+
 class MQTTClient:
     def __init__(self):
         # Use CallbackAPIVersion.VERSION2 for paho-mqtt 2.x compatibility
@@ -33,6 +219,17 @@ class MQTTClient:
         self.connected = False
         self._stop_event = threading.Event()
         self._publisher_thread = None
+        self.ingest_queue = IngestQueue(self.process_message)
+
+        # Last payload published per user, used to skip unchanged state updates
+        self._last_published: Dict[int, str] = {}
+        self._published_lock = threading.Lock()
+
+        # Users changed by committed writes, waiting for the debounced publish
+        self._dirty_users = set()
+        self._dirty_lock = threading.Lock()
+        self._dirty_event = threading.Event()
+        self._state_thread = None
 
     def get_status(self):
         return {
@@ -41,10 +238,14 @@ class MQTTClient:
             "port": MQTT_PORT,
             "username": MQTT_USERNAME or "None",
             "topic_prefix": MQTT_TOPIC_PREFIX,
-            "discovery_prefix": HASS_DISCOVERY_PREFIX
+            "discovery_prefix": HASS_DISCOVERY_PREFIX,
+            "ingest_queue": self.ingest_queue.get_stats()
         }
 
     def start(self):
+        # Workers must be running before the first message can arrive
+        self.ingest_queue.start()
+
         try:
             logger.info(f"Connecting to MQTT Broker at {MQTT_BROKER}:{MQTT_PORT}")
             self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
@@ -55,6 +256,9 @@ class MQTTClient:
             self._publisher_thread = threading.Thread(target=self._publisher_loop, daemon=True)
             self._publisher_thread.start()
 
+            self._state_thread = threading.Thread(target=self._state_loop, daemon=True)
+            self._state_thread.start()
+
         except Exception as e:
             logger.error(f"Failed to connect to MQTT broker: {e}")
 
@@ -62,8 +266,12 @@ class MQTTClient:
         self._stop_event.set()
         if self._publisher_thread:
             self._publisher_thread.join(timeout=5)
+        if self._state_thread:
+            self._state_thread.join(timeout=5)
+            self._state_thread = None
         self.client.loop_stop()
         self.client.disconnect()
+        self.ingest_queue.stop()
 
     def on_connect(self, client, userdata, flags, reason_code, properties=None):
         if reason_code == 0:
@@ -73,6 +281,10 @@ class MQTTClient:
             client.subscribe(topic)
             logger.info(f"Subscribed to {topic}")
 
+            # The broker may have lost retained state, so republish everything
+            with self._published_lock:
+                self._last_published.clear()
+
             # Publish discovery immediately on connect
             self._publish_discovery_task()
         else:
@@ -89,8 +301,8 @@ class MQTTClient:
             payload_str = msg.payload.decode()
             data = json.loads(payload_str)
 
-            # Offload processing to a separate thread to prevent blocking the MQTT loop
-            threading.Thread(target=self.process_message, args=(data,), daemon=True).start()
+            # Hand off to the bounded worker pool so bursts can't spawn unbounded threads
+            self.ingest_queue.put(data)
         except json.JSONDecodeError:
             logger.error("Failed to decode JSON payload")
         except Exception as e:
@@ -123,17 +335,19 @@ class MQTTClient:
         db = database.SessionLocal()
         try:
             # Verify API Key
-            hashed = auth.hash_api_key(api_key)
-            key_record = db.query(models.APIKey).filter(
-                models.APIKey.hashed_key == hashed,
-                models.APIKey.is_active == True
-            ).first()
-
-            if not key_record:
+            user = auth.authenticate_api_key(db, api_key)
+            if not user:
                 logger.warning("Invalid API Key in MQTT message")
                 return
 
-            user = key_record.user
+            # Optional idempotency key, so QoS 1 redeliveries and retries are applied once
+            idempotency_key = data.get("idempotency_key")
+            if idempotency_key:
+                if services.idempotency.is_duplicate(db, user.user_id, idempotency_key):
+                    logger.info(f"Ignoring duplicate MQTT event {idempotency_key}")
+                    return
+                services.idempotency.claim(db, user.user_id, idempotency_key)
+
             service_health = services.HealthLogService()
             service_med = services.MedicationService()
 
@@ -157,8 +371,12 @@ class MQTTClient:
                 logger.info(f"Logged Exercise for user {user.name}")
 
             elif data_type == schemas.WebhookDataType.FOOD_LOG:
-                food_data = schemas.FoodLogPayload(**inner_payload)
-                item, error = service_health.log_food(db, user, food_data)
+                if "items" in inner_payload:
+                    batch = schemas.FoodLogBatchPayload(**inner_payload)
+                    items, error = service_health.log_food_batch(db, user, batch.items, meal_id=batch.meal_id)
+                else:
+                    food_data = schemas.FoodLogPayload(**inner_payload)
+                    item, error = service_health.log_food(db, user, food_data)
                 if error:
                     logger.warning(f"Food log error: {error}")
                 else:
@@ -166,20 +384,15 @@ class MQTTClient:
 
             elif data_type == schemas.WebhookDataType.WEIGHT:
                 weight_data = schemas.WeightPayload(**inner_payload)
-                w_kg = weight_data.weight
-                if weight_data.unit.lower() in ["lbs", "lb", "pound", "pounds"]:
-                    w_kg = w_kg * 0.453592
-
-                user.weight_kg = w_kg
-                db.commit()
+                service_health.log_weight(db, user, weight_data)
                 logger.info(f"Logged Weight for user {user.name}")
 
             else:
                 logger.warning(f"Unknown data_type: {data_type}")
 
-            # Force a state update after logging new data
-            self.publish_periodic_stats(db)
-
+        except IntegrityError:
+            logger.info("Ignoring MQTT event delivered twice concurrently")
+            db.rollback()
         except Exception as e:
             logger.error(f"Error processing DB operation: {e}")
             db.rollback()
@@ -195,10 +408,46 @@ class MQTTClient:
             except Exception as e:
                 logger.error(f"Error in publisher loop: {e}")
 
+            # Writes publish through the commit hook; this periodic pass catches
+            # things no write triggers, such as the day rolling over.
             # Sleep for 60 seconds or until stopped
             if self._stop_event.wait(60):
                 break
 
+    def mark_users_dirty(self, user_ids: Iterable[int]):
+        """Commit listener: queues the given users for a debounced state publish."""
+        if self._state_thread is None:
+            return
+        with self._dirty_lock:
+            self._dirty_users.update(user_ids)
+            self._dirty_event.set()
+
+    def _state_loop(self):
+        while not self._stop_event.is_set():
+            if not self._dirty_event.wait(timeout=1):
+                continue
+
+            # Coalesce a burst of commits into a single publish per user
+            if self._stop_event.wait(MQTT_PUBLISH_DEBOUNCE):
+                break
+            self.flush_dirty_users()
+
+    def flush_dirty_users(self):
+        with self._dirty_lock:
+            user_ids = self._dirty_users
+            self._dirty_users = set()
+            self._dirty_event.clear()
+        if not user_ids:
+            return
+
+        db = database.SessionLocal()
+        try:
+            self.publish_periodic_stats(db, user_ids=user_ids)
+        except Exception as e:
+            logger.error(f"Error publishing state for changed users: {e}")
+        finally:
+            db.close()
+
     def _publish_discovery_task(self):
         threading.Thread(target=self._publish_discovery_worker, daemon=True).start()
 
@@ -248,43 +497,72 @@ class MQTTClient:
 
                 self.client.publish(discovery_topic, json.dumps(payload), retain=True)
 
-    def publish_periodic_stats(self, db: Session):
-        users = db.query(models.User).all()
-        for user in users:
-            try:
-                # 1. Profile Stats
-                weight = user.weight_kg
-                if weight is not None and user.unit_system == "IMPERIAL":
-                    weight = round(weight * 2.20462, 1)
-
-                # 2. Daily Log Stats (Calories)
-                local_date = services.get_user_local_date(user, None)
-                daily = db.query(models.DailyLog).filter(
-                    models.DailyLog.user_id == user.user_id,
-                    models.DailyLog.date == local_date
-                ).first()
-                cals_in = daily.total_calories_consumed if daily else 0
-                cals_out = daily.total_calories_burned if daily else 0
-
-                # 3. Latest BP
-                bp = db.query(models.BloodPressure).filter(
-                    models.BloodPressure.user_id == user.user_id
-                ).order_by(desc(models.BloodPressure.timestamp)).first()
-                systolic = bp.systolic if bp else 0
-                diastolic = bp.diastolic if bp else 0
+    def build_user_states(self, db: Session, user_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict[str, Any]]:
+        """
+        Builds the state payload for every user (or just `user_ids`) using two
+        set-based queries instead of two queries per user.
+        """
+        # 1. Users with their latest BP reading (correlated LIMIT 1 per user, served by the index)
+        latest_bp_id = select(models.BloodPressure.bp_id).where(
+            models.BloodPressure.user_id == models.User.user_id
+        ).order_by(desc(models.BloodPressure.timestamp)).limit(1).correlate(models.User).scalar_subquery()
+
+        query = db.query(
+            models.User, models.BloodPressure.systolic, models.BloodPressure.diastolic
+        ).outerjoin(models.BloodPressure, models.BloodPressure.bp_id == latest_bp_id)
+        if user_ids is not None:
+            query = query.filter(models.User.user_id.in_(list(user_ids)))
+        rows = query.all()
+        if not rows:
+            return {}
+
+        # 2. Today's DailyLog totals, where "today" depends on each user's timezone
+        local_dates = {user.user_id: services.get_user_local_date(user, None) for user, _, _ in rows}
+        daily_rows = db.query(
+            models.DailyLog.user_id,
+            models.DailyLog.date,
+            func.sum(models.DailyLog.total_calories_consumed),
+            func.sum(models.DailyLog.total_calories_burned)
+        ).filter(
+            models.DailyLog.user_id.in_(list(local_dates.keys())),
+            models.DailyLog.date.in_(set(local_dates.values()))
+        ).group_by(models.DailyLog.user_id, models.DailyLog.date).all()
+        daily = {(uid, d): (cals_in, cals_out) for uid, d, cals_in, cals_out in daily_rows}
+
+        states = {}
+        for user, systolic, diastolic in rows:
+            weight = user.weight_kg
+            if weight is not None:
+                if user.unit_system == "IMPERIAL":
+                    weight = weight * 2.20462
+                weight = round(weight, 1)
+
+            cals_in, cals_out = daily.get((user.user_id, local_dates[user.user_id]), (0, 0))
+            states[user.user_id] = {
+                "weight": weight,
+                "calories_in": cals_in or 0,
+                "calories_burned": cals_out or 0,
+                "bp_systolic": systolic or 0,
+                "bp_diastolic": diastolic or 0
+            }
+        return states
 
-                payload = {
-                    "weight": round(weight, 1),
-                    "calories_in": cals_in,
-                    "calories_burned": cals_out,
-                    "bp_systolic": systolic,
-                    "bp_diastolic": diastolic
-                }
+    def publish_periodic_stats(self, db: Session, user_ids: Optional[Iterable[int]] = None, force: bool = False):
+        """Publishes state topics, skipping users whose payload is unchanged since the last publish."""
+        states = self.build_user_states(db, user_ids)
+        for user_id, payload in states.items():
+            try:
+                message = json.dumps(payload, sort_keys=True)
+                with self._published_lock:
+                    if not force and self._last_published.get(user_id) == message:
+                        continue
+                    self._last_published[user_id] = message
 
-                topic = f"hahealth/{user.user_id}/state"
-                self.client.publish(topic, json.dumps(payload), retain=True)
+                topic = f"hahealth/{user_id}/state"
+                self.client.publish(topic, message, retain=True)
 
             except Exception as e:
-                logger.error(f"Error publishing stats for user {user.name}: {e}")
+                logger.error(f"Error publishing stats for user {user_id}: {e}")
 
 mqtt_client = MQTTClient()
+database.add_commit_listener(mqtt_client.mark_users_dirty)
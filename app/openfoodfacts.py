@@ -0,0 +1,231 @@
+import os
+import random
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+OFF_BASE_URL = os.getenv("OFF_BASE_URL", "https://world.openfoodfacts.org")
+OFF_CONNECT_TIMEOUT = float(os.getenv("OFF_CONNECT_TIMEOUT", 3.05))
+OFF_READ_TIMEOUT = float(os.getenv("OFF_READ_TIMEOUT", 10))
+OFF_MAX_RETRIES = int(os.getenv("OFF_MAX_RETRIES", 2))
+OFF_BACKOFF_BASE = float(os.getenv("OFF_BACKOFF_BASE", 0.5))
+OFF_CIRCUIT_FAILURES = int(os.getenv("OFF_CIRCUIT_FAILURES", 5))
+OFF_CIRCUIT_RESET = float(os.getenv("OFF_CIRCUIT_RESET", 60))
+OFF_POOL_SIZE = int(os.getenv("OFF_POOL_SIZE", 10))
+OFF_NEGATIVE_TTL = int(os.getenv("OFF_NEGATIVE_TTL", 86400))
+OFF_NEGATIVE_CACHE_SIZE = int(os.getenv("OFF_NEGATIVE_CACHE_SIZE", 10000))
+OFF_REFRESH_AFTER_DAYS = float(os.getenv("OFF_REFRESH_AFTER_DAYS", 30))
+OFF_REFRESH_WORKERS = int(os.getenv("OFF_REFRESH_WORKERS", 2))
+OFF_LOOKUP_WORKERS = int(os.getenv("OFF_LOOKUP_WORKERS", 4))
+
+USER_AGENT = "HAHealth/1.0 (https://github.com/sprillex/hahealth)"
+
+class OpenFoodFactsUnavailable(Exception):
+    """Raised when Open Food Facts could not be reached (or the circuit is open)."""
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls until
+    `reset_timeout` seconds have passed. Then a single trial call is let through
+    (half-open): success closes the circuit, failure opens it again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = OFF_CIRCUIT_FAILURES, reset_timeout: float = OFF_CIRCUIT_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    logger.warning("Open Food Facts circuit opened")
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+class OpenFoodFactsClient:
+    """
+    Shared keep-alive HTTP client for the Open Food Facts product API, with
+    connect/read timeouts, bounded retries with jittered backoff and a circuit breaker.
+    """
+    PRODUCT_PATH = "/api/v0/product/{barcode}.json"
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str = OFF_BASE_URL, connect_timeout: float = OFF_CONNECT_TIMEOUT,
+                 read_timeout: float = OFF_READ_TIMEOUT, max_retries: int = OFF_MAX_RETRIES,
+                 backoff_base: float = OFF_BACKOFF_BASE, breaker: Optional[CircuitBreaker] = None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=OFF_POOL_SIZE, pool_maxsize=OFF_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def fetch_product(self, barcode: str) -> Optional[dict]:
+        """
+        Returns the OFF product dict, or None if OFF does not know the barcode.
+        Raises OpenFoodFactsUnavailable if OFF is down, slow or the circuit is open.
+        """
+        if not self.breaker.allow():
+            raise OpenFoodFactsUnavailable("Circuit open")
+
+        settled = False
+        try:
+            product = self._fetch(barcode)
+            settled = True
+            return product
+        finally:
+            if not settled:
+                # Unexpected errors count as failures too, so a half-open trial is always released
+                self.breaker.record_failure()
+
+    def _fetch(self, barcode: str) -> Optional[dict]:
+        url = self.base_url + self.PRODUCT_PATH.format(barcode=barcode)
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # Full jitter: sleep somewhere in [0, base * 2^attempt)
+                time.sleep(random.uniform(0, self.backoff_base * (2 ** attempt)))
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                last_error = e
+                continue
+
+            if response.status_code in self.RETRY_STATUSES:
+                last_error = f"HTTP {response.status_code}"
+                continue
+
+            # Any definitive answer (including 404) means OFF is healthy
+            self.breaker.record_success()
+            if response.status_code != 200:
+                return None
+            try:
+                data = response.json()
+            except ValueError:
+                return None
+            product = data.get("product") if isinstance(data, dict) else None
+            return product if isinstance(product, dict) else None
+
+        logger.warning(f"Open Food Facts lookup for {barcode} failed: {last_error}")
+        raise OpenFoodFactsUnavailable(str(last_error))
+
+class MissCache:
+    """LRU set with TTL of barcodes OFF recently reported as unknown."""
+
+    def __init__(self, ttl: int = OFF_NEGATIVE_TTL, max_size: int = OFF_NEGATIVE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # barcode -> expires_at
+        self._lock = threading.Lock()
+
+    def __contains__(self, barcode: str) -> bool:
+        with self._lock:
+            expires_at = self._entries.get(barcode)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._entries[barcode]
+                return False
+            return True
+
+    def add(self, barcode: str):
+        with self._lock:
+            self._entries[barcode] = time.monotonic() + self.ttl
+            self._entries.move_to_end(barcode)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, barcode: str):
+        with self._lock:
+            self._entries.pop(barcode, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one execution whose result (or error) every caller shares."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+off_client = OpenFoodFactsClient()
+off_misses = MissCache()
@@ -0,0 +1,159 @@
+import os
+import json
+import logging
+import threading
+from typing import Any, Dict
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+from app import database, models, services
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 1))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 200))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+
+def enqueue(db: Session, user_id: int, event: Dict[str, Any]) -> models.WebhookOutbox:
+    """Appends an already validated webhook event to the outbox and commits."""
+    row = models.WebhookOutbox(
+        user_id=user_id, event=json.dumps(event), idempotency_key=event.get("idempotency_key")
+    )
+    db.add(row)
+    db.commit()
+    outbox_worker.notify()
+    return row
+
+def is_queued(db: Session, user_id: int, idempotency_key: str) -> bool:
+    return db.query(models.WebhookOutbox.outbox_id).filter(
+        models.WebhookOutbox.user_id == user_id,
+        models.WebhookOutbox.idempotency_key == idempotency_key,
+        models.WebhookOutbox.status == "PENDING"
+    ).first() is not None
+
+class OutboxWorker:
+    """
+    Background threads that apply queued webhook events in batches. Each batch of a
+    user's events is applied, and its outbox rows removed, in one transaction, so an
+    event is applied exactly once even across crashes. Users are split between the
+    workers by user_id, which keeps each user's events in arrival order.
+    """
+
+    def __init__(self, session_factory=None, workers: int = OUTBOX_WORKERS, batch_size: int = OUTBOX_BATCH_SIZE,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.session_factory = session_factory or database.SessionLocal
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self.applied = 0
+        self.failed = 0
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop_event.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, args=(i,), name=f"outbox-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 5):
+        self._stop_event.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+
+    def notify(self):
+        self._wake.set()
+
+    def _worker(self, index: int):
+        while not self._stop_event.is_set():
+            self._wake.clear()
+            try:
+                drained = self.drain_once(index)
+            except Exception as e:
+                logger.error(f"Outbox worker error: {e}")
+                drained = 0
+            if drained < self.batch_size:
+                # Caught up: sleep until new events arrive (or poll in case another process queued some)
+                self._wake.wait(self.poll_interval)
+
+    def drain_once(self, index: int = 0) -> int:
+        """Applies up to batch_size pending events for this worker's users. Returns how many were taken."""
+        db = self.session_factory()
+        try:
+            query = db.query(models.WebhookOutbox).filter(models.WebhookOutbox.status == "PENDING")
+            if self.workers > 1:
+                query = query.filter(models.WebhookOutbox.user_id % self.workers == index)
+            rows = query.order_by(models.WebhookOutbox.outbox_id).limit(self.batch_size).all()
+
+            by_user = {}
+            for row in rows:
+                by_user.setdefault(row.user_id, []).append(row)
+            for user_id, user_rows in by_user.items():
+                self._apply_user_batch(db, user_id, user_rows)
+            return len(rows)
+        finally:
+            db.close()
+
+    def _apply_user_batch(self, db: Session, user_id: int, rows):
+        ids = [row.outbox_id for row in rows]
+        try:
+            user = db.get(models.User, user_id)
+            if user is None:
+                results = [{"status": "error", "detail": "User not found"}] * len(rows)
+            else:
+                events = [json.loads(row.event) for row in rows]
+                # Events are dated when they arrived, not when the worker got to them; one that
+                # raises fails on its own instead of taking the rest of the batch with it
+                results = services.WebhookBatchService().process(
+                    db, user, events, commit=False, received_at=[row.received_at for row in rows], isolate=True
+                )
+
+            failed = 0
+            for row, result in zip(rows, results):
+                if result["status"] == "error":
+                    # Permanent failure (invalid or unresolvable event): keep it for inspection
+                    row.status = "FAILED"
+                    row.attempts = (row.attempts or 0) + 1
+                    row.last_error = result.get("detail")
+                    failed += 1
+                else:
+                    db.delete(row)
+            db.commit()
+            with self._stats_lock:
+                self.applied += len(rows) - failed
+                self.failed += failed
+        except Exception as e:
+            # Transient failure (e.g. database busy): leave the events queued and count the attempt
+            db.rollback()
+            logger.warning(f"Applying outbox events for user {user_id} failed: {e}")
+            status = case((models.WebhookOutbox.attempts + 1 >= self.max_attempts, "FAILED"), else_="PENDING")
+            db.query(models.WebhookOutbox).filter(models.WebhookOutbox.outbox_id.in_(ids)).update({
+                models.WebhookOutbox.attempts: models.WebhookOutbox.attempts + 1,
+                models.WebhookOutbox.status: status,
+                models.WebhookOutbox.last_error: str(e)[:500],
+            }, synchronize_session=False)
+            db.commit()
+
+    def get_stats(self, db: Session) -> Dict[str, Any]:
+        counts = dict(db.query(models.WebhookOutbox.status, func.count()).group_by(models.WebhookOutbox.status).all())
+        oldest = db.query(func.min(models.WebhookOutbox.received_at)).filter(models.WebhookOutbox.status == "PENDING").scalar()
+        with self._stats_lock:
+            return {
+                "workers": len(self._threads),
+                "pending": counts.get("PENDING", 0),
+                "failed": counts.get("FAILED", 0),
+                "oldest_pending": oldest,
+                "applied_since_start": self.applied,
+                "failed_since_start": self.failed,
+            }
+
+outbox_worker = OutboxWorker()
@@ -0,0 +1,79 @@
+import json
+import base64
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Optional
+from sqlalchemy import or_
+from app import models, services
+
+# History endpoints return a plain list; the cursor for the next (older) page, if
+# there is one, is sent in this header and passed back as ?cursor=.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(*key) -> str:
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> list:
+    """Raises ValueError for cursors that were not produced by encode_cursor."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+def local_date_bounds(user: models.User, start_date: Optional[date], end_date: Optional[date]):
+    """Naive UTC bounds [start, end) covering the given local dates (either may be open)."""
+    user_tz = services.get_user_tz(user)
+
+    def to_utc(d: date) -> datetime:
+        return datetime.combine(d, time.min).replace(tzinfo=user_tz).astimezone(timezone.utc).replace(tzinfo=None)
+
+    start = to_utc(start_date) if start_date else None
+    end = to_utc(end_date + timedelta(days=1)) if end_date else None
+    return start, end
+
+def timestamp_page(query, ts_col, id_col, user: models.User, limit: int, cursor: Optional[str] = None,
+                   start_date: Optional[date] = None, end_date: Optional[date] = None):
+    """
+    Newest-first keyset page over (timestamp, id). Every page is an index range scan
+    starting right after the cursor row, so deep pages cost the same as the first.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    start, end = local_date_bounds(user, start_date, end_date)
+    if start:
+        query = query.filter(ts_col >= start)
+    if end:
+        query = query.filter(ts_col < end)
+    if cursor:
+        ts_value, id_value = decode_cursor(cursor, 2)
+        try:
+            ts_value = datetime.fromisoformat(ts_value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+        if not isinstance(id_value, int):
+            raise ValueError("Invalid cursor")
+        # (ts, id) < cursor, spelled so SQLite seeks the (user_id, timestamp) index to the cursor
+        query = query.filter(ts_col <= ts_value, or_(ts_col < ts_value, id_col < id_value))
+
+    rows = query.order_by(ts_col.desc(), id_col.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, ts_col.key), getattr(last, id_col.key))
+
+def id_page(query, id_col, limit: int, cursor: Optional[str] = None):
+    """Keyset page in id order for lists without timestamps. Returns (rows, next_cursor)."""
+    if cursor:
+        (id_value,) = decode_cursor(cursor, 1)
+        if not isinstance(id_value, int):
+            raise ValueError("Invalid cursor")
+        query = query.filter(id_col > id_value)
+    rows = query.order_by(id_col).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(getattr(rows[-1], id_col.key))
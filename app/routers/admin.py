@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
 from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session
-from app import database, models, auth, services, mqtt
+from app import database, models, schemas, auth, services, mqtt, outbox
 import os
 
 router = APIRouter(
@@ -18,6 +18,37 @@ def get_current_admin(current_user: models.User = Depends(auth.get_current_user)
 def get_mqtt_status(admin: models.User = Depends(get_current_admin)):
     return mqtt.mqtt_client.get_status()
 
+@router.get("/outbox_status")
+def get_outbox_status(db: Session = Depends(database.get_db), admin: models.User = Depends(get_current_admin)):
+    return outbox.outbox_worker.get_stats(db)
+
+@router.delete("/apikeys/{key_id}")
+def revoke_api_key(
+    key_id: int,
+    db: Session = Depends(database.get_db),
+    admin: models.User = Depends(get_current_admin)
+):
+    key = db.query(models.APIKey).filter(models.APIKey.key_id == key_id).first()
+    if not key:
+        raise HTTPException(status_code=404, detail="API Key not found")
+
+    key.is_active = False
+    db.commit()
+    auth.notify_api_key_revoked(key.hashed_key)
+    return {"message": f"API Key {key_id} revoked"}
+
+@router.post("/daily_logs/rebuild")
+def rebuild_daily_logs(
+    request: schemas.DailyLogRebuildRequest,
+    db: Session = Depends(database.get_db),
+    admin: models.User = Depends(get_current_admin)
+):
+    service = services.DailyLogRebuildService()
+    return service.rebuild(
+        db, user_id=request.user_id, start_date=request.start_date, end_date=request.end_date,
+        incremental=request.incremental, dry_run=request.dry_run
+    )
+
 @router.post("/key")
 def set_backup_key(
     key_data: dict,
@@ -1,8 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import date, datetime, timedelta
-from app import database, models, schemas, auth, services
+from app import database, models, schemas, auth, services, pagination
 
 router = APIRouter(
     prefix="/api/v1/log",
@@ -40,15 +41,29 @@ def log_exercise(
     # The DailyLog has total_calories_burned updated.
     return {"message": "Exercise logged", "calories_burned": exercise.calories_burned or 0} # Approximate or need to fetch details
 
+def paginate_history(response: Response, query, ts_col, id_col, user: models.User, limit: int,
+                     cursor: Optional[str], start_date: Optional[date], end_date: Optional[date]):
+    try:
+        rows, next_cursor = pagination.timestamp_page(query, ts_col, id_col, user, limit, cursor, start_date, end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+    return rows
+
 @router.get("/history/bp")
 def get_bp_history(
-    limit: int = 50,
+    response: Response,
+    limit: int = Query(50, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    history = db.query(models.BloodPressure).filter(
-        models.BloodPressure.user_id == current_user.user_id
-    ).order_by(models.BloodPressure.timestamp.desc()).limit(limit).all()
+    query = db.query(models.BloodPressure).filter(models.BloodPressure.user_id == current_user.user_id)
+    history = paginate_history(response, query, models.BloodPressure.timestamp, models.BloodPressure.bp_id,
+                               current_user, limit, cursor, start_date, end_date)
 
     # Attach timezone info (SQLite stores as naive UTC)
     for bp in history:
@@ -59,13 +74,17 @@ def get_bp_history(
 
 @router.get("/history/exercise")
 def get_exercise_history(
-    limit: int = 50,
+    response: Response,
+    limit: int = Query(50, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    history = db.query(models.ExerciseLog).filter(
-        models.ExerciseLog.user_id == current_user.user_id
-    ).order_by(models.ExerciseLog.timestamp.desc()).limit(limit).all()
+    query = db.query(models.ExerciseLog).filter(models.ExerciseLog.user_id == current_user.user_id)
+    history = paginate_history(response, query, models.ExerciseLog.timestamp, models.ExerciseLog.exercise_id,
+                               current_user, limit, cursor, start_date, end_date)
 
     # Attach timezone info (SQLite stores as naive UTC)
     for ex in history:
@@ -74,6 +93,98 @@ def get_exercise_history(
 
     return history
 
+@router.get("/history/food")
+def get_food_history(
+    response: Response,
+    limit: int = Query(50, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    query = db.query(
+        models.FoodItemLog.item_log_id,
+        models.FoodItemLog.meal_id,
+        models.FoodItemLog.serving_size,
+        models.FoodItemLog.quantity,
+        models.FoodItemLog.timestamp,
+        models.NutritionCache.food_name,
+        func.coalesce(models.FoodItemLog.calories, models.NutritionCache.calories).label("calories")
+    ).join(models.NutritionCache).filter(models.FoodItemLog.user_id == current_user.user_id)
+    logs = paginate_history(response, query, models.FoodItemLog.timestamp, models.FoodItemLog.item_log_id,
+                            current_user, limit, cursor, start_date, end_date)
+
+    history = []
+    for log in logs:
+        ts = log.timestamp
+        if ts and ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        history.append({
+            "log_id": log.item_log_id,
+            "name": log.food_name,
+            "calories": (log.calories or 0) * log.serving_size * log.quantity,
+            "meal": log.meal_id,
+            "serving_size": log.serving_size,
+            "quantity": log.quantity,
+            "timestamp": ts
+        })
+    return history
+
+@router.get("/history/dose")
+def get_dose_history(
+    response: Response,
+    limit: int = Query(50, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    query = db.query(
+        models.MedDoseLog.dose_log_id,
+        models.MedDoseLog.med_id,
+        models.MedDoseLog.timestamp_taken,
+        models.MedDoseLog.dose_window,
+        models.Medication.name
+    ).join(
+        models.Medication, models.MedDoseLog.med_id == models.Medication.med_id
+    ).filter(models.MedDoseLog.user_id == current_user.user_id)
+    logs = paginate_history(response, query, models.MedDoseLog.timestamp_taken, models.MedDoseLog.dose_log_id,
+                            current_user, limit, cursor, start_date, end_date)
+
+    history = []
+    for log in logs:
+        ts = log.timestamp_taken
+        if ts and ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        history.append({
+            "log_id": log.dose_log_id,
+            "med_id": log.med_id,
+            "med_name": log.name,
+            "timestamp": ts,
+            "dose_window": log.dose_window
+        })
+    return history
+
+@router.get("/charts/bp")
+def get_bp_chart(
+    days: int = Query(365, ge=1, le=services.BP_CHART_MAX_DAYS),
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    points: int = Query(services.BP_CHART_POINTS, ge=3, le=services.BP_CHART_MAX_POINTS),
+    method: str = "bucket",
+    resolution: str = "auto",
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    service = services.BPChartService()
+    try:
+        start_date, end_date = service.resolve_range(current_user, days, start_date, end_date)
+        return service.series(db, current_user, start_date, end_date, points, method, resolution)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/summary")
 def get_daily_summary(
     date_str: Optional[str] = None,
@@ -127,29 +238,39 @@ def get_daily_summary(
 
     bp_str = f"{bp.systolic}/{bp.diastolic}" if bp else "Not Logged"
 
-    # 3. Macro Calculation (Protein/Fat/Carbs/Fiber)
-    food_logs = db.query(models.FoodItemLog).join(models.NutritionCache).filter(
+    # 3. Macros (Protein/Fat/Carbs/Fiber) are maintained on the DailyLog row
+    macros = {
+        "protein": (daily.total_protein or 0) if daily else 0,
+        "fat": (daily.total_fat or 0) if daily else 0,
+        "carbs": (daily.total_carbs or 0) if daily else 0,
+        "fiber": (daily.total_fiber or 0) if daily else 0
+    }
+
+    # Itemised food list (columns only, no per-row nutrition_info lazy loads)
+    food_logs = db.query(
+        models.FoodItemLog.item_log_id,
+        models.FoodItemLog.meal_id,
+        models.FoodItemLog.serving_size,
+        models.FoodItemLog.quantity,
+        models.FoodItemLog.timestamp,
+        models.NutritionCache.food_name,
+        func.coalesce(models.FoodItemLog.calories, models.NutritionCache.calories).label("calories")
+    ).join(models.NutritionCache).filter(
         models.FoodItemLog.user_id == current_user.user_id,
         models.FoodItemLog.timestamp >= utc_start,
         models.FoodItemLog.timestamp <= utc_end
     ).all()
 
-    macros = {"protein": 0, "fat": 0, "carbs": 0, "fiber": 0}
     food_list = []
     for log in food_logs:
         multiplier = log.serving_size * log.quantity
-        macros["protein"] += (log.nutrition_info.protein or 0) * multiplier
-        macros["fat"] += (log.nutrition_info.fat or 0) * multiplier
-        macros["carbs"] += (log.nutrition_info.carbs or 0) * multiplier
-        macros["fiber"] += (log.nutrition_info.fiber or 0) * multiplier
-
         ts = log.timestamp
         if ts and ts.tzinfo is None:
             ts = ts.replace(tzinfo=timezone.utc)
         food_list.append({
             "log_id": log.item_log_id,
-            "name": log.nutrition_info.food_name,
-            "calories": (log.nutrition_info.calories or 0) * multiplier,
+            "name": log.food_name,
+            "calories": (log.calories or 0) * multiplier,
             "meal": log.meal_id,
             "serving_size": log.serving_size,
             "quantity": log.quantity,
@@ -187,13 +308,34 @@ def get_daily_summary(
 
 @router.get("/reports/compliance")
 def get_compliance(
+    days: int = Query(30, ge=1, le=services.COMPLIANCE_MAX_DAYS),
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
     service = services.HealthLogService()
-    report = service.calculate_compliance_report(db, current_user)
+    try:
+        report = service.calculate_compliance_report(db, current_user, days, start_date, end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return report
 
+@router.get("/reports/adherence_calendar")
+def get_adherence_calendar(
+    days: int = Query(365, ge=1, le=services.COMPLIANCE_MAX_DAYS),
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    service = services.ComplianceService()
+    try:
+        start_date, end_date = service.resolve_range(current_user, days, start_date, end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return service.calendar(db, current_user, start_date, end_date)
+
 @router.get("/reports/adherence")
 def get_adherence(
     db: Session = Depends(database.get_db),
@@ -268,7 +410,7 @@ def update_food(
          raise HTTPException(status_code=404, detail="Log not found")
 
     # Calculate calories for response
-    cals = log.nutrition_info.calories * log.serving_size * log.quantity
+    cals = (services.logged_nutrition(log).calories or 0) * log.serving_size * log.quantity
 
     ts = log.timestamp
     if ts and ts.tzinfo is None:
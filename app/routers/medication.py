@@ -1,8 +1,8 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime, date
-from app import database, models, schemas, auth, services
+from app import database, models, schemas, auth, services, pagination
 
 router = APIRouter(
     prefix="/api/v1/medications",
@@ -23,12 +23,23 @@ def create_medication(
 
 @router.get("/", response_model=List[schemas.MedicationResponse])
 def read_medications(
+    response: Response,
     skip: int = 0,
-    limit: int = 100,
+    limit: int = Query(100, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    meds = db.query(models.Medication).filter(models.Medication.user_id == current_user.user_id).offset(skip).limit(limit).all()
+    query = db.query(models.Medication).filter(models.Medication.user_id == current_user.user_id)
+    if not cursor and skip:
+        # Legacy offset paging
+        return query.order_by(models.Medication.med_id).offset(skip).limit(limit).all()
+    try:
+        meds, next_cursor = pagination.id_page(query, models.Medication.med_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
     return meds
 
 @router.put("/{med_id}", response_model=schemas.MedicationResponse)
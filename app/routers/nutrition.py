@@ -45,20 +45,28 @@ def search_food(
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    # Simple search
-    results = db.query(models.NutritionCache).filter(
-        models.NutritionCache.food_name.ilike(f"%{query}%")
-    ).limit(20).all()
-    return results
+    service = services.FoodSearchService()
+    return service.search(db, query, user_id=current_user.user_id)
 
-@router.post("/log", response_model=schemas.FoodLogPayload) # Return type might need adjustment
+@router.get("/recent", response_model=List[schemas.NutritionCacheResponse])
+def recent_foods(
+    limit: int = 20,
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return services.recent_foods.load(db, current_user.user_id, limit=min(limit, 100))
+
+@router.post("/log", response_model=schemas.FoodLogEntry)
 def log_food_entry(
-    entry: schemas.FoodLogPayload,
+    entry: schemas.FoodLogEntry,
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
     service = services.HealthLogService()
-    item, error = service.log_food(db, current_user, entry)
+    if isinstance(entry, schemas.FoodLogBatchPayload):
+        items, error = service.log_food_batch(db, current_user, entry.items, meal_id=entry.meal_id)
+    else:
+        item, error = service.log_food(db, current_user, entry)
     if error:
         raise HTTPException(status_code=404, detail=error)
 
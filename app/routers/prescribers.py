@@ -1,7 +1,7 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from sqlalchemy.orm import Session
-from typing import List
-from app import database, models, schemas, auth
+from typing import List, Optional
+from app import database, models, schemas, auth, pagination
 
 router = APIRouter(
     prefix="/api/v1/prescribers",
@@ -22,10 +22,21 @@ def create_prescriber(
 
 @router.get("/", response_model=List[schemas.PrescriberResponse])
 def read_prescribers(
+    response: Response,
     skip: int = 0,
-    limit: int = 100,
+    limit: int = Query(100, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    prescribers = db.query(models.Prescriber).filter(models.Prescriber.user_id == current_user.user_id).offset(skip).limit(limit).all()
+    query = db.query(models.Prescriber).filter(models.Prescriber.user_id == current_user.user_id)
+    if not cursor and skip:
+        # Legacy offset paging
+        return query.order_by(models.Prescriber.prescriber_id).offset(skip).limit(limit).all()
+    try:
+        prescribers, next_cursor = pagination.id_page(query, models.Prescriber.prescriber_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
     return prescribers
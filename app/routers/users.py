@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from typing import List
-from app import database, models, schemas, auth
+from app import database, models, schemas, auth, services
 
 router = APIRouter(
     prefix="/api/v1/users",
@@ -36,6 +36,9 @@ def update_user_profile(
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
+    # Dose attribution depends on the timezone and the window start times
+    attribution = (current_user.timezone, services.get_user_windows(current_user))
+
     if user_update.weight_kg is not None:
         current_user.weight_kg = user_update.weight_kg
     if user_update.height_cm is not None:
@@ -69,6 +72,8 @@ def update_user_profile(
     if user_update.window_bedtime_start is not None:
         current_user.window_bedtime_start = user_update.window_bedtime_start
 
+    if (current_user.timezone, services.get_user_windows(current_user)) != attribution:
+        services.AdherenceLedgerService().rebuild(db, current_user, commit=False)
     db.commit()
     db.refresh(current_user)
     return current_user
@@ -1,18 +1,48 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Header, status
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from app import database, models, schemas, auth, services
+from typing import List, Optional
+from pydantic import ValidationError
+from app import database, models, schemas, auth, services, outbox
 
 router = APIRouter(
     prefix="/api/webhook",
     tags=["webhook"]
 )
 
+DUPLICATE_RESPONSE = {"status": "success", "message": "Duplicate event ignored", "duplicate": True}
+
 @router.post("/health")
 def webhook_ingestion(
     payload: schemas.WebhookPayload,
     db: Session = Depends(database.get_db),
-    user: models.User = Depends(auth.verify_webhook_api_key)
+    user: models.User = Depends(auth.verify_webhook_api_key),
+    idempotency_key: Optional[str] = Header(None, max_length=200)
 ):
+    if not idempotency_key:
+        return ingest_event(payload, db, user)
+
+    # A retried delivery is acknowledged without being applied again
+    if services.idempotency.is_duplicate(db, user.user_id, idempotency_key):
+        return DUPLICATE_RESPONSE
+    services.idempotency.claim(db, user.user_id, idempotency_key)
+    try:
+        result = ingest_event(payload, db, user)
+    except IntegrityError:
+        # The same key committed concurrently
+        db.rollback()
+        if services.idempotency.is_duplicate(db, user.user_id, idempotency_key):
+            return DUPLICATE_RESPONSE
+        raise
+    services.idempotency.remember(user.user_id, idempotency_key)
+    return result
+
+def ingest_event(payload: schemas.WebhookPayload, db: Session, user: models.User):
+    try:
+        services.WebhookBatchService().parse(payload.model_dump())
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+
     service_health = services.HealthLogService()
     service_med = services.MedicationService()
 
@@ -37,24 +67,84 @@ def webhook_ingestion(
         return {"status": "success", "message": "Exercise logged"}
 
     elif payload.data_type == schemas.WebhookDataType.FOOD_LOG:
-        data = schemas.FoodLogPayload(**payload.payload)
-        item, error = service_health.log_food(db, user, data)
+        if "items" in payload.payload:
+            batch = schemas.FoodLogBatchPayload(**payload.payload)
+            items, error = service_health.log_food_batch(db, user, batch.items, meal_id=batch.meal_id)
+        else:
+            data = schemas.FoodLogPayload(**payload.payload)
+            item, error = service_health.log_food(db, user, data)
         if error:
              raise HTTPException(status_code=400, detail=error)
         return {"status": "success", "message": "Food logged"}
 
     elif payload.data_type == schemas.WebhookDataType.WEIGHT:
         data = schemas.WeightPayload(**payload.payload)
-        w_kg = data.weight
-        if data.unit.lower() in ["lbs", "lb", "pound", "pounds"]:
-            w_kg = w_kg * 0.453592
-        user.weight_kg = w_kg
-        db.commit()
+        service_health.log_weight(db, user, data)
         return {"status": "success", "message": "Weight logged"}
 
     else:
         raise HTTPException(status_code=400, detail="Invalid Data Type")
 
+@router.post("/health/async", status_code=status.HTTP_202_ACCEPTED)
+def webhook_async_ingestion(
+    event: dict,
+    db: Session = Depends(database.get_db),
+    user: models.User = Depends(auth.verify_webhook_api_key),
+    idempotency_key: Optional[str] = Header(None, max_length=200)
+):
+    # Validate now, apply later: the event is queued in the outbox and applied by a background worker
+    try:
+        services.WebhookBatchService().parse(event)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+
+    if idempotency_key:
+        event["idempotency_key"] = idempotency_key
+    key = event.get("idempotency_key")
+    if key and (services.idempotency.is_duplicate(db, user.user_id, key) or outbox.is_queued(db, user.user_id, key)):
+        return {"status": "accepted", "duplicate": True}
+
+    row = outbox.enqueue(db, user.user_id, event)
+    return {"status": "accepted", "outbox_id": row.outbox_id}
+
+@router.post("/health/batch")
+def webhook_batch_ingestion(
+    batch: schemas.WebhookBatchPayload,
+    db: Session = Depends(database.get_db),
+    user: models.User = Depends(auth.verify_webhook_api_key)
+):
+    try:
+        # An event that raises is reported in its result; the rest of the batch still applies
+        results = services.WebhookBatchService().process(db, user, batch.events, isolate=True)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Some events were delivered concurrently, retry the batch")
+    failed = sum(1 for result in results if result["status"] == "error")
+    duplicates = sum(1 for result in results if result["status"] == "duplicate")
+    return {
+        "status": "success" if not failed else "partial",
+        "applied": len(results) - failed - duplicates,
+        "duplicates": duplicates,
+        "failed": failed,
+        "results": results
+    }
+
+@router.post("/nutrition/lookup", response_model=List[schemas.FoodLookupResult])
+def lookup_nutrition_batch(
+    request: schemas.FoodLookupRequest,
+    db: Session = Depends(database.get_db),
+    user: models.User = Depends(auth.verify_webhook_api_key)
+):
+    foods = services.FoodLookupService().lookup(db, request.items)
+    # Keep newly fetched products
+    db.commit()
+    return [
+        schemas.FoodLookupResult(
+            barcode=item.barcode, food_name=item.food_name, found=food is not None,
+            food=schemas.NutritionCacheResponse.model_validate(food) if food else None
+        )
+        for item, food in zip(request.items, foods)
+    ]
+
 @router.get("/nutrition/{barcode}", response_model=schemas.NutritionCacheResponse)
 def get_nutrition_info(
     barcode: str,
@@ -65,5 +155,7 @@ def get_nutrition_info(
     product = off_service.get_product(barcode, db)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
+    # Keep a newly fetched product
+    db.commit()
 
     return product
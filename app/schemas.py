@@ -1,5 +1,5 @@
-from pydantic import BaseModel, ConfigDict
-from typing import Optional, List
+from pydantic import BaseModel, ConfigDict, Discriminator, Field, Tag, model_validator
+from typing import Annotated, Optional, List, Union
 from datetime import date, datetime, time
 from enum import Enum
 
@@ -136,6 +136,10 @@ class WebhookPayload(BaseModel):
     data_type: WebhookDataType
     payload: dict
 
+class WebhookBatchPayload(BaseModel):
+    # Validated one by one, so a bad event is reported without rejecting the batch
+    events: List[dict] = Field(..., min_length=1, max_length=500)
+
 # Specific Payloads for Webhook
 class BPPayload(BaseModel):
     systolic: int
@@ -176,6 +180,28 @@ class FoodLogPayload(BaseModel):
     quantity: float = 1.0
     meal_id: str = "Snack"
 
+    @model_validator(mode="after")
+    def _needs_barcode_or_name(self):
+        if not self.barcode and not self.food_name:
+            raise ValueError("barcode or food_name is required")
+        return self
+
+class FoodLogBatchPayload(BaseModel):
+    items: List[FoodLogPayload] = Field(..., min_length=1, max_length=100)
+    meal_id: Optional[str] = None # Applies to items that do not set their own
+
+def _food_log_kind(value) -> str:
+    if isinstance(value, dict):
+        return "batch" if "items" in value else "single"
+    return "batch" if isinstance(value, FoodLogBatchPayload) else "single"
+
+# A meal ({"items": [...]}) or a single food, chosen by the presence of `items` like the
+# webhook and MQTT payloads, so an invalid batch is rejected rather than read as one food
+FoodLogEntry = Annotated[
+    Union[Annotated[FoodLogBatchPayload, Tag("batch")], Annotated[FoodLogPayload, Tag("single")]],
+    Discriminator(_food_log_kind),
+]
+
 class FoodLogResponse(BaseModel):
     log_id: int
     food_name: str
@@ -204,6 +230,14 @@ class LogUpdate(BaseModel):
     serving_size: Optional[float] = None
     meal_id: Optional[str] = None
 
+# Admin
+class DailyLogRebuildRequest(BaseModel):
+    user_id: Optional[int] = None
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    incremental: bool = False
+    dry_run: bool = False
+
 # Nutrition
 class NutritionCacheBase(BaseModel):
     barcode: Optional[str] = None
@@ -222,6 +256,17 @@ class NutritionCacheResponse(NutritionCacheBase):
     source: str
     model_config = ConfigDict(from_attributes=True)
 
+class FoodLookupItem(BaseModel):
+    barcode: Optional[str] = None
+    food_name: Optional[str] = None
+
+class FoodLookupRequest(BaseModel):
+    items: List[FoodLookupItem] = Field(..., max_length=100)
+
+class FoodLookupResult(FoodLookupItem):
+    found: bool
+    food: Optional[NutritionCacheResponse] = None
+
 # Medical History
 class AllergyBase(BaseModel):
     allergen: str
@@ -1,8 +1,25 @@
-import requests
 import os
+import sys
 import shutil
+import json
+import re
+import csv
+import gzip
+import logging
+import threading
+import heapq
+import bisect
+from collections import OrderedDict
+from itertools import groupby
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from sqlalchemy import event, func, text, and_, or_, insert, Table, MetaData, Column, Date, DateTime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
-from app import models, schemas, database
+from pydantic import ValidationError
+from app import models, schemas, database, openfoodfacts
 from datetime import datetime, date, timedelta, time
 from cryptography.fernet import Fernet
 import base64
@@ -10,43 +27,354 @@ import hashlib
 from datetime import timezone
 import zoneinfo
 
+logger = logging.getLogger(__name__)
+
+RECENT_FOODS_PER_USER = int(os.getenv("RECENT_FOODS_PER_USER", 50))
+RECENT_FOODS_HALF_LIFE_DAYS = float(os.getenv("RECENT_FOODS_HALF_LIFE_DAYS", 14))
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", 48))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000))
+BP_CHART_POINTS = int(os.getenv("BP_CHART_POINTS", 200))
+BP_CHART_MAX_POINTS = int(os.getenv("BP_CHART_MAX_POINTS", 2000))
+BP_CHART_MAX_DAYS = int(os.getenv("BP_CHART_MAX_DAYS", 3660))
+
+def parse_off_product(barcode: str, product: dict) -> dict:
+    """Maps an Open Food Facts product record onto NutritionCache column values (per 100g)."""
+    nutriments = product.get("nutriments") or {}
+    def get_nutriment(key):
+        val = nutriments.get(key)
+        if val is None: return 0.0
+        try: return float(val)
+        except (ValueError, TypeError): return 0.0
+    calories = get_nutriment("energy-kcal_100g")
+    if calories == 0:
+        kj = get_nutriment("energy-kj_100g")
+        if kj > 0: calories = kj / 4.184
+    return {
+        "barcode": barcode,
+        "food_name": product.get("product_name") or "Unknown",
+        "calories": calories,
+        "protein": get_nutriment("proteins_100g"),
+        "fat": get_nutriment("fat_100g"),
+        "carbs": get_nutriment("carbohydrates_100g"),
+        "fiber": get_nutriment("fiber_100g"),
+        "source": "OFF",
+    }
+
+# Background refreshes of stale OFF entries, at most one in flight per barcode
+_refresh_executor = ThreadPoolExecutor(max_workers=openfoodfacts.OFF_REFRESH_WORKERS, thread_name_prefix="off-refresh")
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+# Concurrent lookups of the same unknown barcode share one OFF request
+_lookups = openfoodfacts.SingleFlight()
+# Bounds how many OFF fetches batch lookups run at once
+_lookup_executor = ThreadPoolExecutor(max_workers=openfoodfacts.OFF_LOOKUP_WORKERS, thread_name_prefix="off-lookup")
+# Expired idempotency keys are deleted off the request path
+_prune_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="idempotency-prune")
+
 class OpenFoodFactsService:
-    BASE_URL = "https://world.openfoodfacts.org/api/v0/product/{barcode}.json"
+    def __init__(self, client: openfoodfacts.OpenFoodFactsClient = None,
+                 misses: openfoodfacts.MissCache = None, session_factory=None):
+        self.client = client or openfoodfacts.off_client
+        self.misses = misses if misses is not None else openfoodfacts.off_misses
+        self.session_factory = session_factory or database.SessionLocal
+
+    def is_stale(self, food: models.NutritionCache) -> bool:
+        if food.source != "OFF":
+            return False
+        if food.fetched_at is None:
+            return True
+        fetched_at = food.fetched_at
+        if fetched_at.tzinfo is None:
+            fetched_at = fetched_at.replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) - fetched_at > timedelta(days=openfoodfacts.OFF_REFRESH_AFTER_DAYS)
 
     def get_product(self, barcode: str, db: Session):
+        """
+        Returns the cached food for a barcode, fetching it from OFF if needed. A newly fetched
+        food is added in the caller's transaction and saved when the caller commits.
+        """
         cached = db.query(models.NutritionCache).filter(models.NutritionCache.barcode == barcode).first()
         if cached:
+            # Serve what we have now, bring it up to date in the background
+            if self.is_stale(cached):
+                self.schedule_refresh(barcode)
             return cached
 
-        response = requests.get(self.BASE_URL.format(barcode=barcode))
-        if response.status_code == 200:
-            data = response.json()
-            if data.get("status") == 1 or data.get("product"):
-                product = data["product"]
-                nutriments = product.get("nutriments", {})
-                food_name = product.get("product_name", "Unknown")
-                def get_nutriment(key):
-                    val = nutriments.get(key)
-                    if val is None: return 0.0
-                    try: return float(val)
-                    except (ValueError, TypeError): return 0.0
-                calories = get_nutriment("energy-kcal_100g")
-                if calories == 0:
-                    kj = get_nutriment("energy-kj_100g")
-                    if kj > 0: calories = kj / 4.184
-                protein = get_nutriment("proteins_100g")
-                fat = get_nutriment("fat_100g")
-                carbs = get_nutriment("carbohydrates_100g")
-                fiber = get_nutriment("fiber_100g")
-                new_cache = models.NutritionCache(
-                    barcode=barcode, food_name=food_name, calories=calories,
-                    protein=protein, fat=fat, carbs=carbs, fiber=fiber, source="OFF"
-                )
-                db.add(new_cache)
-                db.commit()
-                db.refresh(new_cache)
-                return new_cache
-        return None
+        if barcode in self.misses:
+            return None
+        product = self.fetch(barcode)
+        if product is None:
+            return None
+        return self.store(db, {barcode: product}).get(barcode)
+
+    def fetch(self, barcode: str) -> Optional[dict]:
+        """Fetches a product from OFF; concurrent fetches of the same barcode share one request."""
+        return _lookups.do(barcode, lambda: self._fetch(barcode))
+
+    def _fetch(self, barcode: str) -> Optional[dict]:
+        try:
+            product = self.client.fetch_product(barcode)
+        except openfoodfacts.OpenFoodFactsUnavailable:
+            # Degrade to "not found" rather than hanging or failing the request
+            return None
+        if product is None:
+            self.misses.add(barcode)
+        return product
+
+    def store(self, db: Session, products: dict) -> dict:
+        """
+        Adds fetched products ({barcode: OFF product}) to the cache in the caller's transaction
+        and returns {barcode: NutritionCache}. Barcodes stored in the meantime (by another
+        request or process) are left as they are. Does not commit.
+        """
+        now = datetime.now(timezone.utc)
+        rows = [{**parse_off_product(barcode, product), "fetched_at": now} for barcode, product in products.items()]
+        db.execute(sqlite_insert(models.NutritionCache).on_conflict_do_nothing(index_elements=["barcode"]), rows)
+        return {
+            food.barcode: food
+            for food in db.query(models.NutritionCache).filter(models.NutritionCache.barcode.in_(list(products)))
+        }
+
+    def schedule_refresh(self, barcode: str):
+        with _refreshing_lock:
+            if barcode in _refreshing:
+                return None
+            _refreshing.add(barcode)
+        return _refresh_executor.submit(self.refresh_product, barcode)
+
+    def refresh_product(self, barcode: str):
+        """
+        Re-fetches a cached product from OFF. Keeps the old values if OFF is unavailable or no
+        longer knows it. Existing food logs keep the nutrition snapshot they were logged with.
+        """
+        db = self.session_factory()
+        try:
+            food = db.query(models.NutritionCache).filter(models.NutritionCache.barcode == barcode).first()
+            if not food:
+                return
+            try:
+                product = self.client.fetch_product(barcode)
+            except openfoodfacts.OpenFoodFactsUnavailable:
+                return
+            if product is not None:
+                for key, value in parse_off_product(barcode, product).items():
+                    setattr(food, key, value)
+            food.fetched_at = datetime.now(timezone.utc)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"Refreshing OFF product {barcode} failed: {e}")
+        finally:
+            db.close()
+            with _refreshing_lock:
+                _refreshing.discard(barcode)
+
+def _fold(value: str) -> str:
+    # Lowercase and strip accents, so "Crème" matches "creme"
+    decomposed = unicodedata.normalize("NFKD", value or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+def _epoch(value: datetime) -> float:
+    if value is None:
+        return 0.0
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+class RecentFoodsIndex:
+    """
+    Per-user foods ranked by frecency: how often each was logged, decayed by how long ago it
+    was last logged. Held in memory, capped per user, and rebuilt from food_item_logs with one
+    aggregate query; new logs are added incrementally.
+    """
+    TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self, per_user: int = RECENT_FOODS_PER_USER, half_life_days: float = RECENT_FOODS_HALF_LIFE_DAYS):
+        self.per_user = per_user
+        self.half_life = half_life_days * 86400
+        self._users = {}  # user_id -> {food_id: [count, last_used, name_words]}
+        self._lock = threading.Lock()
+
+    def _score(self, entry, now: float) -> float:
+        count, last_used, _ = entry
+        return count * 0.5 ** (max(now - last_used, 0) / self.half_life)
+
+    def _words(self, food_name: str) -> tuple:
+        return tuple(self.TOKEN_RE.findall(_fold(food_name)))
+
+    def _trim(self, foods: dict, now: float, keep: int = None) -> dict:
+        """Drops the lowest scoring foods over the cap; `keep` (a food just logged) always stays."""
+        if len(foods) <= self.per_user:
+            return foods
+        others = [food_id for food_id in foods if food_id != keep]
+        limit = self.per_user - 1 if keep in foods else self.per_user
+        kept = heapq.nlargest(limit, others, key=lambda food_id: self._score(foods[food_id], now))
+        if keep in foods:
+            kept.append(keep)
+        return {food_id: foods[food_id] for food_id in kept}
+
+    def rebuild(self, db: Session, user_id: int = None):
+        """Reloads everyone (or one user) from the logs."""
+        query = db.query(
+            models.FoodItemLog.user_id, models.FoodItemLog.food_id, models.NutritionCache.food_name,
+            func.count(models.FoodItemLog.item_log_id), func.max(models.FoodItemLog.timestamp)
+        ).join(models.NutritionCache, models.NutritionCache.food_id == models.FoodItemLog.food_id
+        ).group_by(models.FoodItemLog.user_id, models.FoodItemLog.food_id)
+        if user_id is not None:
+            query = query.filter(models.FoodItemLog.user_id == user_id)
+
+        now = datetime.now(timezone.utc).timestamp()
+        users = {}
+        for uid, food_id, food_name, count, last_used in query:
+            users.setdefault(uid, {})[food_id] = [count, _epoch(last_used), self._words(food_name)]
+        users = {uid: self._trim(foods, now) for uid, foods in users.items()}
+
+        with self._lock:
+            if user_id is None:
+                self._users = users
+            else:
+                self._users[user_id] = users.get(user_id, {})
+
+    def record(self, user_id: int, food_id: int, food_name: str, when: datetime = None):
+        last_used = _epoch(when) if when else datetime.now(timezone.utc).timestamp()
+        with self._lock:
+            foods = self._users.setdefault(user_id, {})
+            entry = foods.get(food_id)
+            if entry:
+                entry[0] += 1
+                entry[1] = max(entry[1], last_used)
+            else:
+                foods[food_id] = [1, last_used, self._words(food_name)]
+                self._users[user_id] = self._trim(foods, last_used, keep=food_id)
+
+    def record_on_commit(self, db: Session, user_id: int, food_id: int, food_name: str, when: datetime = None):
+        """Records the food once `db` commits; a rollback drops it."""
+        db.info.setdefault(RECENT_FOODS_KEY, []).append((user_id, food_id, food_name, when))
+
+    def top(self, user_id: int, limit: int = 20, query: str = None) -> List[int]:
+        """Food ids for the user, best first, optionally only those whose words start with every query word."""
+        tokens = self.TOKEN_RE.findall(_fold(query)) if query else []
+        now = datetime.now(timezone.utc).timestamp()
+        with self._lock:
+            foods = list(self._users.get(user_id, {}).items())
+        if tokens:
+            foods = [(food_id, entry) for food_id, entry in foods
+                     if all(any(word.startswith(token) for word in entry[2]) for token in tokens)]
+        foods.sort(key=lambda item: self._score(item[1], now), reverse=True)
+        return [food_id for food_id, _ in foods[:limit]]
+
+    def load(self, db: Session, user_id: int, limit: int = 20, query: str = None) -> List[models.NutritionCache]:
+        food_ids = self.top(user_id, limit, query)
+        if not food_ids:
+            return []
+        foods = {f.food_id: f for f in db.query(models.NutritionCache).filter(models.NutritionCache.food_id.in_(food_ids))}
+        return [foods[food_id] for food_id in food_ids if food_id in foods]
+
+recent_foods = RecentFoodsIndex()
+RECENT_FOODS_KEY = "recent_foods_pending"
+
+@event.listens_for(Session, "after_commit")
+def _record_recent_foods(session):
+    if session.in_nested_transaction():
+        return
+    for user_id, food_id, food_name, when in session.info.pop(RECENT_FOODS_KEY, ()):
+        recent_foods.record(user_id, food_id, food_name, when)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_recent_foods(session):
+    # Savepoint rollbacks trim their own entries (see WebhookBatchService.process)
+    if not session.in_nested_transaction():
+        session.info.pop(RECENT_FOODS_KEY, None)
+
+class FoodSearchService:
+    """Ranked prefix search over food names using the nutrition_cache_fts index."""
+    TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+    # Only the best-ranked matches are loaded and re-sorted, which bounds the cost of very short, very common prefixes
+    RANK_CANDIDATES = 1000
+
+    def build_match_query(self, query: str) -> str:
+        # Quote each word (so FTS5 operators in user input are inert) and prefix-match it
+        tokens = self.TOKEN_RE.findall(query)
+        return " ".join(f'"{token}"*' for token in tokens)
+
+    def search(self, db: Session, query: str, limit: int = 20, user_id: int = None):
+        """With a user_id, that user's matching recent and frequent foods come first."""
+        match = self.build_match_query(query)
+        if not match:
+            return []
+        if user_id is None:
+            return self._search_catalogue(db, query, match, limit)
+
+        recent = recent_foods.load(db, user_id, limit, query)
+        if len(recent) >= limit:
+            return recent
+        seen = {food.food_id for food in recent}
+        others = self._search_catalogue(db, query, match, limit + len(recent))
+        return (recent + [food for food in others if food.food_id not in seen])[:limit]
+
+    def _search_catalogue(self, db: Session, query: str, match: str, limit: int):
+        try:
+            return db.query(models.NutritionCache).from_statement(text("""
+                SELECT nutrition_cache.* FROM (
+                    SELECT rowid, rank FROM nutrition_cache_fts
+                    WHERE nutrition_cache_fts MATCH :match
+                    ORDER BY rank
+                    LIMIT :candidates
+                ) AS hits
+                JOIN nutrition_cache ON nutrition_cache.food_id = hits.rowid
+                ORDER BY hits.rank, length(nutrition_cache.food_name)
+                LIMIT :limit
+            """)).params(match=match, candidates=self.RANK_CANDIDATES, limit=limit).all()
+        except OperationalError:
+            # No FTS5 module or index in this database: fall back to a substring scan
+            return db.query(models.NutritionCache).filter(
+                models.NutritionCache.food_name.ilike(f"%{query}%")
+            ).limit(limit).all()
+
+class FoodLookupService:
+    """
+    Resolves a list of barcodes and/or food names in one go: everything already cached
+    comes from a single query, unknown barcodes are fetched from OFF in parallel.
+    """
+    def __init__(self, off_service: OpenFoodFactsService = None):
+        self.off_service = off_service or OpenFoodFactsService()
+
+    def lookup(self, db: Session, items: List[schemas.FoodLookupItem]) -> List[Optional[models.NutritionCache]]:
+        """Returns the matching food (or None) for each item, in order. Barcodes win over names."""
+        barcodes = {item.barcode for item in items if item.barcode}
+        names = {item.food_name for item in items if item.food_name}
+
+        by_barcode, by_name = {}, {}
+        conditions = []
+        if barcodes: conditions.append(models.NutritionCache.barcode.in_(barcodes))
+        if names: conditions.append(models.NutritionCache.food_name.in_(names))
+        if conditions:
+            query = db.query(models.NutritionCache).filter(or_(*conditions)).order_by(models.NutritionCache.food_id)
+            for food in query:
+                if food.barcode in barcodes:
+                    by_barcode[food.barcode] = food
+                if food.food_name in names:
+                    by_name.setdefault(food.food_name, food)
+
+        for food in by_barcode.values():
+            if self.off_service.is_stale(food):
+                self.off_service.schedule_refresh(food.barcode)
+
+        missing = [b for b in barcodes if b not in by_barcode and b not in self.off_service.misses]
+        if missing:
+            products = {barcode: product for barcode, product in zip(missing, self._fetch(missing)) if product}
+            if products:
+                # Stored in the caller's transaction: a batch that has already written holds the
+                # write lock, and a second session would wait on it until it times out
+                by_barcode.update(self.off_service.store(db, products))
+
+        return [by_barcode.get(item.barcode) or by_name.get(item.food_name) for item in items]
+
+    def _fetch(self, barcodes: List[str]) -> List[Optional[dict]]:
+        """OFF products (or None) for the barcodes, fetched in parallel."""
+        if len(barcodes) == 1:
+            return [self.off_service.fetch(barcodes[0])]
+        return list(_lookup_executor.map(self.off_service.fetch, barcodes))
 
 class METCalculator:
     def calculate_calories(self, db: Session, user: models.User, activity_type: str, duration_minutes: float):
@@ -55,6 +383,30 @@ class METCalculator:
         met_value = met_entry.met_value if met_entry else default_mets.get(activity_type.lower(), 1.0)
         return (met_value * user.weight_kg * 3.5 / 200) * duration_minutes
 
+def get_user_tz(user: models.User):
+    try:
+        return zoneinfo.ZoneInfo(user.timezone) if user.timezone else timezone.utc
+    except Exception:
+        return timezone.utc
+
+def resolve_date_range(days: int, start_date: Optional[date], end_date: Optional[date], default_end: date,
+                       max_days: int):
+    """
+    Fills in an optional local date range: the end defaults to `default_end` and the start
+    to `days` days before the end. Raises ValueError for reversed or over-long ranges.
+    """
+    if days > max_days:
+        raise ValueError(f"Range is limited to {max_days} days")
+    if end_date is None:
+        end_date = default_end
+    if start_date is None:
+        start_date = end_date - timedelta(days=days - 1)
+    if start_date > end_date:
+        raise ValueError("start_date must not be after end_date")
+    if (end_date - start_date).days >= max_days:
+        raise ValueError(f"Range is limited to {max_days} days")
+    return start_date, end_date
+
 def get_user_local_date(user: models.User, utc_dt: datetime) -> date:
     if not utc_dt: utc_dt = datetime.now(timezone.utc)
     if utc_dt.tzinfo is None: utc_dt = utc_dt.replace(tzinfo=timezone.utc)
@@ -64,8 +416,81 @@ def get_user_local_date(user: models.User, utc_dt: datetime) -> date:
         user_tz = timezone.utc
     return utc_dt.astimezone(user_tz).date()
 
+NUTRITION_FIELDS = ("calories", "protein", "fat", "carbs", "fiber")
+
+def nutrition_snapshot(food: models.NutritionCache) -> dict:
+    """Per-serving values copied onto a FoodItemLog when it is created."""
+    return {field: getattr(food, field) or 0 for field in NUTRITION_FIELDS}
+
+def logged_nutrition(log: models.FoodItemLog):
+    """The nutrition a log was counted with: its own snapshot, or the cached food for logs that predate snapshots."""
+    return log if log.calories is not None else log.nutrition_info
+
+def food_log_totals(food, serving_size: float, quantity: float, sign: int = 1) -> dict:
+    """Nutrition contributed by one food log entry, as keyword arguments for apply_daily_log_delta."""
+    multiplier = serving_size * quantity * sign
+    return {
+        "consumed": (food.calories or 0) * multiplier,
+        "protein": (food.protein or 0) * multiplier,
+        "fat": (food.fat or 0) * multiplier,
+        "carbs": (food.carbs or 0) * multiplier,
+        "fiber": (food.fiber or 0) * multiplier,
+        "food_items": sign,
+    }
+
+def apply_daily_log_delta(db: Session, user_id: int, log_date: date, consumed: float = 0.0, burned: float = 0.0,
+                          protein: float = 0.0, fat: float = 0.0, carbs: float = 0.0, fiber: float = 0.0,
+                          food_items: int = 0):
+    """
+    Adds to (or, with negative values, subtracts from) a user's DailyLog totals
+    with a single INSERT ... ON CONFLICT DO UPDATE, relying on the unique
+    (user_id, date) index. Totals are clamped at zero. Does not commit.
+    """
+    deltas = {
+        "total_calories_consumed": consumed,
+        "total_calories_burned": burned,
+        "total_protein": protein,
+        "total_fat": fat,
+        "total_carbs": carbs,
+        "total_fiber": fiber,
+        "food_item_count": food_items,
+    }
+    stmt = sqlite_insert(models.DailyLog).values(
+        user_id=user_id, date=log_date,
+        **{column: max(delta, 0) for column, delta in deltas.items()}
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.DailyLog.user_id, models.DailyLog.date],
+        set_={
+            column: func.max(getattr(models.DailyLog, column) + delta, 0)
+            for column, delta in deltas.items()
+        }
+    )
+    db.execute(stmt)
+    database.mark_user_changed(db, user_id)
+
+class DailyLogDeltas:
+    """Collects DailyLog changes so a batch of logs updates each (user, day) row only once."""
+    def __init__(self):
+        self._totals = {}  # (user_id, date) -> {field: delta}
+
+    def add(self, user_id: int, log_date: date, **deltas):
+        totals = self._totals.setdefault((user_id, log_date), {})
+        for key, value in deltas.items():
+            totals[key] = totals.get(key, 0) + value
+
+    def merge(self, other: "DailyLogDeltas"):
+        for (user_id, log_date), totals in other._totals.items():
+            self.add(user_id, log_date, **totals)
+
+    def apply(self, db: Session):
+        for (user_id, log_date), totals in self._totals.items():
+            apply_daily_log_delta(db, user_id, log_date, **totals)
+        self._totals.clear()
+
 class MedicationService:
-    def log_dose(self, db: Session, user_id: int, med_name: str, timestamp_taken: datetime = None, med_window: str = None):
+    def log_dose(self, db: Session, user_id: int, med_name: str, timestamp_taken: datetime = None, med_window: str = None,
+                 commit: bool = True):
         if not timestamp_taken: timestamp_taken = datetime.now(timezone.utc)
         med = db.query(models.Medication).filter(
             models.Medication.user_id == user_id, models.Medication.name == med_name
@@ -83,11 +508,15 @@ class MedicationService:
             dose_window=dose_window
         )
         db.add(dose_log)
+        user = db.get(models.User, user_id)
+        if user:
+            AdherenceLedgerService().record_dose(db, user, med.med_id, timestamp_taken, dose_window)
         alert = None
         days_remaining = med.current_inventory / med.daily_doses if med.daily_doses > 0 else 999
         if days_remaining <= 7 or med.refills_remaining <= 1:
             alert = f"Refill needed for {med.name}. Days remaining: {days_remaining:.1f}, Refills: {med.refills_remaining}"
-        db.commit()
+        if commit:
+            db.commit()
         return dose_log, alert
 
     def delete_dose_log(self, db: Session, log_id: int, user_id: int):
@@ -100,12 +529,16 @@ class MedicationService:
             med.current_inventory += 1
 
         db.delete(log)
+        user = db.get(models.User, user_id)
+        if user:
+            AdherenceLedgerService().refresh(db, user, log.med_id, [log.timestamp_taken])
         db.commit()
         return True
 
     def update_dose_log(self, db: Session, log_id: int, user_id: int, updates: schemas.LogUpdate):
         log = db.query(models.MedDoseLog).filter(models.MedDoseLog.dose_log_id == log_id, models.MedDoseLog.user_id == user_id).first()
         if not log: return None
+        old_med_id, old_timestamp = log.med_id, log.timestamp_taken
 
         if updates.timestamp:
             log.timestamp_taken = updates.timestamp
@@ -124,72 +557,463 @@ class MedicationService:
                 new_med.current_inventory -= 1 # Deduct new
                 log.med_id = updates.med_id
 
+        user = db.get(models.User, user_id)
+        if user:
+            ledger = AdherenceLedgerService()
+            ledger.refresh(db, user, log.med_id, [old_timestamp, log.timestamp_taken])
+            if old_med_id != log.med_id:
+                ledger.refresh(db, user, old_med_id, [old_timestamp])
         db.commit()
         db.refresh(log)
         return log
 
+DOSE_WINDOWS = ("morning", "afternoon", "evening", "bedtime")
+COMPLIANCE_MAX_DAYS = int(os.getenv("COMPLIANCE_MAX_DAYS", 3660))
+CALENDAR_STATUSES = {"T": "all doses taken", "P": "some doses taken", "M": "no doses taken", "N": "nothing scheduled"}
+
+def get_user_windows(user: models.User) -> list:
+    """The user's dose windows as (name, local start time), ordered by start time."""
+    windows = [
+        ("morning", user.window_morning_start or time(6, 0)),
+        ("afternoon", user.window_afternoon_start or time(12, 0)),
+        ("evening", user.window_evening_start or time(17, 0)),
+        ("bedtime", user.window_bedtime_start or time(21, 0))
+    ]
+    windows.sort(key=lambda x: x[1])
+    return windows
+
+def med_schedule(med: models.Medication) -> List[str]:
+    schedule = []
+    if med.schedule_morning: schedule.append("morning")
+    if med.schedule_afternoon: schedule.append("afternoon")
+    if med.schedule_evening: schedule.append("evening")
+    if med.schedule_bedtime: schedule.append("bedtime")
+    return schedule
+
+class ComplianceService:
+    """
+    Expected-versus-taken dose counts over an arbitrary range of local days.
+
+    Everything is kept as one bitset (a Python int) per medication and window, with
+    bit i standing for day start_date + i, so counting is a popcount of the taken bits
+    masked by the days the medication was active. Taken doses come from the
+    adherence ledger (see AdherenceLedgerService).
+
+    Attribution rules: a dose without an explicit window belongs to the latest
+    window that has started on its local day; before the first window it belongs
+    to the previous day's last window. An explicit bedtime dose taken before the
+    morning window counts for the previous day.
+    """
+    # Boundaries per local day: midnight, then the start of each window in order
+    SLOTS_PER_DAY = 1 + len(DOSE_WINDOWS)
+
+    def resolve_range(self, user: models.User, days: int = 30, start_date: date = None, end_date: date = None):
+        """Defaults to the `days` complete local days up to yesterday."""
+        yesterday = get_user_local_date(user, datetime.now(timezone.utc)) - timedelta(days=1)
+        return resolve_date_range(days, start_date, end_date, yesterday, COMPLIANCE_MAX_DAYS)
+
+    def _boundaries(self, user: models.User, windows: list, start_date: date, days: int) -> List[datetime]:
+        """Naive UTC instants of each local midnight and window start, for `days` days from start_date."""
+        user_tz = get_user_tz(user)
+        starts = [time.min] + [w_start for _, w_start in windows]
+        bounds = []
+        for i in range(days):
+            d = start_date + timedelta(days=i)
+            for t in starts:
+                local = datetime.combine(d, t).replace(tzinfo=user_tz)
+                bounds.append(local.astimezone(timezone.utc).replace(tzinfo=None))
+        return bounds
+
+    def _attribute(self, bounds: List[datetime], names: List[str], ts: datetime, dose_window: str = None):
+        """
+        Returns (day index, window) of a dose, found by bisecting its UTC timestamp into
+        the boundaries rather than converting it to local time.
+        """
+        if ts.tzinfo is not None:
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        day, slot = divmod(bisect.bisect_right(bounds, ts) - 1, self.SLOTS_PER_DAY)
+        if dose_window:
+            # Before the morning window: an explicit bedtime dose is the previous night's
+            if dose_window == "bedtime" and slot == 0:
+                day -= 1
+            return day, dose_window
+        if slot == 0:
+            return day - 1, names[-1]
+        return day, names[slot - 1]
+
+    def attribute_dose(self, user: models.User, ts: datetime, dose_window: str = None):
+        """Returns the (local date, window) a single dose counts for."""
+        first = get_user_local_date(user, ts) - timedelta(days=1)
+        windows = get_user_windows(user)
+        bounds = self._boundaries(user, windows, first, 3)
+        day, w_name = self._attribute(bounds, [w_name for w_name, _ in windows], ts, dose_window)
+        return first + timedelta(days=day), w_name
+
+    def log_masks(self, db: Session, user: models.User, start_date: date, end_date: date,
+                  med_ids: List[int] = None) -> dict:
+        """
+        Attributes the user's dose logs to local days from scratch. Returns a dict mapping
+        (med_id, local date) to a mask with bit i set if DOSE_WINDOWS[i] was taken.
+        """
+        windows = get_user_windows(user)
+        names = [w_name for w_name, _ in windows]
+        days = (end_date - start_date).days + 1
+        # One extra day so bedtime doses taken after midnight on end_date + 1 are seen
+        bounds = self._boundaries(user, windows, start_date, days + 1)
+
+        query = db.query(
+            models.MedDoseLog.med_id, models.MedDoseLog.timestamp_taken, models.MedDoseLog.dose_window
+        ).filter(
+            models.MedDoseLog.user_id == user.user_id,
+            models.MedDoseLog.timestamp_taken >= bounds[0],
+            models.MedDoseLog.timestamp_taken < bounds[days * self.SLOTS_PER_DAY + 1]
+        )
+        if med_ids is not None:
+            query = query.filter(models.MedDoseLog.med_id.in_(med_ids))
+
+        masks = {}
+        for med_id, ts, dose_window in query.all():
+            day, w_name = self._attribute(bounds, names, ts, dose_window)
+            if 0 <= day < days and w_name in DOSE_WINDOWS:
+                key = (med_id, start_date + timedelta(days=day))
+                masks[key] = masks.get(key, 0) | (1 << DOSE_WINDOWS.index(w_name))
+        return masks
+
+    def taken_masks(self, db: Session, user: models.User, start_date: date, end_date: date) -> dict:
+        """Maps (med_id, window) to a bitset of the days in the range that dose was taken."""
+        rows = db.query(
+            models.DoseAdherence.med_id, models.DoseAdherence.local_date, models.DoseAdherence.windows_taken
+        ).filter(
+            models.DoseAdherence.user_id == user.user_id,
+            models.DoseAdherence.local_date >= start_date,
+            models.DoseAdherence.local_date <= end_date
+        ).all()
+
+        masks = {}
+        for med_id, local_date, windows_taken in rows:
+            day_bit = 1 << (local_date - start_date).days
+            for i, w_name in enumerate(DOSE_WINDOWS):
+                if windows_taken & (1 << i):
+                    masks[(med_id, w_name)] = masks.get((med_id, w_name), 0) | day_bit
+        return masks
+
+    def active_mask(self, med: models.Medication, start_date: date, end_date: date) -> int:
+        """Bitset of the days in the range on which the medication was scheduled (start/end inclusive)."""
+        first = max(start_date, med.start_date) if med.start_date else start_date
+        last = min(end_date, med.end_date) if med.end_date else end_date
+        if first > last:
+            return 0
+        return ((1 << ((last - first).days + 1)) - 1) << (first - start_date).days
+
+    def report(self, db: Session, user: models.User, start_date: date, end_date: date) -> dict:
+        meds = db.query(models.Medication).filter(models.Medication.user_id == user.user_id).all()
+        result = {
+            "start_date": start_date, "end_date": end_date, "compliance_percentage": 0,
+            "missed_doses": 0, "taken_doses": 0, "total_scheduled": 0, "medications": []
+        }
+        if not meds:
+            return result
+
+        taken_masks = self.taken_masks(db, user, start_date, end_date)
+        total_expected = 0
+        total_taken = 0
+        for med in meds:
+            schedule = med_schedule(med)
+            active = self.active_mask(med, start_date, end_date)
+            exp = active.bit_count() * len(schedule)
+            tak = sum((taken_masks.get((med.med_id, w), 0) & active).bit_count() for w in schedule)
+            total_expected += exp
+            total_taken += tak
+
+            pct = (tak / exp * 100) if exp > 0 else 100.0
+            result["medications"].append({
+                "name": med.name, "compliance_percentage": round(pct, 1),
+                "taken": tak, "expected": exp, "missed": exp - tak,
+                "schedule": ", ".join(w[0].upper() for w in schedule)
+            })
+
+        percentage = (total_taken / total_expected * 100) if total_expected > 0 else 0.0
+        result.update({
+            "compliance_percentage": round(percentage, 1), "missed_doses": total_expected - total_taken,
+            "taken_doses": total_taken, "total_scheduled": total_expected
+        })
+        return result
+
+    def calendar(self, db: Session, user: models.User, start_date: date, end_date: date) -> dict:
+        """
+        Per-day adherence for each medication plus streaks, for rendering a heatmap.
+        Each day is one status letter (see CALENDAR_STATUSES) and the days are
+        run-length encoded, e.g. "30T2P1M" for 30 complete days, 2 partial and 1 missed.
+        """
+        days = (end_date - start_date).days + 1
+        meds = db.query(models.Medication).filter(models.Medication.user_id == user.user_id).all()
+        taken_masks = self.taken_masks(db, user, start_date, end_date)
+
+        def bits(mask: int) -> str:
+            return format(mask, f"0{days}b")[::-1]
+
+        medications = []
+        med_statuses = []
+        for med in meds:
+            schedule = med_schedule(med)
+            active = self.active_mask(med, start_date, end_date) if schedule else 0
+            taken = [taken_masks.get((med.med_id, w), 0) & active for w in schedule]
+            all_taken = active
+            any_taken = 0
+            for mask in taken:
+                all_taken &= mask
+                any_taken |= mask
+
+            statuses = "".join(
+                "N" if a == "0" else "T" if f == "1" else "P" if t == "1" else "M"
+                for a, f, t in zip(bits(active), bits(all_taken), bits(any_taken))
+            )
+            med_statuses.append(statuses)
+            current, longest = self._streaks(statuses)
+            medications.append({
+                "med_id": med.med_id, "name": med.name,
+                "schedule": ", ".join(w[0].upper() for w in schedule),
+                "taken": sum(mask.bit_count() for mask in taken),
+                "expected": active.bit_count() * len(schedule),
+                "days": self._run_length(statuses),
+                "current_streak": current, "longest_streak": longest
+            })
+
+        overall = []
+        for day in zip(*med_statuses) if med_statuses else [("N",)] * days:
+            scheduled = set(day) - {"N"}
+            if not scheduled:
+                overall.append("N")
+            elif len(scheduled) == 1:
+                overall.append(scheduled.pop())
+            else:
+                overall.append("P")
+        overall = "".join(overall)
+        current, longest = self._streaks(overall)
+
+        return {
+            "start_date": start_date, "end_date": end_date, "days": days,
+            "statuses": CALENDAR_STATUSES,
+            "overall": {"days": self._run_length(overall), "current_streak": current, "longest_streak": longest},
+            "medications": medications
+        }
+
+    @staticmethod
+    def _run_length(statuses: str) -> str:
+        return "".join(f"{len(list(run))}{status}" for status, run in groupby(statuses))
+
+    @staticmethod
+    def _streaks(statuses: str):
+        """(current, longest) runs of fully taken days; days with nothing scheduled are skipped."""
+        current = longest = 0
+        for status in statuses:
+            if status == "T":
+                current += 1
+                longest = max(longest, current)
+            elif status != "N":
+                current = 0
+        return current, longest
+
+class AdherenceLedgerService:
+    """
+    Keeps dose_adherence, one row per medication and local day holding a bit per dose
+    window taken, in step with med_dose_logs. New doses OR their bit in; edits and
+    deletes recompute the affected days from the logs. Window start times and the
+    timezone decide which day and window a dose counts for, so changing either
+    requires rebuilding the user's ledger.
+    """
+    BUILT_KEY = "dose_adherence_built"
+
+    def __init__(self):
+        self.compliance = ComplianceService()
+
+    def record_dose(self, db: Session, user: models.User, med_id: int, ts: datetime, dose_window: str = None):
+        """
+        Queues the dose's bit on the session; it is written by the flush that inserts the
+        dose log, so the ledger does not take the write lock ahead of the caller's commit.
+        """
+        local_date, w_name = self.compliance.attribute_dose(user, ts, dose_window)
+        if w_name not in DOSE_WINDOWS:
+            return
+        db.info.setdefault(ADHERENCE_PENDING_KEY, []).append({
+            "user_id": user.user_id, "med_id": med_id, "local_date": local_date,
+            "windows_taken": 1 << DOSE_WINDOWS.index(w_name)
+        })
+
+    def refresh(self, db: Session, user: models.User, med_id: int, timestamps: List[datetime]):
+        """Recomputes the days that doses of med_id at these timestamps may have counted for."""
+        dates = [get_user_local_date(user, ts) for ts in timestamps if ts]
+        if not dates:
+            return
+        # A dose counts for its local date or, before the morning window, the day before
+        first, last = min(dates) - timedelta(days=1), max(dates)
+        db.flush()
+        masks = self.compliance.log_masks(db, user, first, last, med_ids=[med_id])
+        db.query(models.DoseAdherence).filter(
+            models.DoseAdherence.med_id == med_id,
+            models.DoseAdherence.local_date >= first,
+            models.DoseAdherence.local_date <= last
+        ).delete(synchronize_session=False)
+        self._insert(db, user.user_id, masks)
+
+    def rebuild(self, db: Session, user: models.User, commit: bool = True) -> int:
+        """Recomputes the user's whole ledger from their dose logs. Returns the number of days stored."""
+        db.query(models.DoseAdherence).filter(
+            models.DoseAdherence.user_id == user.user_id
+        ).delete(synchronize_session=False)
+        first_ts, last_ts = db.query(
+            func.min(models.MedDoseLog.timestamp_taken), func.max(models.MedDoseLog.timestamp_taken)
+        ).filter(models.MedDoseLog.user_id == user.user_id).one()
+
+        masks = {}
+        if first_ts:
+            first = get_user_local_date(user, first_ts) - timedelta(days=1)
+            masks = self.compliance.log_masks(db, user, first, get_user_local_date(user, last_ts))
+            self._insert(db, user.user_id, masks)
+        if commit:
+            db.commit()
+        return len(masks)
+
+    def ensure_built(self, db: Session):
+        """Builds the ledger for every user once, after the table is first created."""
+        if db.query(models.SystemConfig).filter(models.SystemConfig.key == self.BUILT_KEY).first():
+            return
+        days = 0
+        for user in db.query(models.User).all():
+            days += self.rebuild(db, user, commit=False)
+        db.add(models.SystemConfig(key=self.BUILT_KEY, value=datetime.now(timezone.utc).isoformat()))
+        db.commit()
+        logger.info(f"Built dose adherence ledger ({days} medication days)")
+
+    def _insert(self, db: Session, user_id: int, masks: dict):
+        if masks:
+            db.execute(insert(models.DoseAdherence), [
+                {"user_id": user_id, "med_id": med_id, "local_date": local_date, "windows_taken": mask}
+                for (med_id, local_date), mask in masks.items()
+            ])
+
+ADHERENCE_PENDING_KEY = "dose_adherence_pending"
+
+@event.listens_for(Session, "after_flush")
+def _write_adherence_bits(session, flush_context):
+    connection = session.connection()
+    for row in session.info.pop(ADHERENCE_PENDING_KEY, ()):
+        upsert = sqlite_insert(models.DoseAdherence).values(**row)
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=["med_id", "local_date"],
+            set_={"windows_taken": models.DoseAdherence.windows_taken.op("|")(row["windows_taken"])}
+        ))
+
+@event.listens_for(Session, "after_rollback")
+def _discard_adherence_bits(session):
+    # Savepoints flush on entry, so anything still queued belongs to what was rolled back
+    session.info.pop(ADHERENCE_PENDING_KEY, None)
+
 class HealthLogService:
-    def log_bp(self, db: Session, user_id: int, data: schemas.BPPayload):
+    # The log_* methods commit unless commit=False, in which case the caller owns the
+    # transaction. DailyLog changes go into `daily` instead of the table when it is given.
+
+    def log_bp(self, db: Session, user_id: int, data: schemas.BPPayload, commit: bool = True,
+               timestamp: datetime = None):
         bp = models.BloodPressure(
             user_id=user_id, systolic=data.systolic, diastolic=data.diastolic,
             pulse=data.pulse, location=data.location, stress_level=data.stress_level,
-            meds_taken_before=data.meds_taken_before, timestamp=datetime.now(timezone.utc)
+            meds_taken_before=data.meds_taken_before, timestamp=timestamp or datetime.now(timezone.utc)
         )
         db.add(bp)
-        db.commit()
-        db.refresh(bp)
+        if commit:
+            db.commit()
+            db.refresh(bp)
         return bp
 
-    def log_exercise(self, db: Session, user: models.User, data: schemas.ExercisePayload):
+    def log_weight(self, db: Session, user: models.User, data: schemas.WeightPayload, commit: bool = True):
+        w_kg = data.weight
+        if data.unit.lower() in ["lbs", "lb", "pound", "pounds"]:
+            w_kg = w_kg * 0.453592
+        user.weight_kg = w_kg
+        if commit:
+            db.commit()
+        return user
+
+    def log_exercise(self, db: Session, user: models.User, data: schemas.ExercisePayload, commit: bool = True,
+                     daily: DailyLogDeltas = None, timestamp: datetime = None):
+        timestamp = timestamp or datetime.now(timezone.utc)
         met_calc = METCalculator()
         calories = data.calories_burned
         if calories is None:
             calories = met_calc.calculate_calories(db, user, data.activity_type, data.duration_minutes)
         exercise_log = models.ExerciseLog(
             user_id=user.user_id, activity_type=data.activity_type,
-            duration_minutes=data.duration_minutes, calories_burned=calories
+            duration_minutes=data.duration_minutes, calories_burned=calories, timestamp=timestamp
         )
         db.add(exercise_log)
-        local_date = get_user_local_date(user, datetime.now(timezone.utc))
-        daily_log = db.query(models.DailyLog).filter(models.DailyLog.user_id == user.user_id, models.DailyLog.date == local_date).first()
-        if not daily_log:
-            daily_log = models.DailyLog(user_id=user.user_id, date=local_date, total_calories_burned=0, total_calories_consumed=0)
-            db.add(daily_log)
-        daily_log.total_calories_burned += calories
-        db.commit()
+        local_date = get_user_local_date(user, timestamp)
+        if daily is not None:
+            daily.add(user.user_id, local_date, burned=calories)
+        else:
+            apply_daily_log_delta(db, user.user_id, local_date, burned=calories)
+        if commit:
+            db.commit()
         return exercise_log # Return the ExerciseLog, not DailyLog
 
     def log_food(self, db: Session, user: models.User, data: schemas.FoodLogPayload):
-        off_service = OpenFoodFactsService()
-        food_item = None
-        if data.barcode: food_item = off_service.get_product(data.barcode, db)
-        if not food_item and data.food_name:
-            food_item = db.query(models.NutritionCache).filter(models.NutritionCache.food_name == data.food_name).first()
-        if not food_item:
-            if data.food_name:
-                food_item = models.NutritionCache(
-                    barcode=data.barcode, food_name=data.food_name, calories=0,
+        logs, error = self.log_food_batch(db, user, [data])
+        return (logs[0] if logs else None), error
+
+    def log_food_batch(self, db: Session, user: models.User, items: List[schemas.FoodLogPayload],
+                       meal_id: Optional[str] = None, commit: bool = True, daily: DailyLogDeltas = None,
+                       timestamp: datetime = None):
+        """
+        Logs a whole meal in one transaction: foods are resolved up front, the log rows go
+        in with one bulk insert and the DailyLog gets one combined delta. Nothing is logged
+        if any item cannot be resolved.
+        """
+        timestamp = timestamp or datetime.now(timezone.utc)
+        if meal_id:
+            items = [item if "meal_id" in item.model_fields_set else item.model_copy(update={"meal_id": meal_id})
+                     for item in items]
+
+        foods = FoodLookupService().lookup(db, items)
+
+        # Unknown foods that have a name get a MANUAL placeholder, shared by repeats within the meal
+        placeholders = {}
+        for i, item in enumerate(items):
+            if foods[i] is not None:
+                continue
+            if not item.food_name:
+                return [], "Food not found"
+            key = item.barcode or item.food_name
+            if key not in placeholders:
+                placeholders[key] = models.NutritionCache(
+                    barcode=item.barcode, food_name=item.food_name, calories=0,
                     protein=0, fat=0, carbs=0, fiber=0, source="MANUAL"
                 )
-                db.add(food_item)
-                db.commit()
-                db.refresh(food_item)
-            else:
-                return None, "Food not found"
-        item_log = models.FoodItemLog(
-            user_id=user.user_id, meal_id=data.meal_id, food_id=food_item.food_id,
-            serving_size=data.serving_size, quantity=data.quantity
-        )
-        db.add(item_log)
-        local_date = get_user_local_date(user, datetime.now(timezone.utc))
-        daily_log = db.query(models.DailyLog).filter(models.DailyLog.user_id == user.user_id, models.DailyLog.date == local_date).first()
-        if not daily_log:
-            daily_log = models.DailyLog(user_id=user.user_id, date=local_date, total_calories_burned=0, total_calories_consumed=0)
-            db.add(daily_log)
-        total_cals = food_item.calories * data.serving_size * data.quantity
-        daily_log.total_calories_consumed += total_cals
-        db.commit()
-        return item_log, None
+            foods[i] = placeholders[key]
+        if placeholders:
+            db.add_all(placeholders.values())
+            db.flush()
+
+        rows = [
+            {"user_id": user.user_id, "meal_id": item.meal_id, "food_id": food.food_id, "timestamp": timestamp,
+             "serving_size": item.serving_size, "quantity": item.quantity, **nutrition_snapshot(food)}
+            for item, food in zip(items, foods)
+        ]
+        logs = db.scalars(insert(models.FoodItemLog).returning(models.FoodItemLog), rows).all()
+
+        totals = {}
+        for item, food in zip(items, foods):
+            for key, value in food_log_totals(food, item.serving_size, item.quantity).items():
+                totals[key] = totals.get(key, 0) + value
+        local_date = get_user_local_date(user, timestamp)
+        if daily is not None:
+            daily.add(user.user_id, local_date, **totals)
+        else:
+            apply_daily_log_delta(db, user.user_id, local_date, **totals)
+        for food in foods:
+            recent_foods.record_on_commit(db, user.user_id, food.food_id, food.food_name, timestamp)
+        if commit:
+            db.commit()
+        return logs, None
 
     def delete_exercise_log(self, db: Session, log_id: int, user_id: int):
         log = db.query(models.ExerciseLog).filter(models.ExerciseLog.exercise_id == log_id, models.ExerciseLog.user_id == user_id).first()
@@ -197,10 +1021,7 @@ class HealthLogService:
 
         # Deduct from DailyLog
         local_date = get_user_local_date(log.user, log.timestamp)
-        daily_log = db.query(models.DailyLog).filter(models.DailyLog.user_id == user_id, models.DailyLog.date == local_date).first()
-        if daily_log:
-            daily_log.total_calories_burned -= log.calories_burned
-            if daily_log.total_calories_burned < 0: daily_log.total_calories_burned = 0
+        apply_daily_log_delta(db, user_id, local_date, burned=-log.calories_burned)
 
         db.delete(log)
         db.commit()
@@ -242,17 +1063,9 @@ class HealthLogService:
 
         # Update DB for DailyLogs
         # 1. Revert Old
-        old_daily = db.query(models.DailyLog).filter(models.DailyLog.user_id == user_id, models.DailyLog.date == old_date).first()
-        if old_daily:
-            old_daily.total_calories_burned -= old_cals
-            if old_daily.total_calories_burned < 0: old_daily.total_calories_burned = 0
-
+        apply_daily_log_delta(db, user_id, old_date, burned=-old_cals)
         # 2. Apply New
-        new_daily = db.query(models.DailyLog).filter(models.DailyLog.user_id == user_id, models.DailyLog.date == new_date).first()
-        if not new_daily:
-            new_daily = models.DailyLog(user_id=user_id, date=new_date, total_calories_burned=0, total_calories_consumed=0)
-            db.add(new_daily)
-        new_daily.total_calories_burned += new_cals
+        apply_daily_log_delta(db, user_id, new_date, burned=new_cals)
 
         db.commit()
         db.refresh(log)
@@ -262,19 +1075,15 @@ class HealthLogService:
         log = db.query(models.FoodItemLog).filter(models.FoodItemLog.item_log_id == log_id, models.FoodItemLog.user_id == user_id).first()
         if not log: return False
 
-        # Deduct from DailyLog
-        # Need to know total calories of this item
-        # log has nutrition_info rel
-        cals = log.nutrition_info.calories * log.serving_size * log.quantity
+        # Deduct from DailyLog what the log added
+        totals = food_log_totals(logged_nutrition(log), log.serving_size, log.quantity, sign=-1)
 
         local_date = get_user_local_date(log.user, log.timestamp)
-        daily_log = db.query(models.DailyLog).filter(models.DailyLog.user_id == user_id, models.DailyLog.date == local_date).first()
-        if daily_log:
-            daily_log.total_calories_consumed -= cals
-            if daily_log.total_calories_consumed < 0: daily_log.total_calories_consumed = 0
+        apply_daily_log_delta(db, user_id, local_date, **totals)
 
         db.delete(log)
         db.commit()
+        recent_foods.rebuild(db, user_id)
         return True
 
     def update_food_log(self, db: Session, log_id: int, user_id: int, updates: schemas.LogUpdate):
@@ -282,7 +1091,7 @@ class HealthLogService:
         if not log: return None
 
         # Old values
-        old_cals = log.nutrition_info.calories * log.serving_size * log.quantity
+        old_totals = food_log_totals(logged_nutrition(log), log.serving_size, log.quantity, sign=-1)
         old_date = get_user_local_date(log.user, log.timestamp)
 
         # Updates
@@ -292,152 +1101,687 @@ class HealthLogService:
         if updates.meal_id: log.meal_id = updates.meal_id
 
         # New values
-        new_cals = log.nutrition_info.calories * log.serving_size * log.quantity
+        new_totals = food_log_totals(logged_nutrition(log), log.serving_size, log.quantity)
         new_date = get_user_local_date(log.user, log.timestamp)
 
         # Update DailyLogs
-        old_daily = db.query(models.DailyLog).filter(models.DailyLog.user_id == user_id, models.DailyLog.date == old_date).first()
-        if old_daily:
-            old_daily.total_calories_consumed -= old_cals
-            if old_daily.total_calories_consumed < 0: old_daily.total_calories_consumed = 0
-
-        new_daily = db.query(models.DailyLog).filter(models.DailyLog.user_id == user_id, models.DailyLog.date == new_date).first()
-        if not new_daily:
-            new_daily = models.DailyLog(user_id=user_id, date=new_date, total_calories_burned=0, total_calories_consumed=0)
-            db.add(new_daily)
-        new_daily.total_calories_consumed += new_cals
+        apply_daily_log_delta(db, user_id, old_date, **old_totals)
+        apply_daily_log_delta(db, user_id, new_date, **new_totals)
 
         db.commit()
+        if updates.timestamp:
+            recent_foods.rebuild(db, user_id)
         db.refresh(log)
         return log
 
-    def calculate_compliance_report(self, db: Session, user: models.User):
+    def calculate_compliance_report(self, db: Session, user: models.User, days: int = 30,
+                                    start_date: date = None, end_date: date = None):
+        service = ComplianceService()
+        start_date, end_date = service.resolve_range(user, days, start_date, end_date)
+        return service.report(db, user, start_date, end_date)
+
+# Per-connection scratch table mapping each local day to its UTC bounds, so
+# logs can be bucketed by the user's local date inside SQL.
+_rebuild_days = Table(
+    "tmp_daily_rebuild_days", MetaData(),
+    Column("local_date", Date, primary_key=True),
+    Column("utc_start", DateTime),
+    Column("utc_end", DateTime),
+    prefixes=["TEMPORARY"]
+)
+
+class IdempotencyService:
+    """
+    Remembers idempotency keys of processed events, so retried deliveries are recognised
+    and skipped. Keys live in idempotency_keys for IDEMPOTENCY_TTL_HOURS, with an in-memory
+    LRU of recently seen keys in front. A key is claimed in the same transaction as the
+    event's writes, so an event and its key are saved together or not at all.
+    """
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, ttl_hours: float = IDEMPOTENCY_TTL_HOURS, cache_size: int = IDEMPOTENCY_CACHE_SIZE,
+                 session_factory=None):
+        self.ttl = timedelta(hours=ttl_hours)
+        self.cache_size = cache_size
+        self.session_factory = session_factory or database.SessionLocal
+        self._recent = OrderedDict()  # (user_id, key) -> seen_at
+        self._lock = threading.Lock()
+        self._last_prune = None
+
+    def _cutoff(self) -> datetime:
+        return datetime.now(timezone.utc) - self.ttl
+
+    def is_duplicate(self, db: Session, user_id: int, key: str) -> bool:
+        with self._lock:
+            seen_at = self._recent.get((user_id, key))
+            if seen_at is not None:
+                if seen_at >= self._cutoff():
+                    self._recent.move_to_end((user_id, key))
+                    return True
+                del self._recent[(user_id, key)]
+
+        row = db.get(models.IdempotencyKey, (user_id, key))
+        if row is None:
+            return False
+        created_at = row.created_at if row.created_at.tzinfo else row.created_at.replace(tzinfo=timezone.utc)
+        if created_at < self._cutoff():
+            return False
+        self.remember(user_id, key, created_at)
+        return True
+
+    def claim(self, db: Session, user_id: int, key: str):
+        """
+        Adds the key to the session; it is saved by the commit that saves the event. Does not
+        commit and writes nothing before that commit, so the event's own work (e.g. fetching a
+        new food) runs before this transaction takes the write lock.
+        """
+        now = datetime.now(timezone.utc)
+        if self._last_prune is None or (now - self._last_prune).total_seconds() > self.PRUNE_INTERVAL:
+            self._last_prune = now
+            self.schedule_prune()
+        existing = db.get(models.IdempotencyKey, (user_id, key))
+        if existing:
+            # Expired but not pruned yet: reuse the row
+            existing.created_at = now
+        else:
+            db.add(models.IdempotencyKey(user_id=user_id, key=key, created_at=now))
+
+    def remember(self, user_id: int, key: str, seen_at: datetime = None):
+        """Call after the claiming transaction committed."""
+        with self._lock:
+            self._recent[(user_id, key)] = seen_at or datetime.now(timezone.utc)
+            self._recent.move_to_end((user_id, key))
+            while len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+
+    def schedule_prune(self):
+        return _prune_executor.submit(self.prune_expired)
+
+    def prune_expired(self) -> int:
+        """Deletes expired keys in a short transaction of its own."""
+        db = self.session_factory()
+        try:
+            count = self.prune(db)
+            db.commit()
+            return count
+        except Exception as e:
+            logger.error(f"Failed to prune idempotency keys: {e}")
+            db.rollback()
+            return 0
+        finally:
+            db.close()
+
+    def prune(self, db: Session) -> int:
+        return db.query(models.IdempotencyKey).filter(
+            models.IdempotencyKey.created_at < self._cutoff()
+        ).delete(synchronize_session=False)
+
+idempotency = IdempotencyService()
+
+class WebhookBatchService:
+    """
+    Applies a list of webhook events in one transaction. Every event is validated first;
+    events that are invalid or cannot be applied are reported and skipped, the rest are
+    committed together, with DailyLog totals aggregated across the whole batch.
+    """
+    PAYLOADS = {
+        schemas.WebhookDataType.BLOOD_PRESSURE: schemas.BPPayload,
+        schemas.WebhookDataType.MEDICATION_TAKEN: schemas.MedicationTakenPayload,
+        schemas.WebhookDataType.EXERCISE_SESSION: schemas.ExercisePayload,
+        schemas.WebhookDataType.FOOD_LOG: schemas.FoodLogPayload,
+        schemas.WebhookDataType.WEIGHT: schemas.WeightPayload,
+    }
+
+    def parse(self, event: dict):
+        """Returns (data_type, payload model) for a raw event; raises ValidationError."""
+        envelope = schemas.WebhookPayload(**event)
+        model = self.PAYLOADS[envelope.data_type]
+        if envelope.data_type == schemas.WebhookDataType.FOOD_LOG and "items" in envelope.payload:
+            model = schemas.FoodLogBatchPayload
+        return envelope.data_type, model(**envelope.payload)
+
+    def process(self, db: Session, user: models.User, events: List[dict], commit: bool = True,
+                received_at: List[datetime] = None, isolate: bool = False) -> List[dict]:
+        """
+        Returns one result per event. An event may carry an `idempotency_key`; events whose
+        key was already processed (or appears earlier in the batch) get status "duplicate".
+        With commit=False everything is flushed but the caller commits.
+
+        Each event is applied in its own savepoint, so a failed event leaves nothing behind.
+        `received_at` (one per event) timestamps events that do not carry their own time,
+        for events applied later than they arrived. With `isolate`, an event that raises is
+        reported as an error instead of aborting the batch; database errors (e.g. busy)
+        still abort it.
+        """
+        results, parsed = [], []
+        for index, event in enumerate(events):
+            try:
+                parsed.append((index, event.get("idempotency_key"), *self.parse(event)))
+                results.append(None)
+            except ValidationError as e:
+                detail = "; ".join(f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors())
+                results.append({"index": index, "status": "error", "detail": detail})
+
+        health, meds = HealthLogService(), MedicationService()
+        daily = DailyLogDeltas()
+        claimed = set()
         try:
-            user_tz = zoneinfo.ZoneInfo(user.timezone) if user.timezone else timezone.utc
+            for index, key, data_type, data in parsed:
+                if key and (key in claimed or idempotency.is_duplicate(db, user.user_id, key)):
+                    results[index] = {"index": index, "status": "duplicate", "message": "Duplicate event ignored"}
+                    continue
+                timestamp = received_at[index] if received_at else None
+                event_daily = DailyLogDeltas()
+                pending_foods = len(db.info.get(RECENT_FOODS_KEY, ()))
+                savepoint = db.begin_nested()
+                try:
+                    result = self._apply(db, user, data_type, data, health, meds, event_daily, timestamp)
+                except OperationalError:
+                    raise
+                except Exception as e:
+                    if not isolate:
+                        raise
+                    logger.warning(f"Webhook event {index} for user {user.user_id} failed: {e}")
+                    result = {"status": "error", "detail": str(e)[:500]}
+                result["index"] = index
+                results[index] = result
+                if result["status"] != "success":
+                    savepoint.rollback()
+                    del db.info.get(RECENT_FOODS_KEY, [])[pending_foods:]
+                    continue
+                savepoint.commit()
+                daily.merge(event_daily)
+                if key:
+                    idempotency.claim(db, user.user_id, key)
+                    claimed.add(key)
+            daily.apply(db)
+            if not commit:
+                db.flush()
+                return results
+            db.commit()
         except Exception:
-            user_tz = timezone.utc
+            db.rollback()
+            raise
+        for key in claimed:
+            idempotency.remember(user.user_id, key)
+        return results
 
-        # [FIXED INDENTATION HERE]
-        end_date = get_user_local_date(user, datetime.now(timezone.utc)) - timedelta(days=1)
-        start_date = end_date - timedelta(days=29)
+    def _apply(self, db, user, data_type, data, health, meds, daily, timestamp=None) -> dict:
+        if data_type == schemas.WebhookDataType.BLOOD_PRESSURE:
+            health.log_bp(db, user.user_id, data, commit=False, timestamp=timestamp)
+            return {"status": "success", "message": "Blood pressure logged"}
 
-        # Get active medications
-        meds = db.query(models.Medication).filter(models.Medication.user_id == user.user_id).all()
-        if not meds:
-            return {"compliance_percentage": 0, "missed_doses": 0, "taken_doses": 0, "total_scheduled": 0, "medications": []}
-            
-        start_dt = datetime.combine(start_date, time.min).replace(tzinfo=user_tz)
-        end_dt = datetime.combine(end_date + timedelta(days=1), time.min).replace(tzinfo=user_tz)
-        
-        logs = db.query(models.MedDoseLog).filter(
-            models.MedDoseLog.user_id == user.user_id,
-            models.MedDoseLog.timestamp_taken >= start_dt,
-            models.MedDoseLog.timestamp_taken < end_dt
-        ).all()
+        if data_type == schemas.WebhookDataType.MEDICATION_TAKEN:
+            log, alert = meds.log_dose(db, user.user_id, data.med_name, data.timestamp or timestamp,
+                                       med_window=data.med_window, commit=False)
+            if not log:
+                return {"status": "error", "detail": alert}
+            return {"status": "success", "message": "Medication logged", "alert": alert}
 
-        windows = [
-            ("morning", user.window_morning_start or time(6, 0)),
-            ("afternoon", user.window_afternoon_start or time(12, 0)),
-            ("evening", user.window_evening_start or time(17, 0)),
-            ("bedtime", user.window_bedtime_start or time(21, 0))
-        ]
-        windows.sort(key=lambda x: x[1])
-
-        def get_window_and_date(ts: datetime):
-            if ts.tzinfo is None: ts = ts.replace(tzinfo=timezone.utc)
-            ts_local = ts.astimezone(user_tz)
-            t = ts_local.time()
-            d = ts_local.date()
-            matched_window = None
-            for w_name, w_start in windows:
-                if t >= w_start:
-                    matched_window = w_name
-                else:
-                    break
-            if matched_window:
-                return matched_window, d
+        if data_type == schemas.WebhookDataType.EXERCISE_SESSION:
+            health.log_exercise(db, user, data, commit=False, daily=daily, timestamp=timestamp)
+            return {"status": "success", "message": "Exercise logged"}
+
+        if data_type == schemas.WebhookDataType.FOOD_LOG:
+            if isinstance(data, schemas.FoodLogBatchPayload):
+                items, meal_id = data.items, data.meal_id
             else:
-                return windows[-1][0], d - timedelta(days=1)
-
-        taken_set = set()
-        for log in logs:
-            if log.dose_window:
-                w_name = log.dose_window
-                # Date logic: If explicit bedtime dose is taken early morning (before morning window),
-                # attribute it to previous day.
-                # Note: get_window_and_date logic handles this for inferred windows.
-                # We need similar logic here for explicit windows.
-                if log.timestamp_taken.tzinfo is None:
-                     ts = log.timestamp_taken.replace(tzinfo=timezone.utc)
-                else:
-                     ts = log.timestamp_taken
-                ts_local = ts.astimezone(user_tz)
-                w_date = ts_local.date()
-
-                morning_start = windows[0][1] # First window is morning
-
-                if w_name == "bedtime" and ts_local.time() < morning_start:
-                     w_date -= timedelta(days=1)
+                items, meal_id = [data], None
+            logs, error = health.log_food_batch(db, user, items, meal_id=meal_id, commit=False, daily=daily,
+                                                timestamp=timestamp)
+            if error:
+                return {"status": "error", "detail": error}
+            return {"status": "success", "message": "Food logged"}
+
+        health.log_weight(db, user, data, commit=False)
+        return {"status": "success", "message": "Weight logged"}
+
+class DailyLogRebuildService:
+    """
+    Recomputes DailyLog aggregates from exercise_logs and food_item_logs and
+    reports where the stored totals had drifted.
+    """
+    WATERMARK_KEY = "daily_log_rebuild_watermark"
+    TOLERANCE = 0.01
+    FIELDS = ("total_calories_consumed", "total_calories_burned", "total_protein",
+              "total_fat", "total_carbs", "total_fiber", "food_item_count")
+
+    def rebuild(self, db: Session, user_id: int = None, start_date: date = None, end_date: date = None,
+                incremental: bool = False, dry_run: bool = False, max_reported: int = 100) -> dict:
+        """
+        Rebuilds one user (or everyone) over a local date range (default: all history).
+        With `incremental`, only days touched by logs added since the last run's
+        watermark are rebuilt. With `dry_run`, discrepancies are reported but not fixed.
+        """
+        query = db.query(models.User)
+        if user_id is not None:
+            query = query.filter(models.User.user_id == user_id)
+        users = query.all()
+
+        watermark = self._get_watermark(db)
+        new_watermark = {
+            "exercise_id": db.query(func.max(models.ExerciseLog.exercise_id)).scalar() or 0,
+            "item_log_id": db.query(func.max(models.FoodItemLog.item_log_id)).scalar() or 0,
+        }
+
+        report = {"users": 0, "days_checked": 0, "days_updated": 0, "discrepancy_count": 0, "discrepancies": []}
+        for user in users:
+            if incremental:
+                user_range = self._incremental_range(db, user, watermark)
             else:
-                w_name, w_date = get_window_and_date(log.timestamp_taken)
+                user_range = self._full_range(db, user)
+            if not user_range:
+                continue
+            first, last = user_range
+            if start_date: first = max(first, start_date)
+            if end_date: last = min(last, end_date)
+            if first > last:
+                continue
 
-            if start_date <= w_date <= end_date:
-                taken_set.add((log.med_id, w_name, w_date))
+            report["users"] += 1
+            self._rebuild_user_range(db, user, first, last, dry_run, report, max_reported)
 
-        total_expected = 0
-        total_taken = 0
-        med_stats = {med.med_id: {"name": med.name, "taken": 0, "expected": 0} for med in meds}
-
-        current_d = start_date
-        while current_d <= end_date:
-            for med in meds:
-                # Check active range
-                # If start_date is set, ignore if current_d < start_date
-                # Note: start_date is inclusive
-                if med.start_date and current_d < med.start_date:
-                    continue
-                # If end_date is set, ignore if current_d > end_date
-                # Note: end_date is inclusive
-                if med.end_date and current_d > med.end_date:
-                    continue
+        if not dry_run:
+            if user_id is None and start_date is None and end_date is None:
+                self._set_watermark(db, new_watermark)
+            db.commit()
+        else:
+            db.rollback()
+        report["watermark"] = new_watermark if not dry_run else watermark
+        return report
 
-                schedule = []
-                if med.schedule_morning: schedule.append("morning")
-                if med.schedule_afternoon: schedule.append("afternoon")
-                if med.schedule_evening: schedule.append("evening")
-                if med.schedule_bedtime: schedule.append("bedtime")
-                for w in schedule:
-                    total_expected += 1
-                    med_stats[med.med_id]["expected"] += 1
-                    if (med.med_id, w, current_d) in taken_set:
-                        total_taken += 1
-                        med_stats[med.med_id]["taken"] += 1
-            current_d += timedelta(days=1)
+    def _get_watermark(self, db: Session) -> dict:
+        config = db.query(models.SystemConfig).filter(models.SystemConfig.key == self.WATERMARK_KEY).first()
+        if config and config.value:
+            return json.loads(config.value)
+        return {"exercise_id": 0, "item_log_id": 0}
 
-        percentage = (total_taken / total_expected * 100) if total_expected > 0 else 0.0
-        missed = total_expected - total_taken
-        medications_list = []
-        for mid, stats in med_stats.items():
-            exp = stats["expected"]
-            tak = stats["taken"]
-            pct = (tak / exp * 100) if exp > 0 else 100.0
-            med = next((m for m in meds if m.med_id == mid), None)
-            schedule_str = []
-            if med:
-                if med.schedule_morning: schedule_str.append("M")
-                if med.schedule_afternoon: schedule_str.append("A")
-                if med.schedule_evening: schedule_str.append("E")
-                if med.schedule_bedtime: schedule_str.append("B")
-            medications_list.append({
-                "name": stats["name"], "compliance_percentage": round(pct, 1),
-                "taken": tak, "expected": exp, "missed": exp - tak, "schedule": ", ".join(schedule_str)
+    def _set_watermark(self, db: Session, watermark: dict):
+        config = db.query(models.SystemConfig).filter(models.SystemConfig.key == self.WATERMARK_KEY).first()
+        if not config:
+            config = models.SystemConfig(key=self.WATERMARK_KEY)
+            db.add(config)
+        config.value = json.dumps(watermark)
+
+    def _local_range(self, user: models.User, bounds) -> tuple:
+        # bounds alternate (min, max) pairs of timestamps or dates
+        def as_date(value):
+            return get_user_local_date(user, value) if isinstance(value, datetime) else value
+
+        lows = [as_date(b) for b in bounds[0::2] if b is not None]
+        highs = [as_date(b) for b in bounds[1::2] if b is not None]
+        if not lows:
+            return None
+        return min(lows), max(highs)
+
+    def _full_range(self, db: Session, user: models.User):
+        ex = db.query(func.min(models.ExerciseLog.timestamp), func.max(models.ExerciseLog.timestamp)).filter(
+            models.ExerciseLog.user_id == user.user_id).one()
+        food = db.query(func.min(models.FoodItemLog.timestamp), func.max(models.FoodItemLog.timestamp)).filter(
+            models.FoodItemLog.user_id == user.user_id).one()
+        daily = db.query(func.min(models.DailyLog.date), func.max(models.DailyLog.date)).filter(
+            models.DailyLog.user_id == user.user_id).one()
+        return self._local_range(user, (*ex, *food, *daily))
+
+    def _incremental_range(self, db: Session, user: models.User, watermark: dict):
+        ex = db.query(func.min(models.ExerciseLog.timestamp), func.max(models.ExerciseLog.timestamp)).filter(
+            models.ExerciseLog.user_id == user.user_id,
+            models.ExerciseLog.exercise_id > watermark.get("exercise_id", 0)).one()
+        food = db.query(func.min(models.FoodItemLog.timestamp), func.max(models.FoodItemLog.timestamp)).filter(
+            models.FoodItemLog.user_id == user.user_id,
+            models.FoodItemLog.item_log_id > watermark.get("item_log_id", 0)).one()
+        return self._local_range(user, (*ex, *food))
+
+    def _load_days(self, db: Session, user: models.User, first: date, last: date):
+        user_tz = get_user_tz(user)
+        conn = db.connection()
+        _rebuild_days.create(conn, checkfirst=True)
+        conn.execute(_rebuild_days.delete())
+
+        rows = []
+        d = first
+        while d <= last:
+            start = datetime.combine(d, time.min).replace(tzinfo=user_tz).astimezone(timezone.utc)
+            end = datetime.combine(d + timedelta(days=1), time.min).replace(tzinfo=user_tz).astimezone(timezone.utc)
+            rows.append({"local_date": d, "utc_start": start.replace(tzinfo=None), "utc_end": end.replace(tzinfo=None)})
+            d += timedelta(days=1)
+        conn.execute(_rebuild_days.insert(), rows)
+        return rows[0]["utc_start"], rows[-1]["utc_end"]
+
+    def _rebuild_user_range(self, db: Session, user: models.User, first: date, last: date,
+                            dry_run: bool, report: dict, max_reported: int):
+        utc_start, utc_end = self._load_days(db, user, first, last)
+        days = _rebuild_days.c
+        F, N, E = models.FoodItemLog, models.NutritionCache, models.ExerciseLog
+        multiplier = F.serving_size * F.quantity
+
+        # Each day drives an index range scan on (user_id, timestamp)
+        food_rows = db.query(
+            days.local_date,
+            # Logged values, falling back to the cached food for logs that predate snapshots
+            func.sum(func.coalesce(F.calories, N.calories, 0) * multiplier),
+            func.sum(func.coalesce(F.protein, N.protein, 0) * multiplier),
+            func.sum(func.coalesce(F.fat, N.fat, 0) * multiplier),
+            func.sum(func.coalesce(F.carbs, N.carbs, 0) * multiplier),
+            func.sum(func.coalesce(F.fiber, N.fiber, 0) * multiplier),
+            func.count(F.item_log_id)
+        ).select_from(_rebuild_days).join(F, and_(
+            F.user_id == user.user_id,
+            F.timestamp >= days.utc_start,
+            F.timestamp < days.utc_end
+        )).join(N, N.food_id == F.food_id).group_by(days.local_date).all()
+
+        exercise_rows = db.query(
+            days.local_date, func.sum(E.calories_burned)
+        ).select_from(_rebuild_days).join(E, and_(
+            E.user_id == user.user_id,
+            E.timestamp >= days.utc_start,
+            E.timestamp < days.utc_end
+        )).group_by(days.local_date).all()
+
+        actual = {}
+        for local_date, cals, protein, fat, carbs, fiber, count in food_rows:
+            actual[local_date] = dict(zip(self.FIELDS, (cals or 0, 0.0, protein or 0, fat or 0, carbs or 0, fiber or 0, count)))
+        for local_date, burned in exercise_rows:
+            actual.setdefault(local_date, dict.fromkeys(self.FIELDS, 0))["total_calories_burned"] = burned or 0
+
+        stored = {
+            row.date: {field: getattr(row, field) or 0 for field in self.FIELDS}
+            for row in db.query(models.DailyLog).filter(
+                models.DailyLog.user_id == user.user_id,
+                models.DailyLog.date >= first,
+                models.DailyLog.date <= last
+            )
+        }
+
+        zero = dict.fromkeys(self.FIELDS, 0)
+        fixes = []
+        report["days_checked"] += (last - first).days + 1
+        for local_date in sorted(set(actual) | set(stored)):
+            want = actual.get(local_date, zero)
+            have = stored.get(local_date)
+            diffs = {
+                field: {"stored": (have or zero)[field], "actual": want[field]}
+                for field in self.FIELDS
+                if abs((have or zero)[field] - want[field]) > self.TOLERANCE
+            }
+            if have is not None and not diffs:
+                continue
+            if have is None and want == zero:
+                continue
+            fixes.append({"user_id": user.user_id, "date": local_date, **want})
+            if diffs:
+                report["discrepancy_count"] += 1
+                if len(report["discrepancies"]) < max_reported:
+                    report["discrepancies"].append({"user_id": user.user_id, "date": local_date.isoformat(), "fields": diffs})
+
+        if fixes and not dry_run:
+            stmt = sqlite_insert(models.DailyLog.__table__)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[models.DailyLog.user_id, models.DailyLog.date],
+                set_={field: getattr(stmt.excluded, field) for field in self.FIELDS}
+            )
+            db.execute(stmt, fixes)
+            database.mark_user_changed(db, user.user_id)
+            report["days_updated"] += len(fixes)
+
+# Per-connection scratch table of chart buckets (one or more local days each) and
+# their UTC bounds, so readings can be aggregated per bucket inside SQL.
+_chart_buckets = Table(
+    "tmp_bp_chart_buckets", MetaData(),
+    Column("bucket_start", Date, primary_key=True),
+    Column("utc_start", DateTime),
+    Column("utc_end", DateTime),
+    prefixes=["TEMPORARY"]
+)
+
+def lttb(xs: List[float], ys: List[float], threshold: int) -> List[int]:
+    """
+    Largest-Triangle-Three-Buckets: indices of `threshold` points that preserve the
+    visual shape of the series. Always keeps the first and last point.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    every = (n - 2) / (threshold - 2)
+    picked = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third corner of the triangle
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+
+        ax, ay = xs[a], ys[a]
+        best_area, best = -1.0, None
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best_area, best = area, j
+        picked.append(best)
+        a = best
+    picked.append(n - 1)
+    return picked
+
+class BPChartService:
+    """
+    Blood pressure series for charts, reduced to at most `points` points however many
+    readings there are: either min/mean/max per bucket of local days, aggregated in
+    SQL, or the readings picked by LTTB. Series are returned column-wise.
+    """
+    METHODS = ("bucket", "lttb")
+    RESOLUTIONS = {"auto": None, "day": 1, "week": 7}
+
+    def resolve_range(self, user: models.User, days: int = 365, start_date: date = None, end_date: date = None):
+        """Defaults to the `days` local days up to and including today."""
+        today = get_user_local_date(user, datetime.now(timezone.utc))
+        return resolve_date_range(days, start_date, end_date, today, BP_CHART_MAX_DAYS)
+
+    def series(self, db: Session, user: models.User, start_date: date, end_date: date, points: int = BP_CHART_POINTS,
+               method: str = "bucket", resolution: str = "auto") -> dict:
+        if method not in self.METHODS:
+            raise ValueError(f"method must be one of {', '.join(self.METHODS)}")
+        if resolution not in self.RESOLUTIONS:
+            raise ValueError(f"resolution must be one of {', '.join(self.RESOLUTIONS)}")
+        if method == "lttb":
+            return self._lttb(db, user, start_date, end_date, points)
+        return self._buckets(db, user, start_date, end_date, points, self.RESOLUTIONS[resolution])
+
+    def bucket_days(self, start_date: date, end_date: date, points: int) -> int:
+        """Daily buckets if they fit in `points`, otherwise whole weeks."""
+        days = (end_date - start_date).days + 1
+        if days <= points:
+            return 1
+        weeks = -(-days // 7) + 1  # +1: the range need not start on a Monday
+        return 7 * -(-weeks // points)
+
+    def _buckets(self, db: Session, user: models.User, start_date: date, end_date: date, points: int,
+                 width: Optional[int]) -> dict:
+        width = width or self.bucket_days(start_date, end_date, points)
+        first = start_date - timedelta(days=start_date.weekday()) if width % 7 == 0 else start_date
+        if -(-((end_date - first).days + 1) // width) > points:
+            raise ValueError(f"More than {points} buckets; use a coarser resolution or a shorter range")
+
+        user_tz = get_user_tz(user)
+
+        def utc(d: date) -> datetime:
+            return datetime.combine(d, time.min).replace(tzinfo=user_tz).astimezone(timezone.utc).replace(tzinfo=None)
+
+        rows = []
+        d = first
+        while d <= end_date:
+            # The first and last buckets are clipped to the requested range
+            rows.append({
+                "bucket_start": d, "utc_start": utc(max(d, start_date)),
+                "utc_end": utc(min(d + timedelta(days=width), end_date + timedelta(days=1)))
             })
+            d += timedelta(days=width)
+        conn = db.connection()
+        _chart_buckets.create(conn, checkfirst=True)
+        conn.execute(_chart_buckets.delete())
+        conn.execute(_chart_buckets.insert(), rows)
+
+        buckets = _chart_buckets.c
+        BP = models.BloodPressure
+        # Each bucket drives an index range scan on (user_id, timestamp)
+        result = db.query(
+            buckets.bucket_start, func.count(BP.bp_id),
+            func.min(BP.systolic), func.avg(BP.systolic), func.max(BP.systolic),
+            func.min(BP.diastolic), func.avg(BP.diastolic), func.max(BP.diastolic),
+            func.avg(BP.pulse)
+        ).select_from(_chart_buckets).join(BP, and_(
+            BP.user_id == user.user_id,
+            BP.timestamp >= buckets.utc_start,
+            BP.timestamp < buckets.utc_end
+        )).group_by(buckets.bucket_start).order_by(buckets.bucket_start).all()
+        conn.execute(_chart_buckets.delete())
+
+        columns = ("date", "count", "systolic_min", "systolic_mean", "systolic_max",
+                   "diastolic_min", "diastolic_mean", "diastolic_max", "pulse_mean")
+        series = {column: [] for column in columns}
+        for row in result:
+            for column, value in zip(columns, row):
+                series[column].append(round(value, 1) if isinstance(value, float) else value)
         return {
-            "compliance_percentage": round(percentage, 1), "missed_doses": missed,
-            "taken_doses": total_taken, "total_scheduled": total_expected,
-            "medications": medications_list
+            "start_date": start_date, "end_date": end_date, "method": "bucket",
+            "bucket_days": width, "series": series
         }
 
+    def _lttb(self, db: Session, user: models.User, start_date: date, end_date: date, points: int) -> dict:
+        user_tz = get_user_tz(user)
+        start = datetime.combine(start_date, time.min).replace(tzinfo=user_tz).astimezone(timezone.utc)
+        end = datetime.combine(end_date + timedelta(days=1), time.min).replace(tzinfo=user_tz).astimezone(timezone.utc)
+        BP = models.BloodPressure
+        readings = db.query(BP.timestamp, BP.systolic, BP.diastolic, BP.pulse).filter(
+            BP.user_id == user.user_id,
+            BP.timestamp >= start.replace(tzinfo=None),
+            BP.timestamp < end.replace(tzinfo=None),
+            BP.systolic.isnot(None)
+        ).order_by(BP.timestamp).all()
+
+        timestamps = [r.timestamp.replace(tzinfo=timezone.utc) for r in readings]
+        picked = lttb([ts.timestamp() for ts in timestamps], [r.systolic for r in readings], points)
+        return {
+            "start_date": start_date, "end_date": end_date, "method": "lttb", "readings": len(readings),
+            "series": {
+                "timestamp": [timestamps[i] for i in picked],
+                "systolic": [readings[i].systolic for i in picked],
+                "diastolic": [readings[i].diastolic for i in picked],
+                "pulse": [readings[i].pulse for i in picked],
+            }
+        }
+
+class OpenFoodFactsImportService:
+    """
+    Streams an Open Food Facts export (JSONL or tab-separated CSV, optionally gzipped)
+    into nutrition_cache in batched upserts, using the same nutriment rules as get_product.
+    """
+    CHECKPOINT_KEY = "off_import_checkpoint"
+    CSV_NUTRIMENTS = ("energy-kcal_100g", "energy-kj_100g", "proteins_100g", "fat_100g",
+                      "carbohydrates_100g", "fiber_100g")
+
+    def open_records(self, path: str, delimiter: str = "\t", skip: int = 0):
+        """
+        Yields OFF product dicts (None for unreadable lines) one at a time, so memory use does
+        not depend on the dump size. The first `skip` records are passed over without parsing.
+        """
+        opener = gzip.open if path.endswith(".gz") else open
+        name = path[:-3] if path.endswith(".gz") else path
+        with opener(path, "rt", encoding="utf-8", newline="") as f:
+            if name.endswith(".csv") or name.endswith(".tsv"):
+                csv.field_size_limit(sys.maxsize)
+                reader = csv.reader(f, delimiter=delimiter)
+                header = next(reader, [])
+                for index, fields in enumerate(reader):
+                    if index < skip:
+                        continue
+                    row = dict(zip(header, fields))
+                    yield {
+                        "code": row.get("code"),
+                        "product_name": row.get("product_name") or "Unknown",
+                        "nutriments": {key: row[key] for key in self.CSV_NUTRIMENTS if row.get(key)},
+                    }
+            else:
+                for index, line in enumerate(f):
+                    if index < skip:
+                        continue
+                    line = line.strip()
+                    if not line:
+                        yield None
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield None
+
+    def import_file(self, db: Session, path: str, batch_size: int = 5000, resume: bool = True,
+                    delimiter: str = "\t", progress=None) -> dict:
+        """
+        Imports every product with a barcode. Existing OFF entries are updated, entries of
+        other sources (e.g. MANUAL) are left alone; food logs keep the nutrition they were
+        logged with. Each batch commits together with a checkpoint, so an interrupted import
+        continues where it stopped when run again.
+        """
+        source = {"path": os.path.abspath(path), "size": os.path.getsize(path)}
+        checkpoint = self._get_checkpoint(db) if resume else None
+        skip = checkpoint["records"] if checkpoint and checkpoint.get("source") == source else 0
+
+        table = models.NutritionCache.__table__
+        upsert = sqlite_insert(table)
+        columns = ("food_name", "calories", "protein", "fat", "carbs", "fiber", "source", "fetched_at")
+        stmt = upsert.on_conflict_do_update(
+            index_elements=[table.c.barcode],
+            set_={col: upsert.excluded[col] for col in columns},
+            where=table.c.source == "OFF",
+        )
+
+        stats = {"records": skip, "imported": 0, "skipped": 0, "resumed_from": skip}
+        batch = []
+
+        def flush():
+            if batch:
+                db.execute(stmt, batch)
+                stats["imported"] += len(batch)
+                batch.clear()
+            self._set_checkpoint(db, {"source": source, "records": stats["records"]})
+            db.commit()
+            if progress:
+                progress(stats)
+
+        fetched_at = datetime.now(timezone.utc)
+        for product in self.open_records(path, delimiter, skip):
+            stats["records"] += 1
+            barcode = str(product.get("code") or "").strip() if isinstance(product, dict) else ""
+            if not barcode:
+                stats["skipped"] += 1
+                continue
+            values = parse_off_product(barcode, product)
+            values["fetched_at"] = fetched_at
+            batch.append(values)
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+
+        self._clear_checkpoint(db)
+        db.commit()
+        return stats
+
+    def _get_checkpoint(self, db: Session):
+        config = db.query(models.SystemConfig).filter(models.SystemConfig.key == self.CHECKPOINT_KEY).first()
+        return json.loads(config.value) if config and config.value else None
+
+    def _set_checkpoint(self, db: Session, checkpoint: dict):
+        config = db.query(models.SystemConfig).filter(models.SystemConfig.key == self.CHECKPOINT_KEY).first()
+        if not config:
+            config = models.SystemConfig(key=self.CHECKPOINT_KEY)
+            db.add(config)
+        config.value = json.dumps(checkpoint)
+
+    def _clear_checkpoint(self, db: Session):
+        db.query(models.SystemConfig).filter(models.SystemConfig.key == self.CHECKPOINT_KEY).delete()
+
 class BackupService:
     CONFIG_KEY = "backup_encryption_key"
     BACKUP_DIR = "backups"
@@ -464,6 +1808,8 @@ class BackupService:
         filename = f"backup_{timestamp}.enc"
         filepath = os.path.join(self.BACKUP_DIR, filename)
         fernet = Fernet(self._derive_fernet_key(key_str))
+        # Recent commits may still live in the WAL file
+        database.checkpoint()
         with open(self.DB_FILE, "rb") as f:
             data = f.read()
         encrypted_data = fernet.encrypt(data)
@@ -482,6 +1828,10 @@ class BackupService:
         backup_path = self.DB_FILE + ".bak"
         if os.path.exists(self.DB_FILE):
             shutil.move(self.DB_FILE, backup_path)
+        # A leftover WAL would be replayed on top of the restored file
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(self.DB_FILE + suffix):
+                os.remove(self.DB_FILE + suffix)
         with open(self.DB_FILE, "wb") as f:
             f.write(decrypted_data)
         return True
@@ -1,6 +1,48 @@
 import sqlite3
 import os
 
+def backfill_daily_macros(cursor):
+    """Fills the new daily_logs macro columns from existing food logs, bucketed by each user's local date."""
+    from datetime import datetime, timezone
+    import zoneinfo
+
+    cursor.execute("SELECT user_id, timezone FROM users")
+    user_tz = {}
+    for user_id, tz_name in cursor.fetchall():
+        try:
+            user_tz[user_id] = zoneinfo.ZoneInfo(tz_name) if tz_name else timezone.utc
+        except Exception:
+            user_tz[user_id] = timezone.utc
+
+    cursor.execute("""
+        SELECT f.user_id, f.timestamp, f.serving_size * f.quantity,
+               COALESCE(n.protein, 0), COALESCE(n.fat, 0), COALESCE(n.carbs, 0), COALESCE(n.fiber, 0)
+        FROM food_item_logs f JOIN nutrition_cache n ON n.food_id = f.food_id
+    """)
+    totals = {}
+    for user_id, ts, multiplier, protein, fat, carbs, fiber in cursor.fetchall():
+        if not ts or multiplier is None:
+            continue
+        utc_dt = datetime.fromisoformat(ts).replace(tzinfo=timezone.utc)
+        local_date = utc_dt.astimezone(user_tz.get(user_id, timezone.utc)).date().isoformat()
+        t = totals.setdefault((user_id, local_date), [0.0, 0.0, 0.0, 0.0, 0])
+        t[0] += protein * multiplier
+        t[1] += fat * multiplier
+        t[2] += carbs * multiplier
+        t[3] += fiber * multiplier
+        t[4] += 1
+
+    cursor.executemany("""
+        INSERT INTO daily_logs (user_id, date, total_calories_consumed, total_calories_burned,
+                                total_protein, total_fat, total_carbs, total_fiber, food_item_count)
+        VALUES (?, ?, 0, 0, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, date) DO UPDATE SET
+            total_protein = excluded.total_protein, total_fat = excluded.total_fat,
+            total_carbs = excluded.total_carbs, total_fiber = excluded.total_fiber,
+            food_item_count = excluded.food_item_count
+    """, [(user_id, d, *t) for (user_id, d), t in totals.items()])
+    print(f" - Backfilled macro totals for {len(totals)} days.")
+
 def migrate_all():
     db_path = 'health_app.db'
     if not os.path.exists(db_path):
@@ -183,6 +225,166 @@ def migrate_all():
     except sqlite3.OperationalError:
         pass
 
+    # 12. Unique API key hashes
+    cursor.execute("PRAGMA index_list(api_keys)")
+    unique_indexes = {row[1]: row[2] for row in cursor.fetchall()}
+    if not unique_indexes.get("ix_api_keys_hashed_key"):
+        try:
+            cursor.execute("DROP INDEX IF EXISTS ix_api_keys_hashed_key")
+            cursor.execute("CREATE UNIQUE INDEX ix_api_keys_hashed_key ON api_keys (hashed_key)")
+            print(" - Added unique index on api_keys.hashed_key.")
+        except sqlite3.Error as e:
+            print(f"Error creating unique index on api_keys.hashed_key (duplicate keys?): {e}")
+            cursor.execute("CREATE INDEX IF NOT EXISTS ix_api_keys_hashed_key ON api_keys (hashed_key)")
+
+    # 13. Time-series indexes
+    # daily_logs gets a unique (user_id, date) index, so fold any duplicate rows first
+    cursor.execute("""
+        UPDATE daily_logs SET
+            total_calories_consumed = (SELECT SUM(d.total_calories_consumed) FROM daily_logs d
+                                       WHERE d.user_id = daily_logs.user_id AND d.date = daily_logs.date),
+            total_calories_burned = (SELECT SUM(d.total_calories_burned) FROM daily_logs d
+                                     WHERE d.user_id = daily_logs.user_id AND d.date = daily_logs.date)
+        WHERE log_id IN (SELECT MIN(log_id) FROM daily_logs GROUP BY user_id, date HAVING COUNT(*) > 1)
+    """)
+    cursor.execute("DELETE FROM daily_logs WHERE log_id NOT IN (SELECT MIN(log_id) FROM daily_logs GROUP BY user_id, date)")
+    if cursor.rowcount > 0:
+        print(f" - Merged {cursor.rowcount} duplicate daily_logs rows.")
+
+    indexes = [
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_daily_logs_user_id_date ON daily_logs (user_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_blood_pressure_user_id_timestamp ON blood_pressure (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_exercise_logs_user_id_timestamp ON exercise_logs (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_food_item_logs_user_id_timestamp ON food_item_logs (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_med_dose_logs_user_id_timestamp_taken ON med_dose_logs (user_id, timestamp_taken)",
+        "CREATE INDEX IF NOT EXISTS ix_medications_user_id_name ON medications (user_id, name)",
+    ]
+    for sql in indexes:
+        try:
+            cursor.execute(sql)
+        except sqlite3.OperationalError as e:
+            print(f"Error creating index: {e}")
+    cursor.execute("ANALYZE")
+    print(" - Checked time-series indexes.")
+
+    # 14. Daily macro totals
+    cursor.execute("PRAGMA table_info(daily_logs)")
+    daily_columns = [col[1] for col in cursor.fetchall()]
+    macro_cols = [
+        ("total_protein", "FLOAT DEFAULT 0"),
+        ("total_fat", "FLOAT DEFAULT 0"),
+        ("total_carbs", "FLOAT DEFAULT 0"),
+        ("total_fiber", "FLOAT DEFAULT 0"),
+        ("food_item_count", "INTEGER DEFAULT 0")
+    ]
+    added_macros = False
+    for col, type_ in macro_cols:
+        if col not in daily_columns:
+            cursor.execute(f"ALTER TABLE daily_logs ADD COLUMN {col} {type_}")
+            print(f" - Added {col} to daily_logs.")
+            added_macros = True
+    if added_macros:
+        backfill_daily_macros(cursor)
+
+    # 15. Full-text food search
+    cursor.execute("SELECT name FROM sqlite_master WHERE name = 'nutrition_cache_fts'")
+    if not cursor.fetchone():
+        try:
+            cursor.execute("""
+                CREATE VIRTUAL TABLE nutrition_cache_fts USING fts5(
+                    food_name, content='nutrition_cache', content_rowid='food_id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                )
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS nutrition_cache_fts_ai AFTER INSERT ON nutrition_cache BEGIN
+                    INSERT INTO nutrition_cache_fts(rowid, food_name) VALUES (new.food_id, new.food_name);
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS nutrition_cache_fts_ad AFTER DELETE ON nutrition_cache BEGIN
+                    INSERT INTO nutrition_cache_fts(nutrition_cache_fts, rowid, food_name) VALUES ('delete', old.food_id, old.food_name);
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS nutrition_cache_fts_au AFTER UPDATE OF food_name ON nutrition_cache BEGIN
+                    INSERT INTO nutrition_cache_fts(nutrition_cache_fts, rowid, food_name) VALUES ('delete', old.food_id, old.food_name);
+                    INSERT INTO nutrition_cache_fts(rowid, food_name) VALUES (new.food_id, new.food_name);
+                END
+            """)
+            cursor.execute("INSERT INTO nutrition_cache_fts(nutrition_cache_fts) VALUES ('rebuild')")
+            print(" - Added full-text index for food search.")
+        except sqlite3.OperationalError as e:
+            print(f" - Full-text search unavailable (SQLite built without FTS5?), using LIKE search: {e}")
+
+    # 16. Nutrition cache freshness
+    cursor.execute("PRAGMA table_info(nutrition_cache)")
+    nutrition_columns = [col[1] for col in cursor.fetchall()]
+    if "fetched_at" not in nutrition_columns:
+        # Left NULL, so existing OFF entries are refreshed in the background the next time they are used
+        cursor.execute("ALTER TABLE nutrition_cache ADD COLUMN fetched_at DATETIME")
+        print(" - Added fetched_at to nutrition_cache.")
+
+    # 17. Idempotency keys
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            key VARCHAR NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (user_id, key),
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created_at ON idempotency_keys (created_at)")
+
+    # 18. Async webhook outbox
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS webhook_outbox (
+            outbox_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            event VARCHAR,
+            idempotency_key VARCHAR,
+            status VARCHAR DEFAULT 'PENDING',
+            attempts INTEGER DEFAULT 0,
+            last_error VARCHAR,
+            received_at DATETIME,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_webhook_outbox_user_id ON webhook_outbox (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_webhook_outbox_status_outbox_id ON webhook_outbox (status, outbox_id)")
+
+    # 19. Dose adherence ledger (filled in by the app on its next start)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dose_adherence (
+            med_id INTEGER NOT NULL,
+            local_date DATE NOT NULL,
+            user_id INTEGER,
+            windows_taken INTEGER DEFAULT 0,
+            PRIMARY KEY (med_id, local_date),
+            FOREIGN KEY(med_id) REFERENCES medications(med_id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_dose_adherence_user_id_local_date ON dose_adherence (user_id, local_date)")
+
+    # 20. Nutrition snapshot on food logs
+    cursor.execute("PRAGMA table_info(food_item_logs)")
+    food_log_columns = [col[1] for col in cursor.fetchall()]
+    snapshot_columns = ["calories", "protein", "fat", "carbs", "fiber"]
+    missing = [column for column in snapshot_columns if column not in food_log_columns]
+    for column in missing:
+        cursor.execute(f"ALTER TABLE food_item_logs ADD COLUMN {column} FLOAT")
+    if missing:
+        # Existing logs were counted with the cached food's current values
+        cursor.execute(f"""
+            UPDATE food_item_logs SET ({", ".join(snapshot_columns)}) = (
+                SELECT {", ".join(f"COALESCE(n.{column}, 0)" for column in snapshot_columns)}
+                FROM nutrition_cache n WHERE n.food_id = food_item_logs.food_id
+            )
+        """)
+        print(" - Added nutrition snapshot columns to food_item_logs.")
+
     conn.commit()
     conn.close()
     print("All migrations complete.")
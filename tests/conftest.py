@@ -3,7 +3,8 @@ from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from app.main import app
-from app.database import Base, get_db
+from app.database import Base, get_db, configure_sqlite_engine
+from app import auth, models
 import os
 
 @pytest.fixture(scope="module")
@@ -15,9 +16,9 @@ def db_session_factory(request):
     db_filename = f"./test_{request.module.__name__}.db"
     db_url = f"sqlite:///{db_filename}"
 
-    engine = create_engine(
+    engine = configure_sqlite_engine(create_engine(
         db_url, connect_args={"check_same_thread": False}
-    )
+    ))
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
     # Create tables
@@ -29,8 +30,9 @@ def db_session_factory(request):
     Base.metadata.drop_all(bind=engine)
     engine.dispose()
 
-    if os.path.exists(db_filename):
-        os.remove(db_filename)
+    for path in (db_filename, db_filename + "-wal", db_filename + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
 @pytest.fixture(scope="module")
 def client(db_session_factory):
@@ -63,3 +65,30 @@ def session(db_session_factory):
         yield db
     finally:
         db.close()
+
+@pytest.fixture
+def make_user_with_key(session):
+    """
+    Returns make(name, raw_key, med_name=None), which creates a user with a webhook API key
+    and, if med_name is given, a medication with 10 doses in stock.
+    """
+    def make(name, raw_key, med_name=None):
+        user = models.User(name=name, weight_kg=70.0, height_cm=175.0)
+        session.add(user)
+        session.commit()
+        session.add(models.APIKey(user_id=user.user_id, name=f"{name} key", hashed_key=auth.hash_api_key(raw_key)))
+        if med_name:
+            session.add(models.Medication(user_id=user.user_id, name=med_name, current_inventory=10,
+                                          daily_doses=1, refills_remaining=3))
+        session.commit()
+        return user
+    return make
+
+@pytest.fixture
+def auth_headers(client):
+    """Returns make(name), which signs up a user and returns Bearer headers for them."""
+    def make(name):
+        client.post("/api/v1/users/", json={"name": name, "password": "pw123456", "weight_kg": 70, "height_cm": 175})
+        token = client.post("/auth/token", data={"username": name, "password": "pw123456"}).json()["access_token"]
+        return {"Authorization": f"Bearer {token}"}
+    return make
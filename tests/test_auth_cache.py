@@ -0,0 +1,67 @@
+from sqlalchemy import event
+from app import models, auth
+
+def make_key(session, name, raw_key):
+    user = models.User(name=name, weight_kg=70.0, height_cm=170.0)
+    session.add(user)
+    session.commit()
+    key = models.APIKey(user_id=user.user_id, name="Cache Test", hashed_key=auth.hash_api_key(raw_key))
+    session.add(key)
+    session.commit()
+    return user, key
+
+def count_queries(session):
+    statements = []
+    event.listen(session.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+    return statements
+
+def test_cached_key_skips_database(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(auth, "API_KEY_REVOCATION_FILE", str(tmp_path / "stamp"))
+    monkeypatch.setattr(auth, "api_key_cache", auth.APIKeyCache(stamp_file=str(tmp_path / "stamp")))
+    user, _ = make_key(session, "cache_user", "cache_raw_key")
+
+    first = auth.authenticate_api_key(session, "cache_raw_key")
+    assert first.user_id == user.user_id
+
+    statements = count_queries(session)
+    second = auth.authenticate_api_key(session, "cache_raw_key")
+    assert second.user_id == user.user_id
+    assert statements == []
+
+def test_revocation_invalidates_cache(session, tmp_path, monkeypatch):
+    stamp = str(tmp_path / "stamp")
+    monkeypatch.setattr(auth, "API_KEY_REVOCATION_FILE", stamp)
+    monkeypatch.setattr(auth, "api_key_cache", auth.APIKeyCache(stamp_file=stamp))
+    _, key = make_key(session, "revoke_user", "revoke_raw_key")
+
+    assert auth.authenticate_api_key(session, "revoke_raw_key") is not None
+
+    # Simulate a revocation from another process (the CLI): only the stamp file changes
+    session.execute(models.APIKey.__table__.update().where(models.APIKey.key_id == key.key_id).values(is_active=False))
+    session.commit()
+    auth.notify_api_key_revoked()
+
+    assert auth.authenticate_api_key(session, "revoke_raw_key") is None
+
+def test_admin_revoke_endpoint(client, session, tmp_path, monkeypatch):
+    stamp = str(tmp_path / "stamp")
+    monkeypatch.setattr(auth, "API_KEY_REVOCATION_FILE", stamp)
+    monkeypatch.setattr(auth, "api_key_cache", auth.APIKeyCache(stamp_file=stamp))
+    target, key = make_key(session, "admin_revoke_target", "admin_revoke_raw_key")
+
+    client.post("/api/v1/users/", json={"name": "cache_admin", "password": "adminpass", "weight_kg": 70, "height_cm": 175})
+    admin = session.query(models.User).filter(models.User.name == "cache_admin").first()
+    admin.is_admin = True
+    session.commit()
+    token = client.post("/auth/token", data={"username": "cache_admin", "password": "adminpass"}).json()["access_token"]
+
+    webhook_headers = {"X-Webhook-Secret": "admin_revoke_raw_key"}
+    bp = {"data_type": "WEIGHT", "payload": {"weight": 71}}
+    assert client.post("/api/webhook/health", json=bp, headers=webhook_headers).status_code == 200
+    # Writes through the cached user snapshot still persist
+    session.expire_all()
+    assert session.get(models.User, target.user_id).weight_kg == 71
+
+    response = client.delete(f"/api/v1/admin/apikeys/{key.key_id}", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert client.post("/api/webhook/health", json=bp, headers=webhook_headers).status_code == 401
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import insert
+from app import models, services
+
+def test_lttb_keeps_peaks():
+    xs = list(range(100))
+    ys = [0] * 100
+    ys[37] = 50
+    picked = services.lttb(xs, ys, 10)
+    assert len(picked) == 10
+    assert picked[0] == 0 and picked[-1] == 99
+    assert 37 in picked
+    assert services.lttb(xs[:5], ys[:5], 10) == [0, 1, 2, 3, 4]
+
+def test_bp_chart_buckets_and_lttb(client, session, auth_headers):
+    headers = auth_headers("chart_bp")
+    user = session.query(models.User).filter(models.User.name == "chart_bp").one()
+    base = datetime(2024, 3, 4, 0, 0)  # a Monday
+    # Four readings a day for 28 days; systolic climbs by one each day
+    session.execute(insert(models.BloodPressure), [
+        {"user_id": user.user_id, "systolic": 110 + day + (5 if hour == 18 else 0), "diastolic": 70, "pulse": 60,
+         "timestamp": base + timedelta(days=day, hours=hour)}
+        for day in range(28) for hour in (6, 12, 18, 22)
+    ])
+    session.commit()
+    params = {"start_date": "2024-03-04", "end_date": "2024-03-31"}
+
+    daily = client.get("/api/v1/log/charts/bp", params=params, headers=headers).json()
+    assert daily["bucket_days"] == 1
+    assert len(daily["series"]["date"]) == 28
+    assert daily["series"]["count"][0] == 4
+    assert daily["series"]["systolic_min"][0] == 110
+    assert daily["series"]["systolic_max"][0] == 115
+    assert daily["series"]["systolic_mean"][0] == 111.2
+
+    weekly = client.get("/api/v1/log/charts/bp", params={**params, "points": 10}, headers=headers).json()
+    assert weekly["bucket_days"] == 7
+    assert weekly["series"]["date"] == ["2024-03-04", "2024-03-11", "2024-03-18", "2024-03-25"]
+    assert weekly["series"]["count"] == [28, 28, 28, 28]
+    assert weekly["series"]["systolic_max"][-1] == 142
+
+    response = client.get("/api/v1/log/charts/bp", params={**params, "points": 10, "resolution": "day"}, headers=headers)
+    assert response.status_code == 400
+    assert client.get("/api/v1/log/charts/bp", params={"days": 10_000_000}, headers=headers).status_code == 422
+    with pytest.raises(ValueError):
+        services.BPChartService().resolve_range(user, days=10_000_000)
+
+    shape = client.get("/api/v1/log/charts/bp", params={**params, "method": "lttb", "points": 20}, headers=headers).json()
+    assert shape["readings"] == 112
+    assert len(shape["series"]["timestamp"]) == 20
+    assert shape["series"]["systolic"][0] == 110
+    assert shape["series"]["systolic"][-1] == 137
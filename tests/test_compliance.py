@@ -0,0 +1,197 @@
+import zoneinfo
+from datetime import date, datetime, time, timedelta, timezone
+import pytest
+from sqlalchemy import insert
+from app import models, schemas, services
+
+NY = zoneinfo.ZoneInfo("America/New_York")
+
+def make_user(session, name, tz="America/New_York"):
+    user = models.User(name=name, weight_kg=70.0, height_cm=175.0, timezone=tz)
+    session.add(user)
+    session.commit()
+    return user
+
+def make_med(session, user, name, **kwargs):
+    med = models.Medication(user_id=user.user_id, name=name, current_inventory=100, refills_remaining=5, **kwargs)
+    session.add(med)
+    session.commit()
+    return med
+
+def utc(d: date, t: time) -> datetime:
+    return datetime.combine(d, t).replace(tzinfo=NY).astimezone(timezone.utc).replace(tzinfo=None)
+
+def log(session, user, med, when, window=None):
+    session.add(models.MedDoseLog(user_id=user.user_id, med_id=med.med_id, timestamp_taken=when, dose_window=window))
+
+def test_compliance_window_attribution(session):
+    user = make_user(session, "compliance_rules")
+    med = make_med(session, user, "Aspirin", schedule_morning=True, schedule_bedtime=True)
+    late = make_med(session, user, "Statin", schedule_morning=True, start_date=date(2024, 3, 6))
+    start, end = date(2024, 3, 1), date(2024, 3, 10)  # spans the DST change
+
+    log(session, user, med, utc(date(2024, 3, 1), time(7, 0)))                 # morning 1st
+    log(session, user, med, utc(date(2024, 3, 2), time(1, 0)))                 # inferred bedtime 1st
+    log(session, user, med, utc(date(2024, 3, 3), time(2, 0)), "bedtime")      # explicit bedtime 2nd
+    log(session, user, med, utc(date(2024, 3, 3), time(23, 0)), "morning")     # explicit morning 3rd
+    log(session, user, med, utc(date(2024, 3, 11), time(0, 30)))               # bedtime 10th, after midnight
+    log(session, user, med, utc(date(2024, 3, 1), time(5, 0)))                 # bedtime 29 Feb: out of range
+    log(session, user, late, utc(date(2024, 3, 5), time(8, 0)))                # before its start date
+    log(session, user, late, utc(date(2024, 3, 10), time(8, 0)))
+    session.commit()
+    services.AdherenceLedgerService().rebuild(session, user)
+
+    report = services.HealthLogService().calculate_compliance_report(session, user, start_date=start, end_date=end)
+    by_name = {m["name"]: m for m in report["medications"]}
+    assert by_name["Aspirin"]["expected"] == 20
+    assert by_name["Aspirin"]["taken"] == 5
+    assert by_name["Aspirin"]["schedule"] == "M, B"
+    assert by_name["Statin"]["expected"] == 5
+    assert by_name["Statin"]["taken"] == 1
+    assert report["total_scheduled"] == 25
+    assert report["taken_doses"] == 6
+    assert report["missed_doses"] == 19
+
+def test_compliance_year_for_ten_medications(session):
+    user = make_user(session, "compliance_year")
+    windows = [("morning", time(7, 30)), ("afternoon", time(12, 30)), ("evening", time(18, 0)), ("bedtime", time(23, 30))]
+    meds = [make_med(session, user, f"Med {i}", schedule_morning=True, schedule_afternoon=True,
+                     schedule_evening=True, schedule_bedtime=True) for i in range(10)]
+    end = date(2024, 12, 31)
+    start = end - timedelta(days=364)
+
+    rows = []
+    for i in range(365):
+        d = start + timedelta(days=i)
+        for med in meds:
+            for _, t in windows:
+                # Skip every med's afternoon dose on Sundays
+                if t == time(12, 30) and d.weekday() == 6:
+                    continue
+                rows.append({"user_id": user.user_id, "med_id": med.med_id, "timestamp_taken": utc(d, t)})
+    session.execute(insert(models.MedDoseLog), rows)
+    session.commit()
+    services.AdherenceLedgerService().rebuild(session, user)
+
+    service = services.ComplianceService()
+    report = service.report(session, user, start, end)
+    sundays = sum(1 for i in range(365) if (start + timedelta(days=i)).weekday() == 6)
+    assert report["total_scheduled"] == 365 * 4 * 10
+    assert report["missed_doses"] == sundays * 10
+    assert all(m["missed"] == sundays for m in report["medications"])
+
+def test_compliance_range_validation(session):
+    user = make_user(session, "compliance_range")
+    service = services.ComplianceService()
+    start, end = service.resolve_range(user, days=7)
+    assert (end - start).days == 6
+    assert end == services.get_user_local_date(user, None) - timedelta(days=1)
+    with pytest.raises(ValueError):
+        service.resolve_range(user, start_date=date(2024, 2, 1), end_date=date(2024, 1, 1))
+    # Checked before any date arithmetic, which would overflow
+    with pytest.raises(ValueError):
+        service.resolve_range(user, days=10_000_000)
+
+def ledger_rows(session, user):
+    session.expire_all()
+    return {
+        (row.med_id, row.local_date): row.windows_taken
+        for row in session.query(models.DoseAdherence).filter(models.DoseAdherence.user_id == user.user_id)
+    }
+
+def test_adherence_ledger_tracks_dose_writes(session):
+    user = make_user(session, "ledger_writes")
+    med = make_med(session, user, "Metformin", schedule_morning=True, schedule_bedtime=True)
+    other = make_med(session, user, "Lisinopril", schedule_morning=True)
+    meds = services.MedicationService()
+    day = date(2024, 5, 1)
+
+    meds.log_dose(session, user.user_id, "Metformin", utc(day, time(7, 0)))
+    meds.log_dose(session, user.user_id, "Metformin", utc(day, time(7, 30)))
+    late, _ = meds.log_dose(session, user.user_id, "Metformin", utc(day + timedelta(days=1), time(0, 30)))
+    assert ledger_rows(session, user) == {(med.med_id, day): 0b1001}
+
+    # Deleting one of two morning doses keeps the morning bit
+    first = session.query(models.MedDoseLog).filter(models.MedDoseLog.user_id == user.user_id).order_by(
+        models.MedDoseLog.timestamp_taken).first()
+    meds.delete_dose_log(session, first.dose_log_id, user.user_id)
+    assert ledger_rows(session, user) == {(med.med_id, day): 0b1001}
+
+    # Moving the bedtime dose to the next evening and to another medication
+    meds.update_dose_log(session, late.dose_log_id, user.user_id, schemas.LogUpdate(
+        timestamp=utc(day + timedelta(days=1), time(18, 0)), med_id=other.med_id
+    ))
+    assert ledger_rows(session, user) == {(med.med_id, day): 0b0001, (other.med_id, day + timedelta(days=1)): 0b0100}
+
+    expected = ledger_rows(session, user)
+    services.AdherenceLedgerService().rebuild(session, user)
+    assert ledger_rows(session, user) == expected
+
+def test_adherence_ledger_follows_the_callers_transaction(session):
+    user = make_user(session, "ledger_rollback")
+    med = make_med(session, user, "Atorvastatin", schedule_morning=True, schedule_evening=True)
+    day = date(2024, 6, 3)
+    batch = services.WebhookBatchService()
+
+    # Logging a dose writes nothing (and takes no write lock) until the caller flushes
+    services.MedicationService().log_dose(session, user.user_id, "Atorvastatin", utc(day, time(12, 0)), commit=False)
+    assert not session.connection().connection.dbapi_connection.in_transaction
+    session.rollback()
+    assert ledger_rows(session, user) == {}
+
+    events = [{"data_type": "MEDICATION_TAKEN", "payload": {"med_name": "Atorvastatin", "timestamp": utc(day, time(7, 0)).isoformat()}}]
+    assert batch.process(session, user, events, commit=False)[0]["status"] == "success"
+    session.rollback()
+    assert ledger_rows(session, user) == {}
+
+    events[0]["payload"]["timestamp"] = utc(day, time(18, 0)).isoformat()
+    batch.process(session, user, events, commit=False)
+    session.commit()
+    assert ledger_rows(session, user) == {(med.med_id, day): 0b0100}
+
+def test_adherence_ledger_rebuilt_when_windows_change(client, session, auth_headers):
+    headers = auth_headers("ledger_windows")
+    user = session.query(models.User).filter(models.User.name == "ledger_windows").one()
+    med = make_med(session, user, "Vitamin D", schedule_morning=True)
+
+    # 05:30 UTC is before the 06:00 morning window, so it is the previous night's bedtime dose
+    services.MedicationService().log_dose(session, user.user_id, "Vitamin D", datetime(2024, 5, 2, 5, 30))
+    assert ledger_rows(session, user) == {(med.med_id, date(2024, 5, 1)): 0b1000}
+
+    response = client.put("/api/v1/users/me", json={"window_morning_start": "05:00:00"}, headers=headers)
+    assert response.status_code == 200
+    assert ledger_rows(session, user) == {(med.med_id, date(2024, 5, 2)): 0b0001}
+
+    response = client.get("/api/v1/log/reports/compliance?start_date=2024-05-01&end_date=2024-05-02", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["taken_doses"] == 1
+    assert response.json()["total_scheduled"] == 2
+    assert client.get("/api/v1/log/reports/compliance?days=10000000", headers=headers).status_code == 422
+    assert client.get("/api/v1/log/reports/adherence_calendar?days=10000000", headers=headers).status_code == 422
+
+def test_adherence_calendar_run_lengths_and_streaks(session):
+    user = make_user(session, "calendar")
+    twice = make_med(session, user, "Twice", schedule_morning=True, schedule_evening=True)
+    once = make_med(session, user, "Once", schedule_morning=True, start_date=date(2024, 6, 3))
+    start = date(2024, 6, 1)
+    meds = services.MedicationService()
+
+    # Twice: days 1-3 complete, day 4 partial, day 5 missed, days 6-7 complete
+    for i in (0, 1, 2, 3, 5, 6):
+        meds.log_dose(session, user.user_id, "Twice", utc(start + timedelta(days=i), time(7, 0)))
+        if i != 3:
+            meds.log_dose(session, user.user_id, "Twice", utc(start + timedelta(days=i), time(18, 0)))
+    # Once: scheduled from day 3, taken on every one of those days
+    for i in range(2, 7):
+        meds.log_dose(session, user.user_id, "Once", utc(start + timedelta(days=i), time(8, 0)))
+
+    calendar = services.ComplianceService().calendar(session, user, start, start + timedelta(days=6))
+    by_name = {m["name"]: m for m in calendar["medications"]}
+    assert calendar["days"] == 7
+    assert by_name["Twice"]["days"] == "3T1P1M2T"
+    assert (by_name["Twice"]["current_streak"], by_name["Twice"]["longest_streak"]) == (2, 3)
+    assert (by_name["Twice"]["taken"], by_name["Twice"]["expected"]) == (11, 14)
+    assert by_name["Once"]["days"] == "2N5T"
+    assert (by_name["Once"]["current_streak"], by_name["Once"]["longest_streak"]) == (5, 5)
+    assert calendar["overall"]["days"] == "3T2P2T"
+    assert calendar["overall"]["longest_streak"] == 3
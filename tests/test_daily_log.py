@@ -0,0 +1,151 @@
+import threading
+from sqlalchemy import event
+from app import models, schemas, services, database
+
+def make_user(session, name):
+    user = models.User(name=name, weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+    session.commit()
+    return user
+
+def daily_rows(session, user_id):
+    session.expire_all()
+    return session.query(models.DailyLog).filter(models.DailyLog.user_id == user_id).all()
+
+def test_daily_log_delta_upserts_and_clamps(session):
+    user = make_user(session, "daily_upsert")
+    today = services.get_user_local_date(user, None)
+
+    services.apply_daily_log_delta(session, user.user_id, today, consumed=200)
+    services.apply_daily_log_delta(session, user.user_id, today, consumed=50, burned=30)
+    services.apply_daily_log_delta(session, user.user_id, today, burned=-100)
+    session.commit()
+
+    rows = daily_rows(session, user.user_id)
+    assert len(rows) == 1
+    assert rows[0].total_calories_consumed == 250
+    assert rows[0].total_calories_burned == 0
+
+def test_concurrent_exercise_logging_keeps_exact_totals(db_session_factory):
+    setup = db_session_factory()
+    user = make_user(setup, "daily_concurrent")
+    user_id = user.user_id
+    setup.close()
+
+    errors = []
+
+    def worker():
+        db = db_session_factory()
+        try:
+            worker_user = db.get(models.User, user_id)
+            for _ in range(10):
+                payload = schemas.ExercisePayload(activity_type="walking", duration_minutes=10, calories_burned=5)
+                services.HealthLogService().log_exercise(db, worker_user, payload)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    check = db_session_factory()
+    try:
+        rows = daily_rows(check, user_id)
+        assert len(rows) == 1
+        assert rows[0].total_calories_burned == 4 * 10 * 5
+    finally:
+        check.close()
+
+def test_food_logging_maintains_macro_totals(session):
+    user = make_user(session, "daily_macros")
+    food = models.NutritionCache(food_name="Macro Bar", calories=200, protein=10, fat=5, carbs=30, fiber=3, source="MANUAL")
+    session.add(food)
+    session.commit()
+
+    service = services.HealthLogService()
+    first, _ = service.log_food(session, user, schemas.FoodLogPayload(food_name="Macro Bar", quantity=2))
+    second, _ = service.log_food(session, user, schemas.FoodLogPayload(food_name="Macro Bar"))
+
+    row = daily_rows(session, user.user_id)[0]
+    assert (row.total_calories_consumed, row.total_protein, row.total_carbs, row.food_item_count) == (600, 30, 90, 2)
+
+    service.update_food_log(session, first.item_log_id, user.user_id, schemas.LogUpdate(quantity=1))
+    service.delete_food_log(session, second.item_log_id, user.user_id)
+
+    row = daily_rows(session, user.user_id)[0]
+    assert (row.total_calories_consumed, row.total_protein, row.total_fat, row.total_fiber, row.food_item_count) == (200, 10, 5, 3, 1)
+
+def test_food_batch_logs_meal_in_one_transaction(session):
+    user = make_user(session, "daily_batch")
+    session.add_all([
+        models.NutritionCache(food_name="Batch Toast", calories=80, protein=3, fat=1, carbs=15, fiber=1, source="MANUAL"),
+        models.NutritionCache(barcode="8000001", food_name="Batch Jam", calories=50, protein=0, fat=0, carbs=12, fiber=0, source="MANUAL"),
+    ])
+    session.commit()
+
+    commits, notified = [], []
+    event.listen(session, "after_commit", lambda s: commits.append(1))
+    database.add_commit_listener(notified.append)
+    try:
+        items = [
+            schemas.FoodLogPayload(food_name="Batch Toast", quantity=2),
+            schemas.FoodLogPayload(barcode="8000001"),
+            schemas.FoodLogPayload(food_name="Homemade Soup"),
+            schemas.FoodLogPayload(food_name="Homemade Soup", meal_id="Lunch"),
+        ]
+        logs, error = services.HealthLogService().log_food_batch(session, user, items, meal_id="Breakfast")
+    finally:
+        database.remove_commit_listener(notified.append)
+
+    assert error is None
+    assert len(commits) == 1
+    assert any(user.user_id in ids for ids in notified)
+    assert [log.meal_id for log in logs] == ["Breakfast", "Breakfast", "Breakfast", "Lunch"]
+    assert logs[2].food_id == logs[3].food_id
+    assert session.query(models.NutritionCache).filter_by(food_name="Homemade Soup").count() == 1
+
+    row = daily_rows(session, user.user_id)[0]
+    assert (row.total_calories_consumed, row.total_carbs, row.food_item_count) == (210, 42, 4)
+
+    # One unresolvable item rejects the whole meal
+    services.openfoodfacts.off_misses.add("8000099")
+    logs, error = services.HealthLogService().log_food_batch(
+        session, user, [schemas.FoodLogPayload(food_name="Batch Toast"), schemas.FoodLogPayload(barcode="8000099")]
+    )
+    services.openfoodfacts.off_misses.discard("8000099")
+    assert (logs, error) == ([], "Food not found")
+    assert daily_rows(session, user.user_id)[0].food_item_count == 4
+
+def test_rebuild_repairs_drifted_totals(session):
+    user = make_user(session, "daily_rebuild")
+    food = models.NutritionCache(food_name="Rebuild Soup", calories=150, protein=8, fat=4, carbs=12, fiber=2, source="MANUAL")
+    session.add(food)
+    session.commit()
+
+    service = services.HealthLogService()
+    service.log_food(session, user, schemas.FoodLogPayload(food_name="Rebuild Soup", quantity=2))
+    service.log_exercise(session, user, schemas.ExercisePayload(activity_type="yoga", duration_minutes=30, calories_burned=90))
+
+    # Simulate drift from a manual edit
+    row = daily_rows(session, user.user_id)[0]
+    row.total_calories_consumed = 999
+    row.total_protein = 0
+    session.commit()
+
+    rebuild = services.DailyLogRebuildService()
+    report = rebuild.rebuild(session, user_id=user.user_id, dry_run=True)
+    assert report["discrepancy_count"] == 1
+    assert report["discrepancies"][0]["fields"]["total_calories_consumed"] == {"stored": 999, "actual": 300}
+    assert daily_rows(session, user.user_id)[0].total_calories_consumed == 999
+
+    report = rebuild.rebuild(session, user_id=user.user_id)
+    assert report["days_updated"] == 1
+    row = daily_rows(session, user.user_id)[0]
+    assert (row.total_calories_consumed, row.total_calories_burned, row.total_protein, row.food_item_count) == (300, 90, 16, 1)
+
+    assert rebuild.rebuild(session, user_id=user.user_id)["discrepancy_count"] == 0
@@ -0,0 +1,37 @@
+from app import database, models
+
+def test_sqlite_pragmas_applied(session):
+    conn = session.connection()
+    assert conn.exec_driver_sql("PRAGMA journal_mode").scalar().lower() == database.SQLITE_JOURNAL_MODE.lower()
+    assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == database.SQLITE_BUSY_TIMEOUT_MS
+    assert conn.exec_driver_sql("PRAGMA foreign_keys").scalar() == 1
+    # NORMAL == 1
+    assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+
+def test_history_queries_use_composite_indexes(session):
+    conn = session.connection()
+    plans = {
+        "ix_blood_pressure_user_id_timestamp":
+            "SELECT * FROM blood_pressure WHERE user_id = 1 ORDER BY timestamp DESC LIMIT 50",
+        "ix_food_item_logs_user_id_timestamp":
+            "SELECT * FROM food_item_logs WHERE user_id = 1 AND timestamp >= '2024-01-01' AND timestamp <= '2024-01-02'",
+        "ix_med_dose_logs_user_id_timestamp_taken":
+            "SELECT * FROM med_dose_logs WHERE user_id = 1 AND timestamp_taken >= '2024-01-01'",
+        "ix_daily_logs_user_id_date":
+            "SELECT * FROM daily_logs WHERE user_id = 1 AND date = '2024-01-01'",
+    }
+    for index_name, sql in plans.items():
+        plan = " ".join(str(row[-1]) for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}"))
+        assert index_name in plan, plan
+
+def test_savepoints_stay_inside_the_outer_transaction(session):
+    user = models.User(name="savepoint_user", weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+    session.commit()
+
+    savepoint = session.begin_nested()
+    user.weight_kg = 80.0
+    savepoint.commit()
+    session.rollback()
+    session.expire_all()
+    assert session.get(models.User, user.user_id).weight_kg == 70.0
@@ -0,0 +1,82 @@
+import time
+from datetime import datetime, timedelta, timezone
+from app import models, mqtt, services
+
+def inventory(session, user):
+    session.expire_all()
+    return session.query(models.Medication).filter_by(user_id=user.user_id, name="Retry Med").one().current_inventory
+
+def test_webhook_retries_are_applied_once(client, session, make_user_with_key):
+    user = make_user_with_key("idem_webhook", "idem_webhook_key", med_name="Retry Med")
+    session.add(models.NutritionCache(food_name="Retry Snack", calories=150, protein=2, source="MANUAL"))
+    session.commit()
+    headers = {"X-Webhook-Secret": "idem_webhook_key", "Idempotency-Key": "dose-1"}
+    dose = {"data_type": "MEDICATION_TAKEN", "payload": {"med_name": "Retry Med"}}
+
+    first = client.post("/api/webhook/health", headers=headers, json=dose)
+    second = client.post("/api/webhook/health", headers=headers, json=dose)
+    assert first.json()["message"] == "Medication logged"
+    assert second.status_code == 200 and second.json()["duplicate"] is True
+    assert inventory(session, user) == 9
+
+    # The key is per event, not per endpoint: a new key is a new dose
+    client.post("/api/webhook/health", headers={**headers, "Idempotency-Key": "dose-2"}, json=dose)
+    assert inventory(session, user) == 8
+
+    # Failed events do not use up their key
+    food = {"data_type": "FOOD_LOG", "payload": {"barcode": "no-such-barcode-and-no-name"}}
+    headers["Idempotency-Key"] = "meal-1"
+    services.openfoodfacts.off_misses.add("no-such-barcode-and-no-name")
+    assert client.post("/api/webhook/health", headers=headers, json=food).status_code == 400
+    # So do invalid ones
+    assert client.post("/api/webhook/health", headers=headers, json={"data_type": "FOOD_LOG", "payload": {}}).status_code == 422
+    food["payload"] = {"food_name": "Retry Snack"}
+    for _ in range(3):
+        assert client.post("/api/webhook/health", headers=headers, json=food).status_code == 200
+    session.expire_all()
+    row = session.query(models.DailyLog).filter_by(user_id=user.user_id).one()
+    assert (row.total_calories_consumed, row.food_item_count) == (150, 1)
+    services.openfoodfacts.off_misses.discard("no-such-barcode-and-no-name")
+
+def test_batch_and_mqtt_share_keys(client, session, db_session_factory, monkeypatch, make_user_with_key):
+    user = make_user_with_key("idem_mqtt", "idem_mqtt_key", med_name="Retry Med")
+    monkeypatch.setattr(mqtt.database, "SessionLocal", db_session_factory)
+    client_mqtt = mqtt.MQTTClient()
+
+    message = {"api_key": "idem_mqtt_key", "data_type": "MEDICATION_TAKEN",
+               "payload": {"med_name": "Retry Med"}, "idempotency_key": "mqtt-1"}
+    client_mqtt.process_message(message)
+    client_mqtt.process_message(message)
+    assert inventory(session, user) == 9
+
+    events = [
+        {"data_type": "MEDICATION_TAKEN", "payload": {"med_name": "Retry Med"}, "idempotency_key": "mqtt-1"},
+        {"data_type": "MEDICATION_TAKEN", "payload": {"med_name": "Retry Med"}, "idempotency_key": "batch-1"},
+        {"data_type": "MEDICATION_TAKEN", "payload": {"med_name": "Retry Med"}, "idempotency_key": "batch-1"},
+    ]
+    response = client.post("/api/webhook/health/batch", headers={"X-Webhook-Secret": "idem_mqtt_key"}, json={"events": events})
+    data = response.json()
+    assert [r["status"] for r in data["results"]] == ["duplicate", "success", "duplicate"]
+    assert (data["applied"], data["duplicates"], data["failed"]) == (1, 2, 0)
+    assert inventory(session, user) == 8
+
+def test_keys_expire_and_are_pruned(session, db_session_factory):
+    user = models.User(name="idem_expiry", weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+    session.commit()
+    idem = services.IdempotencyService(ttl_hours=1, session_factory=db_session_factory)
+
+    session.add(models.IdempotencyKey(user_id=user.user_id, key="old", created_at=datetime.now(timezone.utc) - timedelta(hours=2)))
+    session.commit()
+    assert not idem.is_duplicate(session, user.user_id, "old")
+
+    idem.claim(session, user.user_id, "new")
+    session.commit()
+    assert idem.is_duplicate(session, user.user_id, "new")
+    # The first claim pruned the expired key, in the background
+    for _ in range(100):
+        session.expire_all()
+        if session.query(models.IdempotencyKey).filter_by(user_id=user.user_id).count() == 1:
+            break
+        time.sleep(0.02)
+    assert session.query(models.IdempotencyKey).filter_by(user_id=user.user_id).count() == 1
@@ -122,8 +122,8 @@ def test_webhook_get_nutrition(client, session):
     assert data["source"] == "TEST"
 
     # Test Not Found with Mock
-    import app.services
-    original_get = app.services.requests.get
+    from app.openfoodfacts import off_client
+    original_get = off_client.session.get
 
     class MockResponse:
         def __init__(self, status_code, json_data):
@@ -132,12 +132,12 @@ def test_webhook_get_nutrition(client, session):
         def json(self):
             return self._json
 
-    def mock_get(url):
+    def mock_get(url, **kwargs):
         if "123456" in url:
              return MockResponse(200, {"status": 1, "product": {"product_name": "Test Food"}})
         return MockResponse(404, {})
 
-    app.services.requests.get = mock_get
+    off_client.session.get = mock_get
 
     try:
         response_nf = client.get(
@@ -146,4 +146,123 @@ def test_webhook_get_nutrition(client, session):
         )
         assert response_nf.status_code == 404
     finally:
-        app.services.requests.get = original_get
+        off_client.session.get = original_get
+
+def test_webhook_nutrition_batch_lookup(client, session):
+    user = session.query(models.User).filter(models.User.name == "testuser").first()
+    if not user:
+        pytest.skip("User testuser not found")
+
+    raw_key = "test_webhook_key_lookup"
+    session.add(models.APIKey(user_id=user.user_id, name="Test Key Lookup", hashed_key=auth.hash_api_key(raw_key)))
+    session.add(models.NutritionCache(barcode="222333", food_name="Batch Food", calories=50.0, protein=1.0, source="TEST"))
+    session.commit()
+
+    response = client.post(
+        "/api/webhook/nutrition/lookup",
+        headers={"X-Webhook-Secret": raw_key},
+        json={"items": [{"food_name": "Missing Food"}, {"barcode": "222333"}, {"food_name": "Test Food"}]}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [r["found"] for r in data] == [False, True, True]
+    assert data[0]["food"] is None
+    assert data[1]["barcode"] == "222333" and data[1]["food"]["food_name"] == "Batch Food"
+    assert data[2]["food"]["calories"] == 100.0
+
+def test_log_food_single_and_batch(client):
+    token = get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    response = client.post("/api/v1/nutrition/log", headers=headers, json={"food_name": "Test Food", "meal_id": "Lunch"})
+    assert response.status_code == 200
+    assert response.json()["food_name"] == "Test Food"
+
+    batch = {"meal_id": "Dinner", "items": [{"food_name": "Test Food", "quantity": 2}, {"barcode": "222333"}]}
+    response = client.post("/api/v1/nutrition/log", headers=headers, json=batch)
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 2
+
+    # Invalid batches are rejected, not read as a single food
+    response = client.post("/api/v1/nutrition/log", headers=headers, json={"items": [{"quantity": 1}]})
+    assert response.status_code == 422
+    response = client.post("/api/v1/nutrition/log", headers=headers, json={"items": [{"food_name": "Test Food"}] * 101})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"][-1] == "items"
+
+def test_webhook_batch(client, session):
+    from app import database
+    user = session.query(models.User).filter(models.User.name == "testuser").first()
+    if not user:
+        pytest.skip("User testuser not found")
+
+    raw_key = "test_webhook_key_batch"
+    session.add(models.APIKey(user_id=user.user_id, name="Test Key Batch", hashed_key=auth.hash_api_key(raw_key)))
+    session.commit()
+
+    def burned_today():
+        session.expire_all()
+        row = session.query(models.DailyLog).filter(models.DailyLog.user_id == user.user_id).order_by(models.DailyLog.date.desc()).first()
+        return (row.total_calories_burned, row.food_item_count) if row else (0, 0)
+    before = burned_today()
+
+    events = [
+        {"data_type": "EXERCISE_SESSION", "payload": {"activity_type": "Walking", "duration_minutes": 10, "calories_burned": 40}},
+        {"data_type": "BLOOD_PRESSURE", "payload": {"systolic": 118, "diastolic": 76, "pulse": 64, "location": "Left Arm",
+                                                   "stress_level": 2, "meds_taken_before": "NO"}},
+        {"data_type": "NOT_A_TYPE", "payload": {}},
+        {"data_type": "MEDICATION_TAKEN", "payload": {"med_name": "No Such Med"}},
+        {"data_type": "MEDICATION_TAKEN", "payload": {"med_name": "Ibuprofen"}},
+        {"data_type": "EXERCISE_SESSION", "payload": {"activity_type": "Walking", "duration_minutes": 5, "calories_burned": 20}},
+        {"data_type": "FOOD_LOG", "payload": {"items": [{"food_name": "Test Food"}, {"barcode": "222333"}]}},
+        {"data_type": "BLOOD_PRESSURE", "payload": {"systolic": "high"}},
+    ]
+    commits = []
+    database.add_commit_listener(commits.append)
+    try:
+        response = client.post("/api/webhook/health/batch", headers={"X-Webhook-Secret": raw_key}, json={"events": events})
+    finally:
+        database.remove_commit_listener(commits.append)
+
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["status"], data["applied"], data["failed"]) == ("partial", 5, 3)
+    assert [r["status"] for r in data["results"]] == ["success", "success", "error", "error", "success", "success", "success", "error"]
+    assert [r["index"] for r in data["results"]] == list(range(len(events)))
+    assert data["results"][3]["detail"] == "Medication not found"
+    assert data["results"][7]["detail"].startswith("systolic: Input should be a valid integer")
+
+    # Everything went in with one commit
+    assert len(commits) == 1
+    burned, items = burned_today()
+    assert burned - before[0] == 60
+    assert items - before[1] == 2
+
+def test_webhook_batch_event_that_raises_fails_alone(client, session, monkeypatch):
+    from app import services
+    user = session.query(models.User).filter(models.User.name == "testuser").first()
+    if not user:
+        pytest.skip("User testuser not found")
+    raw_key = "test_webhook_key_isolate"
+    session.add(models.APIKey(user_id=user.user_id, name="Test Key Isolate", hashed_key=auth.hash_api_key(raw_key)))
+    session.commit()
+
+    def broken(*args, **kwargs):
+        raise ValueError("sensor glitch")
+    monkeypatch.setattr(services.HealthLogService, "log_bp", broken)
+    bp_count = session.query(models.BloodPressure).filter_by(user_id=user.user_id).count()
+    exercise_count = session.query(models.ExerciseLog).filter_by(user_id=user.user_id).count()
+
+    events = [
+        {"data_type": "BLOOD_PRESSURE", "payload": {"systolic": 120, "diastolic": 80, "pulse": 60, "location": "Left Arm",
+                                                   "stress_level": 1, "meds_taken_before": "NO"}},
+        {"data_type": "EXERCISE_SESSION", "payload": {"activity_type": "Walking", "duration_minutes": 5, "calories_burned": 15}},
+    ]
+    response = client.post("/api/webhook/health/batch", headers={"X-Webhook-Secret": raw_key}, json={"events": events})
+    assert response.status_code == 200
+    data = response.json()
+    assert [r["status"] for r in data["results"]] == ["error", "success"]
+    assert data["results"][0]["detail"] == "sensor glitch"
+    session.expire_all()
+    assert session.query(models.BloodPressure).filter_by(user_id=user.user_id).count() == bp_count
+    assert session.query(models.ExerciseLog).filter_by(user_id=user.user_id).count() == exercise_count + 1
@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+from app import mqtt
+
+def test_ingest_queue_processes_with_fixed_pool():
+    seen = []
+    lock = threading.Lock()
+
+    def handler(item):
+        with lock:
+            seen.append(item["n"])
+
+    q = mqtt.IngestQueue(handler, workers=3, maxsize=10, overflow="block")
+    q.start()
+    try:
+        for n in range(50):
+            q.put({"n": n})
+        q.join()
+    finally:
+        q.stop()
+
+    assert sorted(seen) == list(range(50))
+    stats = q.get_stats()
+    assert stats["processed"] == 50
+    assert stats["workers"] == 3
+    assert stats["depth"] == 0
+
+def test_ingest_queue_drop_oldest():
+    # Workers are not started, so the queue fills up
+    q = mqtt.IngestQueue(lambda item: None, workers=1, maxsize=3, overflow="drop_oldest")
+    for n in range(5):
+        q.put({"n": n})
+
+    stats = q.get_stats()
+    assert stats["depth"] == 3
+    assert stats["dropped"] == 2
+    assert [q._queue.get_nowait()["n"] for _ in range(3)] == [2, 3, 4]
+
+def test_ingest_queue_spill_to_disk(tmp_path):
+    spill_file = str(tmp_path / "spill.jsonl")
+    seen = []
+
+    q = mqtt.IngestQueue(lambda item: seen.append(item["n"]), workers=1, maxsize=2,
+                         overflow="spill", spill_file=spill_file)
+    for n in range(5):
+        q.put({"n": n})
+
+    assert q.get_stats()["spilled"] == 3
+    assert q.get_stats()["spill_pending"] is True
+
+    q.start()
+    try:
+        # Idle workers drain the spill file back through the queue
+        for _ in range(40):
+            if len(seen) == 5:
+                break
+            threading.Event().wait(0.1)
+        q.join()
+    finally:
+        q.stop()
+
+    assert sorted(seen) == [0, 1, 2, 3, 4]
+    assert q.get_stats()["spill_pending"] is False
+
+def test_spill_leftovers_replace_the_file(tmp_path, monkeypatch):
+    spill_file = str(tmp_path / "spill.jsonl")
+    q = mqtt.IngestQueue(lambda item: None, workers=1, maxsize=2, overflow="spill", spill_file=spill_file)
+    for n in range(6):
+        q.put({"n": n})
+    q._queue.get_nowait()
+    q._queue.get_nowait()
+
+    # Rewriting the leftovers fails: the spill file must still hold every message
+    def fail(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr(mqtt.os, "replace", fail)
+    q._drain_spill()
+    with open(spill_file) as f:
+        assert [json.loads(line)["n"] for line in f] == [2, 3, 4, 5]
+
+    monkeypatch.undo()
+    q._queue.get_nowait()
+    q._queue.get_nowait()
+    q._drain_spill()
+    with open(spill_file) as f:
+        assert [json.loads(line)["n"] for line in f] == [4, 5]
+    assert not os.path.exists(spill_file + ".tmp")
+
+def test_status_reports_queue():
+    client = mqtt.MQTTClient()
+    status = client.get_status()
+    assert status["ingest_queue"]["max_depth"] == mqtt.MQTT_QUEUE_MAXSIZE
+    assert status["ingest_queue"]["busy_workers"] == 0
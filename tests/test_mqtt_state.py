@@ -0,0 +1,90 @@
+import json
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+from app import mqtt, models, services
+
+def make_user(session, name, **kwargs):
+    user = models.User(name=name, weight_kg=80.0, height_cm=180.0, **kwargs)
+    session.add(user)
+    session.commit()
+    return user
+
+def published_states(client):
+    return {
+        call[0][0]: json.loads(call[0][1])
+        for call in client.client.publish.call_args_list
+    }
+
+def test_build_user_states(session):
+    metric = make_user(session, "state_metric")
+    imperial = make_user(session, "state_imperial", unit_system="IMPERIAL")
+    now = datetime.now(timezone.utc)
+
+    session.add_all([
+        models.BloodPressure(user_id=metric.user_id, systolic=110, diastolic=70, pulse=60, timestamp=now - timedelta(days=1)),
+        models.BloodPressure(user_id=metric.user_id, systolic=125, diastolic=82, pulse=60, timestamp=now),
+        models.DailyLog(user_id=metric.user_id, date=services.get_user_local_date(metric, None),
+                        total_calories_consumed=500, total_calories_burned=200),
+    ])
+    session.commit()
+
+    client = mqtt.MQTTClient()
+    states = client.build_user_states(session, [metric.user_id, imperial.user_id])
+
+    assert states[metric.user_id] == {
+        "weight": 80.0, "calories_in": 500, "calories_burned": 200,
+        "bp_systolic": 125, "bp_diastolic": 82
+    }
+    assert states[imperial.user_id]["weight"] == round(80.0 * 2.20462, 1)
+    assert states[imperial.user_id]["bp_systolic"] == 0
+
+def test_publish_skips_unchanged_payloads(session):
+    user = make_user(session, "state_changes")
+    topic = f"hahealth/{user.user_id}/state"
+
+    client = mqtt.MQTTClient()
+    client.client = MagicMock()
+
+    client.publish_periodic_stats(session, [user.user_id])
+    assert topic in published_states(client)
+
+    client.client.reset_mock()
+    client.publish_periodic_stats(session, [user.user_id])
+    assert client.client.publish.call_count == 0
+
+    user.weight_kg = 79.0
+    session.commit()
+    client.publish_periodic_stats(session, [user.user_id])
+    assert published_states(client)[topic]["weight"] == 79.0
+
+def test_commit_notifies_changed_users(session):
+    from app import database
+    user = make_user(session, "state_commit_hook")
+    seen = []
+    database.add_commit_listener(seen.append)
+    try:
+        session.add(models.BloodPressure(user_id=user.user_id, systolic=120, diastolic=80, pulse=60))
+        session.commit()
+
+        # Rolled back writes are not reported
+        session.add(models.BloodPressure(user_id=user.user_id, systolic=130, diastolic=85, pulse=60))
+        session.flush()
+        session.rollback()
+    finally:
+        database.remove_commit_listener(seen.append)
+
+    assert seen == [{user.user_id}]
+
+def test_dirty_users_are_coalesced(session, monkeypatch):
+    client = mqtt.MQTTClient()
+    client._state_thread = MagicMock()  # pretend the publisher is running
+    published = []
+    monkeypatch.setattr(client, "publish_periodic_stats", lambda db, user_ids=None: published.append(set(user_ids)))
+
+    client.mark_users_dirty({1})
+    client.mark_users_dirty({1, 2})
+    client.mark_users_dirty({2})
+    client.flush_dirty_users()
+    client.flush_dirty_users()
+
+    assert published == [{1, 2}]
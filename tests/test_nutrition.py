@@ -0,0 +1,138 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from datetime import datetime, timedelta, timezone
+from app import models, schemas, services
+from app.database import Base
+
+def add_foods(session, *names):
+    foods = [models.NutritionCache(food_name=name, calories=100, source="MANUAL") for name in names]
+    session.add_all(foods)
+    session.commit()
+    return foods
+
+def test_fts_search_prefix_and_ranking(session):
+    add_foods(session, "Chocolate Milk", "Dark Chocolate Bar", "Milk Chocolate Chip Cookie", "Oat Milk")
+    search = services.FoodSearchService()
+
+    names = [f.food_name for f in search.search(session, "choc")]
+    assert set(names) == {"Chocolate Milk", "Dark Chocolate Bar", "Milk Chocolate Chip Cookie"}
+
+    names = [f.food_name for f in search.search(session, "choc mil")]
+    assert set(names) == {"Chocolate Milk", "Milk Chocolate Chip Cookie"}
+
+    # FTS syntax in user input is treated as plain words
+    assert [f.food_name for f in search.search(session, '"oat')] == ["Oat Milk"]
+    assert search.search(session, "***") == []
+
+def test_fts_index_follows_updates_and_deletes(session):
+    (food,) = add_foods(session, "Granola Crunch")
+    search = services.FoodSearchService()
+    assert [f.food_id for f in search.search(session, "granola")] == [food.food_id]
+
+    food.food_name = "Muesli Crunch"
+    session.commit()
+    assert search.search(session, "granola") == []
+    assert [f.food_id for f in search.search(session, "muesli")] == [food.food_id]
+
+    session.delete(food)
+    session.commit()
+    assert search.search(session, "muesli") == []
+
+def test_search_falls_back_without_fts():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        # Simulate a database without the FTS5 index
+        for trigger in ("nutrition_cache_fts_ai", "nutrition_cache_fts_ad", "nutrition_cache_fts_au"):
+            db.connection().exec_driver_sql(f"DROP TRIGGER {trigger}")
+        db.connection().exec_driver_sql("DROP TABLE nutrition_cache_fts")
+        add_foods(db, "Peanut Butter")
+        assert [f.food_name for f in services.FoodSearchService().search(db, "butter peanut")] == []
+        assert [f.food_name for f in services.FoodSearchService().search(db, "peanut")] == ["Peanut Butter"]
+    finally:
+        db.close()
+        engine.dispose()
+
+def test_recent_foods_ranked_by_frecency(session):
+    user = models.User(name="recent_rank", weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+    tea, toast, cake, creme = add_foods(session, "Green Tea", "Rye Toast", "Birthday Cake", "Crème Brûlée")
+
+    now = datetime.now(timezone.utc)
+    logs = [(tea, 1)] * 3 + [(toast, 1), (toast, 2)] + [(cake, 60)] * 6 + [(creme, 3)]
+    session.add_all([
+        models.FoodItemLog(user_id=user.user_id, food_id=food.food_id, timestamp=now - timedelta(days=days))
+        for food, days in logs
+    ])
+    session.commit()
+
+    index = services.RecentFoodsIndex(per_user=3, half_life_days=14)
+    index.rebuild(session)
+    # Six old slices of cake count for less than three recent cups of tea, and the cap drops the weakest
+    assert index.top(user.user_id) == [tea.food_id, toast.food_id, creme.food_id]
+    assert index.top(user.user_id, query="creme") == [creme.food_id]
+    assert index.top(user.user_id, query="RY to") == [toast.food_id]
+
+    index.record(user.user_id, creme.food_id, creme.food_name)
+    index.record(user.user_id, creme.food_id, creme.food_name)
+    assert index.top(user.user_id, limit=1) == [creme.food_id]
+    assert [f.food_name for f in index.load(session, user.user_id, limit=2)] == ["Crème Brûlée", "Green Tea"]
+
+def test_recent_foods_keeps_a_newly_logged_food_when_full(session):
+    user = models.User(name="recent_full", weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+    tea, toast, cake = add_foods(session, "Mint Tea", "Oat Toast", "Lemon Cake")
+
+    index = services.RecentFoodsIndex(per_user=2, half_life_days=14)
+    for food, count in ((tea, 4), (toast, 3)):
+        for _ in range(count):
+            index.record(user.user_id, food.food_id, food.food_name)
+    # Both regulars score above a first log, but the new food still makes it in
+    index.record(user.user_id, cake.food_id, cake.food_name)
+    assert index.top(user.user_id) == [tea.food_id, cake.food_id]
+
+def test_recent_foods_only_records_committed_logs(session):
+    user = models.User(name="recent_rollback", weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+    session.commit()
+    (soup,) = add_foods(session, "Tomato Soup")
+    services.recent_foods.rebuild(session)
+
+    log = services.HealthLogService()
+    log.log_food_batch(session, user, [schemas.FoodLogPayload(food_name="Tomato Soup")], commit=False)
+    assert services.recent_foods.top(user.user_id) == []
+    session.rollback()
+    assert services.recent_foods.top(user.user_id) == []
+
+    log.log_food_batch(session, user, [schemas.FoodLogPayload(food_name="Tomato Soup")], commit=False)
+    session.commit()
+    assert services.recent_foods.top(user.user_id) == [soup.food_id]
+
+def test_search_blends_recent_foods_first(session):
+    user = models.User(name="recent_search", weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+    session.commit()
+    add_foods(session, "Apple", "Apple Pie", "Apple Juice Drink")
+    services.recent_foods.rebuild(session)
+
+    log = services.HealthLogService()
+    log.log_food_batch(session, user, [schemas.FoodLogPayload(food_name="Apple Juice Drink")] * 2)
+
+    search = services.FoodSearchService()
+    names = [f.food_name for f in search.search(session, "appl", user_id=user.user_id)]
+    assert names[0] == "Apple Juice Drink"
+    assert sorted(names) == ["Apple", "Apple Juice Drink", "Apple Pie"]
+    assert [f.food_name for f in search.search(session, "appl")][0] == "Apple"
+    assert [f.food_name for f in services.recent_foods.load(session, user.user_id)] == ["Apple Juice Drink"]
+
+def test_fts_search_ranks_before_limiting(session):
+    # More matches than are ranked; the best (shortest) match is the newest row
+    session.add_all([
+        models.NutritionCache(food_name=f"Pumpernickel loaf sliced seeded variety {i}", calories=100, source="MANUAL")
+        for i in range(services.FoodSearchService.RANK_CANDIDATES + 50)
+    ])
+    session.commit()
+    (best,) = add_foods(session, "Pumpernickel")
+    results = services.FoodSearchService().search(session, "pumpernickel", limit=5)
+    assert results[0].food_id == best.food_id
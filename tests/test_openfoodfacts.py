@@ -0,0 +1,468 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+import pytest
+from app import models, schemas, services
+from app.openfoodfacts import OpenFoodFactsClient, OpenFoodFactsUnavailable, CircuitBreaker, MissCache, SingleFlight
+
+class FakeOFF:
+    """
+    Local stand-in for the OFF API. `products` maps a barcode to its (status, body, delay);
+    other requests consume `responses` in order.
+    """
+    def __init__(self):
+        self.products = {}
+        self.responses = []
+        self.requests = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests += 1
+                barcode = self.path.rsplit("/", 1)[-1].split(".")[0]
+                if barcode in fake.products:
+                    status, body, delay = fake.products[barcode]
+                else:
+                    status, body, delay = fake.responses.pop(0) if fake.responses else (404, {}, 0)
+                if delay:
+                    time.sleep(delay)
+                payload = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except OSError:
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def fake_off():
+    fake = FakeOFF()
+    yield fake
+    fake.close()
+
+def make_client(fake_off, **kwargs):
+    kwargs.setdefault("max_retries", 2)
+    kwargs.setdefault("backoff_base", 0.01)
+    kwargs.setdefault("breaker", CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    return OpenFoodFactsClient(base_url=fake_off.url, **kwargs)
+
+PRODUCT = {"status": 1, "product": {"product_name": "Fake Bar", "nutriments": {"energy-kj_100g": "418.4", "proteins_100g": 7}}}
+
+def test_retries_transient_errors_then_caches(fake_off, session):
+    fake_off.responses = [(500, {}, 0), (503, {}, 0), (200, PRODUCT, 0)]
+    off = services.OpenFoodFactsService(client=make_client(fake_off))
+
+    food = off.get_product("4000001", session)
+    assert fake_off.requests == 3
+    assert food.food_name == "Fake Bar"
+    assert food.calories == pytest.approx(100.0)
+    assert food.protein == 7.0
+
+    # Second lookup is served from the cache
+    assert off.get_product("4000001", session).food_id == food.food_id
+    assert fake_off.requests == 3
+
+def test_unknown_barcode_does_not_retry(fake_off):
+    fake_off.responses = [(200, {"status": 0}, 0)]
+    client = make_client(fake_off)
+    assert client.fetch_product("4000002") is None
+    assert fake_off.requests == 1
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+def test_timeouts_open_the_circuit(fake_off, session):
+    fake_off.responses = [(200, PRODUCT, 1.0)] * 4
+    client = make_client(fake_off, read_timeout=0.1, max_retries=1)
+    off = services.OpenFoodFactsService(client=client)
+
+    started = time.monotonic()
+    assert off.get_product("4000003", session) is None
+    assert off.get_product("4000003", session) is None
+    assert time.monotonic() - started < 2
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+    # While open, lookups fail fast without touching the network
+    seen = fake_off.requests
+    with pytest.raises(OpenFoodFactsUnavailable):
+        client.fetch_product("4000003")
+    assert fake_off.requests == seen
+    assert session.query(models.NutritionCache).filter_by(barcode="4000003").count() == 0
+
+def test_half_open_trial_closes_circuit(fake_off):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    client = make_client(fake_off, max_retries=0, breaker=breaker)
+
+    fake_off.responses = [(502, {}, 0)]
+    with pytest.raises(OpenFoodFactsUnavailable):
+        client.fetch_product("4000004")
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    fake_off.responses = [(200, PRODUCT, 0)]
+    assert client.fetch_product("4000004")["product_name"] == "Fake Bar"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_half_open_trial_released_on_unexpected_error(fake_off, monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    client = make_client(fake_off, max_retries=0, breaker=breaker)
+
+    fake_off.responses = [(502, {}, 0)]
+    with pytest.raises(OpenFoodFactsUnavailable):
+        client.fetch_product("4000010")
+    time.sleep(0.06)
+
+    def broken_get(url, **kwargs):
+        raise ValueError("unexpected")
+    monkeypatch.setattr(client.session, "get", broken_get)
+    with pytest.raises(ValueError):
+        client.fetch_product("4000010")
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # The failed trial is not left in flight: after the next timeout another trial runs
+    monkeypatch.undo()
+    time.sleep(0.06)
+    fake_off.responses = [(200, PRODUCT, 0)]
+    assert client.fetch_product("4000010")["product_name"] == "Fake Bar"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    # A body that is valid JSON but not an object is treated as unknown
+    fake_off.responses = [(200, ["not", "a", "product"], 0)]
+    assert client.fetch_product("4000011") is None
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+def test_misses_are_cached_until_ttl(fake_off, session):
+    misses = MissCache(ttl=0.2)
+    off = services.OpenFoodFactsService(client=make_client(fake_off), misses=misses)
+
+    fake_off.responses = [(200, {"status": 0}, 0)] * 2
+    assert off.get_product("4000005", session) is None
+    assert off.get_product("4000005", session) is None
+    assert fake_off.requests == 1
+
+    time.sleep(0.25)
+    assert off.get_product("4000005", session) is None
+    assert fake_off.requests == 2
+
+def test_outages_are_not_cached_as_misses(fake_off, session):
+    misses = MissCache()
+    off = services.OpenFoodFactsService(client=make_client(fake_off, max_retries=0), misses=misses)
+
+    fake_off.responses = [(503, {}, 0), (200, PRODUCT, 0)]
+    assert off.get_product("4000006", session) is None
+    assert "4000006" not in misses
+    assert off.get_product("4000006", session).food_name == "Fake Bar"
+
+def test_stale_entry_served_then_refreshed(fake_off, session, db_session_factory):
+    stale = models.NutritionCache(
+        barcode="4000007", food_name="Old Bar", calories=1.0, protein=0, fat=0, carbs=0, fiber=0,
+        source="OFF", fetched_at=datetime.now(timezone.utc) - timedelta(days=365)
+    )
+    manual = models.NutritionCache(barcode="4000008", food_name="My Bar", calories=1.0, source="MANUAL")
+    session.add_all([stale, manual])
+    session.commit()
+
+    off = services.OpenFoodFactsService(client=make_client(fake_off), misses=MissCache(), session_factory=db_session_factory)
+    fake_off.responses = [(200, PRODUCT, 0.2)]
+
+    started = time.monotonic()
+    food = off.get_product("4000007", session)
+    assert food.food_name == "Old Bar"
+    assert time.monotonic() - started < 0.2
+
+    def refreshed():
+        session.expire_all()
+        return session.get(models.NutritionCache, stale.food_id).food_name == "Fake Bar"
+    assert wait_for(refreshed)
+    assert not off.is_stale(session.get(models.NutritionCache, stale.food_id))
+
+    # Fresh and manual entries never go back to OFF
+    off.get_product("4000007", session)
+    off.get_product("4000008", session)
+    time.sleep(0.05)
+    assert fake_off.requests == 1
+
+def test_refresh_does_not_rewrite_logged_nutrition(fake_off, session, db_session_factory):
+    user = models.User(name="off_refresh_log", weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+    session.add(models.NutritionCache(
+        barcode="4000012", food_name="Fake Bar", calories=100.0, protein=10.0, fat=0, carbs=0, fiber=0,
+        source="OFF", fetched_at=datetime.now(timezone.utc)
+    ))
+    session.commit()
+
+    health = services.HealthLogService()
+    (log,), error = health.log_food_batch(session, user, [schemas.FoodLogPayload(barcode="4000012")])
+    assert error is None
+
+    # OFF now reports lower values; deleting the log must still take off what it added
+    fake_off.products["4000012"] = (200, {"status": 1, "product": {
+        "product_name": "Fake Bar", "nutriments": {"energy-kcal_100g": 40, "proteins_100g": 4}
+    }}, 0)
+    off = services.OpenFoodFactsService(client=make_client(fake_off), session_factory=db_session_factory)
+    off.refresh_product("4000012")
+    session.expire_all()
+    assert session.query(models.NutritionCache).filter_by(barcode="4000012").one().calories == 40
+
+    assert health.delete_food_log(session, log.item_log_id, user.user_id)
+    session.expire_all()
+    daily = session.query(models.DailyLog).filter(models.DailyLog.user_id == user.user_id).one()
+    assert daily.total_calories_consumed == 0
+    assert daily.total_protein == 0
+    assert daily.food_item_count == 0
+
+def test_concurrent_lookups_share_one_fetch(fake_off, db_session_factory):
+    off = services.OpenFoodFactsService(client=make_client(fake_off), misses=MissCache())
+    fake_off.responses = [(200, PRODUCT, 0.3)] * 5
+
+    results, errors = [], []
+    def lookup():
+        db = db_session_factory()
+        try:
+            food_id = off.get_product("4000009", db).food_id
+            db.commit()
+            results.append(food_id)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=lookup) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert fake_off.requests == 1
+    assert len(results) == 5 and len(set(results)) == 1
+
+def test_new_product_is_stored_in_the_callers_transaction(fake_off, session):
+    fake_off.products["4000010"] = (200, PRODUCT, 0)
+    off = services.OpenFoodFactsService(client=make_client(fake_off), misses=MissCache())
+    user = models.User(name="off-txn", weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+
+    food = off.get_product("4000010", session)
+    assert food.food_name == "Fake Bar"
+    # The caller decides: rolling back drops its own work and the new food alike
+    session.rollback()
+    assert session.query(models.User).filter(models.User.name == "off-txn").first() is None
+    assert session.query(models.NutritionCache).filter(models.NutritionCache.barcode == "4000010").first() is None
+
+def test_single_flight_shares_errors():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    def failing():
+        started.set()
+        release.wait()
+        raise ValueError("boom")
+
+    errors = []
+    def call():
+        try:
+            flights.do("key", failing)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=call)
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+    assert len(errors) == 2 and errors[0] is errors[1]
+    # The key is free again afterwards
+    assert flights.do("key", lambda: 42) == 42
+
+def write_gz(path, text):
+    import gzip
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(text)
+    return str(path)
+
+def test_import_jsonl_dump_with_resume(tmp_path, session):
+    session.add_all([
+        models.NutritionCache(barcode="5000002", food_name="My Own Bar", calories=1.0, source="MANUAL"),
+        models.NutritionCache(barcode="5000003", food_name="Old OFF Bar", calories=1.0, source="OFF"),
+    ])
+    session.commit()
+
+    records = [
+        {"code": "5000001", "product_name": "Kj Bar", "nutriments": {"energy-kj_100g": 836.8, "fat_100g": "3.5"}},
+        {"code": "5000002", "product_name": "Their Bar", "nutriments": {"energy-kcal_100g": 500}},
+        {"product_name": "No Barcode"},
+        {"code": "5000003", "product_name": "New OFF Bar", "nutriments": {"energy-kcal_100g": 250}},
+        {"code": "5000004", "nutriments": {"proteins_100g": "n/a"}},
+    ]
+    lines = [json.dumps(r) for r in records]
+    lines.insert(3, "{not json")
+    path = write_gz(tmp_path / "products.jsonl.gz", "\n".join(lines) + "\n")
+
+    importer = services.OpenFoodFactsImportService()
+
+    def interrupt(stats):
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        importer.import_file(session, path, batch_size=2, progress=interrupt)
+
+    # The first batch was committed with its checkpoint; the rest picks up after it
+    stats = importer.import_file(session, path, batch_size=2)
+    assert stats["resumed_from"] == 2
+    assert stats["records"] == 6
+    assert stats["skipped"] == 2
+
+    session.expire_all()
+    foods = {f.barcode: f for f in session.query(models.NutritionCache).filter(models.NutritionCache.barcode.like("500000%"))}
+    assert foods["5000001"].calories == pytest.approx(200.0)
+    assert foods["5000001"].fat == 3.5
+    assert foods["5000002"].food_name == "My Own Bar"
+    assert foods["5000003"].food_name == "New OFF Bar"
+    assert foods["5000004"].food_name == "Unknown" and foods["5000004"].protein == 0.0
+    assert importer._get_checkpoint(session) is None
+    assert [f.food_name for f in services.FoodSearchService().search(session, "kj bar")] == ["Kj Bar"]
+
+def test_import_does_not_rewrite_logged_nutrition(tmp_path, session):
+    user = models.User(name="off_import_log", weight_kg=70.0, height_cm=175.0)
+    session.add(user)
+    session.add(models.NutritionCache(
+        barcode="5000020", food_name="Logged Bar", calories=100.0, protein=10.0, fat=0, carbs=0, fiber=0, source="OFF"
+    ))
+    session.commit()
+
+    health = services.HealthLogService()
+    (log,), error = health.log_food_batch(session, user, [schemas.FoodLogPayload(barcode="5000020")])
+    assert error is None
+
+    record = {"code": "5000020", "product_name": "Logged Bar", "nutriments": {"energy-kcal_100g": 40, "proteins_100g": 4}}
+    path = write_gz(tmp_path / "update.jsonl.gz", json.dumps(record) + "\n")
+    services.OpenFoodFactsImportService().import_file(session, path)
+    session.expire_all()
+    assert session.query(models.NutritionCache).filter_by(barcode="5000020").one().calories == 40
+
+    # The log keeps what it added, so deleting it brings the day back to zero
+    assert health.delete_food_log(session, log.item_log_id, user.user_id)
+    session.expire_all()
+    daily = session.query(models.DailyLog).filter(models.DailyLog.user_id == user.user_id).one()
+    assert daily.total_calories_consumed == 0
+    assert daily.total_protein == 0
+
+def test_import_csv_dump(tmp_path, session):
+    rows = [
+        "code\tproduct_name\tenergy-kcal_100g\tproteins_100g\tcarbohydrates_100g",
+        "6000001\tCsv Crackers\t420\t9\t70",
+        "6000002\t\t\t\t",
+    ]
+    path = write_gz(tmp_path / "products.csv.gz", "\n".join(rows) + "\n")
+
+    stats = services.OpenFoodFactsImportService().import_file(session, path)
+    assert stats["imported"] == 2
+
+    crackers = session.query(models.NutritionCache).filter_by(barcode="6000001").one()
+    assert (crackers.food_name, crackers.calories, crackers.protein, crackers.carbs) == ("Csv Crackers", 420, 9, 70)
+    assert crackers.source == "OFF" and crackers.fetched_at is not None
+
+def test_batch_lookup_resolves_in_order(fake_off, session, db_session_factory):
+    session.add_all([
+        models.NutritionCache(barcode="7000001", food_name="Cached Bar", calories=100, source="MANUAL"),
+        models.NutritionCache(food_name="Named Apple", calories=52, source="MANUAL"),
+    ])
+    session.commit()
+
+    named_product = {"status": 1, "product": {"product_name": "Fetched Two"}}
+    fake_off.products = {
+        "7000002": (200, PRODUCT, 0.3),
+        "7000003": (200, named_product, 0.3),
+        "7000004": (200, {"status": 0}, 0.3),
+    }
+    off = services.OpenFoodFactsService(client=make_client(fake_off), misses=MissCache(), session_factory=db_session_factory)
+    lookup = services.FoodLookupService(off_service=off)
+
+    items = [
+        schemas.FoodLookupItem(barcode="7000002"),
+        schemas.FoodLookupItem(food_name="Named Apple"),
+        schemas.FoodLookupItem(barcode="7000001"),
+        schemas.FoodLookupItem(barcode="7000003"),
+        schemas.FoodLookupItem(barcode="7000004", food_name="Named Apple"),
+        schemas.FoodLookupItem(food_name="Nothing Like It"),
+        schemas.FoodLookupItem(barcode="7000001"),
+    ]
+    started = time.monotonic()
+    foods = lookup.lookup(session, items)
+    elapsed = time.monotonic() - started
+
+    # The three unknown barcodes were fetched side by side
+    assert fake_off.requests == 3
+    assert elapsed < 0.8
+    names = [f.food_name if f else None for f in foods]
+    assert names[:4] == ["Fake Bar", "Named Apple", "Cached Bar", "Fetched Two"]
+    # Unknown barcode falls back to the name; nothing matches the last name
+    assert names[4:] == ["Named Apple", None, "Cached Bar"]
+    assert foods[2] is foods[6]
+
+def test_batch_fetches_new_food_after_a_write(fake_off, client, session, monkeypatch, make_user_with_key):
+    user = make_user_with_key("off_batch_write", "off_batch_key")
+    session.add(models.NutritionCache(food_name="Known Crackers", calories=50, source="MANUAL"))
+    session.commit()
+
+    fake_off.products["9990001"] = (200, PRODUCT, 0)
+    monkeypatch.setattr(services.openfoodfacts, "off_client", make_client(fake_off))
+    monkeypatch.setattr(services.openfoodfacts, "off_misses", MissCache())
+
+    # The first event writes, so the second has to store its new food in the same transaction
+    events = [
+        {"data_type": "FOOD_LOG", "payload": {"food_name": "Known Crackers"}},
+        {"data_type": "FOOD_LOG", "payload": {"barcode": "9990001"}},
+    ]
+    response = client.post("/api/webhook/health/batch", headers={"X-Webhook-Secret": "off_batch_key"}, json={"events": events})
+    assert response.status_code == 200
+    assert response.json()["applied"] == 2
+    session.expire_all()
+    assert session.query(models.NutritionCache).filter_by(barcode="9990001").one().food_name == "Fake Bar"
+    daily = session.query(models.DailyLog).filter(models.DailyLog.user_id == user.user_id).one()
+    assert daily.food_item_count == 2
+
+def test_idempotent_food_log_fetches_new_food(fake_off, client, session, db_session_factory, monkeypatch,
+                                              make_user_with_key):
+    user = make_user_with_key("off_idem", "off_idem_key")
+    session.commit()
+
+    fake_off.products["9990002"] = (200, PRODUCT, 0)
+    monkeypatch.setattr(services.openfoodfacts, "off_client", make_client(fake_off))
+    monkeypatch.setattr(services.openfoodfacts, "off_misses", MissCache())
+    # A fresh service prunes on its first claim
+    monkeypatch.setattr(services, "idempotency", services.IdempotencyService(session_factory=db_session_factory))
+
+    headers = {"X-Webhook-Secret": "off_idem_key", "Idempotency-Key": "meal-9990002"}
+    event = {"data_type": "FOOD_LOG", "payload": {"barcode": "9990002"}}
+    first = client.post("/api/webhook/health", headers=headers, json=event)
+    assert first.status_code == 200 and first.json()["message"] == "Food logged"
+    assert client.post("/api/webhook/health", headers=headers, json=event).json()["duplicate"] is True
+    session.expire_all()
+    daily = session.query(models.DailyLog).filter(models.DailyLog.user_id == user.user_id).one()
+    assert daily.food_item_count == 1
@@ -0,0 +1,106 @@
+import time
+from datetime import datetime, timedelta, timezone
+from app import models, outbox
+
+def exercise(calories):
+    return {"data_type": "EXERCISE_SESSION", "payload": {"activity_type": "Rowing", "duration_minutes": 10, "calories_burned": calories}}
+
+def test_async_webhook_queues_and_worker_drains(client, session, db_session_factory, make_user_with_key):
+    user = make_user_with_key("outbox_user", "outbox_key", med_name="Async Med")
+    headers = {"X-Webhook-Secret": "outbox_key"}
+
+    assert client.post("/api/webhook/health/async", headers=headers, json={"data_type": "WEIGHT", "payload": {}}).status_code == 422
+
+    for calories in (30, 40):
+        response = client.post("/api/webhook/health/async", headers=headers, json=exercise(calories))
+        assert response.status_code == 202
+        assert response.json()["status"] == "accepted"
+    dose = {"data_type": "MEDICATION_TAKEN", "payload": {"med_name": "Async Med"}}
+    assert "outbox_id" in client.post("/api/webhook/health/async", headers={**headers, "Idempotency-Key": "a1"}, json=dose).json()
+    # A retry while the first delivery is still queued is recognised too
+    assert client.post("/api/webhook/health/async", headers={**headers, "Idempotency-Key": "a1"}, json=dose).json()["duplicate"] is True
+    client.post("/api/webhook/health/async", headers=headers, json={"data_type": "MEDICATION_TAKEN", "payload": {"med_name": "Unknown"}})
+
+    # Nothing is applied until a worker drains the outbox
+    session.expire_all()
+    assert session.query(models.DailyLog).filter_by(user_id=user.user_id).count() == 0
+
+    worker = outbox.OutboxWorker(session_factory=db_session_factory, batch_size=10)
+    assert worker.drain_once() == 4
+    assert worker.drain_once() == 0
+
+    session.expire_all()
+    assert session.query(models.DailyLog).filter_by(user_id=user.user_id).one().total_calories_burned == 70
+    assert session.query(models.Medication).filter_by(user_id=user.user_id).one().current_inventory == 9
+    failed = session.query(models.WebhookOutbox).filter_by(user_id=user.user_id).one()
+    assert (failed.status, failed.last_error) == ("FAILED", "Medication not found")
+
+    stats = worker.get_stats(session)
+    assert (stats["pending"], stats["failed"], stats["applied_since_start"]) == (0, 1, 3)
+
+def test_transient_errors_keep_events_queued(session, db_session_factory, monkeypatch, make_user_with_key):
+    user = make_user_with_key("outbox_retry", "outbox_retry_key")
+    row = outbox.enqueue(session, user.user_id, exercise(25))
+
+    worker = outbox.OutboxWorker(session_factory=db_session_factory, max_attempts=2)
+    def busy(*args, **kwargs):
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(outbox.services.WebhookBatchService, "process", busy)
+
+    worker.drain_once()
+    session.expire_all()
+    queued = session.get(models.WebhookOutbox, row.outbox_id)
+    assert (queued.status, queued.attempts, queued.last_error) == ("PENDING", 1, "database is locked")
+    worker.drain_once()
+    session.expire_all()
+    assert session.get(models.WebhookOutbox, row.outbox_id).status == "FAILED"
+    assert session.query(models.DailyLog).filter_by(user_id=user.user_id).count() == 0
+
+def test_an_event_that_raises_fails_alone(session, db_session_factory, monkeypatch, make_user_with_key):
+    user = make_user_with_key("outbox_isolate", "outbox_isolate_key")
+    rows = [outbox.enqueue(session, user.user_id, exercise(calories)) for calories in (10, 13, 20)]
+
+    original = outbox.services.HealthLogService.log_exercise
+    def unlucky(self, db, user, data, **kwargs):
+        if data.calories_burned == 13:
+            raise ValueError("unlucky event")
+        return original(self, db, user, data, **kwargs)
+    monkeypatch.setattr(outbox.services.HealthLogService, "log_exercise", unlucky)
+
+    worker = outbox.OutboxWorker(session_factory=db_session_factory)
+    assert worker.drain_once() == 3
+    session.expire_all()
+    remaining = session.query(models.WebhookOutbox).filter_by(user_id=user.user_id).all()
+    assert [(row.outbox_id, row.status, row.last_error) for row in remaining] == [(rows[1].outbox_id, "FAILED", "unlucky event")]
+    assert session.query(models.DailyLog).filter_by(user_id=user.user_id).one().total_calories_burned == 30
+    assert session.query(models.ExerciseLog).filter_by(user_id=user.user_id).count() == 2
+
+def test_events_drained_after_midnight_keep_their_day(session, db_session_factory, make_user_with_key):
+    user = make_user_with_key("outbox_midnight", "outbox_midnight_key")
+    received = datetime.combine(datetime.now(timezone.utc).date(), datetime.min.time()) - timedelta(minutes=10)
+    row = outbox.enqueue(session, user.user_id, exercise(35))
+    row.received_at = received
+    session.commit()
+
+    worker = outbox.OutboxWorker(session_factory=db_session_factory)
+    assert worker.drain_once() == 1
+    session.expire_all()
+    daily = session.query(models.DailyLog).filter_by(user_id=user.user_id).one()
+    assert (daily.date, daily.total_calories_burned) == (received.date(), 35)
+    assert session.query(models.ExerciseLog).filter_by(user_id=user.user_id).one().timestamp == received
+
+def test_background_worker_applies_new_events(session, db_session_factory, make_user_with_key):
+    user = make_user_with_key("outbox_thread", "outbox_thread_key")
+    worker = outbox.OutboxWorker(session_factory=db_session_factory, poll_interval=0.05)
+    worker.start()
+    try:
+        outbox.enqueue(session, user.user_id, exercise(15))
+        deadline = time.monotonic() + 3
+        while time.monotonic() < deadline:
+            session.expire_all()
+            if session.query(models.WebhookOutbox).filter_by(user_id=user.user_id).count() == 0:
+                break
+            time.sleep(0.05)
+    finally:
+        worker.stop()
+    assert session.query(models.DailyLog).filter_by(user_id=user.user_id).one().total_calories_burned == 15
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from app import models, pagination
+
+def fetch_all(client, url, headers, **params):
+    items, cursor, pages = [], None, 0
+    while True:
+        response = client.get(url, params={**params, **({"cursor": cursor} if cursor else {})}, headers=headers)
+        assert response.status_code == 200
+        items.extend(response.json())
+        pages += 1
+        cursor = response.headers.get(pagination.NEXT_CURSOR_HEADER)
+        if not cursor:
+            return items, pages
+
+def test_bp_history_keyset_pages(client, session, auth_headers):
+    headers = auth_headers("pager_bp")
+    user = session.query(models.User).filter(models.User.name == "pager_bp").one()
+    base = datetime(2024, 1, 1, 12, 0)
+    # Pairs of readings share a timestamp, so the id tie-breaker matters
+    session.execute(insert(models.BloodPressure), [
+        {"user_id": user.user_id, "systolic": 100 + i, "diastolic": 70, "pulse": 60,
+         "timestamp": base + timedelta(days=i // 2)}
+        for i in range(25)
+    ])
+    session.commit()
+
+    items, pages = fetch_all(client, "/api/v1/log/history/bp", headers, limit=4)
+    assert pages == 7
+    assert [bp["systolic"] for bp in items] == list(range(124, 99, -1))
+
+    # Local-date filter: 2024-01-03 to 2024-01-04 holds readings 4-7
+    items, _ = fetch_all(client, "/api/v1/log/history/bp", headers, limit=3,
+                         start_date="2024-01-03", end_date="2024-01-04")
+    assert [bp["systolic"] for bp in items] == [107, 106, 105, 104]
+
+    response = client.get("/api/v1/log/history/bp", params={"cursor": "not-a-cursor"}, headers=headers)
+    assert response.status_code == 400
+
+def test_medications_cursor_pages(client, auth_headers):
+    headers = auth_headers("pager_meds")
+    for i in range(5):
+        client.post("/api/v1/medications/", json={
+            "name": f"Med {i}", "frequency": "daily", "type": "OTC", "current_inventory": 30, "refills_remaining": 1
+        }, headers=headers)
+
+    items, pages = fetch_all(client, "/api/v1/medications/", headers, limit=2)
+    assert pages == 3
+    assert [m["name"] for m in items] == [f"Med {i}" for i in range(5)]
+
+    # Offset paging still works for existing clients
+    response = client.get("/api/v1/medications/", params={"skip": 3, "limit": 10}, headers=headers)
+    assert [m["name"] for m in response.json()] == ["Med 3", "Med 4"]